@@ -0,0 +1,337 @@
+# Registry of Twitter accounts, so posts reference an account_id instead of four secrets
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app import config
+from app.proxy_health import mask_proxy_settings
+from app.proxy_pool import account_user_id, get_proxy_pools
+from app.storage import SQLiteStore
+from app.validation import CREDENTIAL_FIELDS, ValidationError
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+except ImportError:  # cryptography is only needed when the registry is enabled
+    Fernet = None
+
+# Decrypted accounts kept in memory, keyed on account_id and version
+CACHE_SIZE = 10000
+
+
+def _mask(value):
+    return "***" + value[-4:] if len(value) > 4 else "***"
+
+
+def _check_account(fields, partial=False):
+    """
+    Check the fields of a new account, or of an update when partial
+
+    Raises:
+        ValueError: If a field is missing or of the wrong type
+    """
+    if not isinstance(fields, dict):
+        raise ValueError("Request body must be a JSON object")
+    unknown = set(fields) - set(CREDENTIAL_FIELDS) - {'name', 'proxy', 'proxy_pool'}
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    for field in CREDENTIAL_FIELDS:
+        if field not in fields and partial:
+            continue
+        if not isinstance(fields.get(field), str) or not fields[field].strip():
+            raise ValueError(f"Field '{field}' must be a non-empty string")
+    if fields.get('name') is not None and not isinstance(fields['name'], str):
+        raise ValueError("Field 'name' must be a string")
+    proxy = fields.get('proxy')
+    if proxy is not None and (
+        not isinstance(proxy, dict) or not all(isinstance(value, str) for value in proxy.values())
+    ):
+        raise ValueError("Field 'proxy' must be an object of proxy URLs")
+    proxy_pool = fields.get('proxy_pool')
+    if proxy_pool is not None and (not isinstance(proxy_pool, str) or get_proxy_pools().get(proxy_pool) is None):
+        raise ValueError(f"Unknown proxy pool: {proxy_pool}")
+
+
+class AccountRegistry(SQLiteStore):
+    """
+    Twitter accounts with their credentials and proxy binding
+
+    Credentials and proxy settings are encrypted at rest with Fernet
+    (AES-128-CBC with an HMAC). Several keys may be given: the first
+    encrypts, all of them decrypt, so a key is rotated by prepending the new
+    one; accounts are re-encrypted with it when they are updated. Decrypted
+    accounts are cached per version, so posts skip the decryption while an
+    update made by any worker is seen by the next post.
+    """
+
+    def __init__(self, path=None, keys=None):
+        """
+        Args:
+            path (str, optional): SQLite database file
+            keys (str, optional): Comma separated Fernet keys, the first one encrypts
+
+        Raises:
+            RuntimeError: If the cryptography package is not installed
+            ValueError: If no key or an invalid key is given
+        """
+        if Fernet is None:
+            raise RuntimeError("The account registry requires the cryptography package")
+        keys = config.ACCOUNTS_KEY if keys is None else keys
+        keys = [key.strip() for key in keys.split(',') if key.strip()]
+        if not keys:
+            raise ValueError("The account registry requires ACCOUNTS_KEY")
+        self._fernet = MultiFernet([Fernet(key) for key in keys])
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        super().__init__(config.ACCOUNTS_DB if path is None else path, [
+            '''
+            CREATE TABLE IF NOT EXISTS accounts (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                user_id TEXT,
+                proxy_pool TEXT,
+                secrets BLOB NOT NULL,
+                version INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS accounts_created ON accounts (created_at, id)'
+        ])
+
+    def create(self, fields):
+        """
+        Register an account
+
+        Args:
+            fields (dict): Credentials, and optional name, proxy and proxy_pool
+
+        Returns:
+            dict: Public view of the account, without secrets
+
+        Raises:
+            ValueError: If a field is missing or invalid
+        """
+        _check_account(fields)
+        account_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT INTO accounts (id, name, user_id, proxy_pool, secrets, version, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, 1, ?, ?)',
+                (account_id, fields.get('name'), account_user_id(fields['access_token']), fields.get('proxy_pool'),
+                 self._encrypt(fields), now, now)
+            )
+        return self.get(account_id)
+
+    def get(self, account_id):
+        """
+        Return the public view of an account, or None if it is unknown
+        """
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                'SELECT id, name, user_id, proxy_pool, secrets, version, created_at, updated_at '
+                'FROM accounts WHERE id = ?', (account_id,)
+            ).fetchone()
+        return self._view(row) if row is not None else None
+
+    def list(self, limit=100, after=None):
+        """
+        Registered accounts in the order they were created
+
+        Args:
+            limit (int): Maximum number of accounts returned
+            after (str, optional): account_id of the last account of the previous page
+
+        Returns:
+            list: Public views of the accounts
+        """
+        columns = 'SELECT id, name, user_id, proxy_pool, secrets, version, created_at, updated_at FROM accounts '
+        with self.transaction(write=False) as connection:
+            if after is None:
+                rows = connection.execute(columns + 'ORDER BY created_at, id LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = connection.execute(
+                    columns + 'WHERE (created_at, id) > (SELECT created_at, id FROM accounts WHERE id = ?) '
+                    'ORDER BY created_at, id LIMIT ?', (after, limit)
+                ).fetchall()
+        return [self._view(row) for row in rows]
+
+    def update(self, account_id, fields):
+        """
+        Change some fields of an account; a null proxy or proxy_pool removes it
+
+        Returns:
+            dict: Public view of the account, or None if it is unknown
+
+        Raises:
+            ValueError: If a field is invalid
+        """
+        _check_account(fields, partial=True)
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT name, proxy_pool, secrets, version FROM accounts WHERE id = ?', (account_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            account = dict(self._decrypt(row[2]), name=row[0], proxy_pool=row[1])
+            account.update(fields)
+            connection.execute(
+                'UPDATE accounts SET name = ?, user_id = ?, proxy_pool = ?, secrets = ?, version = ?, updated_at = ? '
+                'WHERE id = ?',
+                (account.get('name'), account_user_id(account['access_token']), account.get('proxy_pool'),
+                 self._encrypt(account), row[3] + 1, time.time(), account_id)
+            )
+        return self.get(account_id)
+
+    def delete(self, account_id):
+        """
+        Remove an account
+
+        Returns:
+            bool: Whether the account existed
+        """
+        with self.transaction() as connection:
+            deleted = connection.execute('DELETE FROM accounts WHERE id = ?', (account_id,)).rowcount
+        with self._cache_lock:
+            self._cache.pop(account_id, None)
+        return bool(deleted)
+
+    def credentials(self, account_id):
+        """
+        Credentials and proxy binding of an account, for posting
+
+        Returns:
+            dict: api_key, api_secret, access_token, access_secret, and proxy
+            or proxy_pool when the account has one, or None if it is unknown
+        """
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                'SELECT version, secrets, proxy_pool FROM accounts WHERE id = ?', (account_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        version, secrets, proxy_pool = row
+        with self._cache_lock:
+            cached = self._cache.get(account_id)
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(account_id)
+                return dict(cached[1])
+
+        account = self._decrypt(secrets)
+        credentials = {field: account[field] for field in CREDENTIAL_FIELDS}
+        if account.get('proxy'):
+            credentials['proxy'] = account['proxy']
+        elif proxy_pool:
+            credentials['proxy_pool'] = proxy_pool
+        with self._cache_lock:
+            self._cache[account_id] = (version, credentials)
+            self._cache.move_to_end(account_id)
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return dict(credentials)
+
+    def stats(self):
+        with self.transaction(write=False) as connection:
+            accounts = connection.execute('SELECT COUNT(*) FROM accounts').fetchone()[0]
+        with self._cache_lock:
+            cached = len(self._cache)
+        return {"accounts": accounts, "cached": cached}
+
+    def _encrypt(self, fields):
+        secrets = {field: fields[field] for field in CREDENTIAL_FIELDS}
+        secrets['proxy'] = fields.get('proxy')
+        return self._fernet.encrypt(json.dumps(secrets).encode('utf-8'))
+
+    def _decrypt(self, token):
+        try:
+            return json.loads(self._fernet.decrypt(token))
+        except InvalidToken:
+            raise RuntimeError("Account secrets cannot be decrypted, check ACCOUNTS_KEY")
+
+    def _view(self, row):
+        account_id, name, user_id, proxy_pool, secrets, version, created_at, updated_at = row
+        account = self._decrypt(secrets)
+        return {
+            "account_id": account_id,
+            "name": name,
+            "user_id": user_id,
+            "api_key": _mask(account['api_key']),
+            "access_token": _mask(account['access_token']),
+            "proxy": mask_proxy_settings(account.get('proxy')),
+            "proxy_pool": proxy_pool,
+            "version": version,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+
+
+def apply_account(data):
+    """
+    Fill in the credentials of a post that references an account_id
+
+    A proxy or proxy_pool given in the post wins over the account's binding.
+
+    Args:
+        data (dict): Request body, modified in place
+
+    Raises:
+        ValidationError: If the account is unknown or credentials are also given
+    """
+    account_id = data['account_id']
+    registry = get_account_registry()
+    if registry is None:
+        raise ValidationError("The account registry is disabled", 'unknown_account')
+    if not isinstance(account_id, str):
+        raise ValidationError("Field 'account_id' must be a string")
+    if any(field in data for field in CREDENTIAL_FIELDS):
+        raise ValidationError("Fields 'account_id' and credentials cannot be combined")
+
+    credentials = registry.credentials(account_id)
+    if credentials is None:
+        raise ValidationError(f"Unknown account: {account_id}", 'unknown_account')
+    if data.get('proxy') or data.get('proxy_pool'):
+        credentials.pop('proxy', None)
+        credentials.pop('proxy_pool', None)
+    data.update(credentials)
+
+
+def account_reference(data):
+    """
+    Copy of a post without what apply_account() filled in, for posts stored until they run
+
+    The stored post keeps only its account_id, so no secret leaves the
+    encrypted registry and the post runs with the account as it is then.
+
+    Args:
+        data (dict): Request body that passed apply_account()
+
+    Returns:
+        dict: Request body without the credentials and proxy binding of the account
+    """
+    reference = {field: value for field, value in data.items() if field not in CREDENTIAL_FIELDS}
+    registry = get_account_registry()
+    binding = registry.credentials(data['account_id']) if registry is not None else None
+    for field in ('proxy', 'proxy_pool'):
+        if binding and field in binding and reference.get(field) == binding[field]:
+            del reference[field]
+    return reference
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_account_registry():
+    """
+    Return the process-wide account registry, or None when ACCOUNTS_KEY is not set
+    """
+    global _default_registry
+    if not config.ACCOUNTS_KEY:
+        return None
+    if _default_registry is None:
+        with _default_registry_lock:
+            if _default_registry is None:
+                _default_registry = AccountRegistry()
+    return _default_registry
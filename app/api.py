@@ -1,13 +1,23 @@
 from flask import Blueprint, jsonify
+from app import config
+from app.client_pool import get_client_pool
+from app.proxy_health import get_proxy_health
+from app.proxy_pool import get_proxy_pools
+from app.media_cache import get_media_cache
+from app.rate_limit import get_rate_limiter
+from app.dedup import get_dedup_index
+from app.idempotency import get_idempotency_store
 
 api_bp = Blueprint('api', __name__)
 
-@api_bp.route('/docs', methods=['GET'])
-def api_docs():
+def get_api_docs():
     """
-    Return API documentation
+    API documentation, shared by the WSGI and ASGI applications
+
+    Returns:
+        dict: Documentation of every endpoint
     """
-    docs = {
+    return {
         "name": "Twitter Poster API",
         "version": "1.0.0",
         "description": "API for posting content to Twitter with proxy support",
@@ -18,23 +28,343 @@ def api_docs():
                 "description": "Health check endpoint",
                 "response": {"status": "ok"}
             },
+            {
+                "path": "/ready",
+                "method": "GET",
+                "description": "Readiness of the worker for load balancers: 200 when it should get traffic, 503 with Retry-After otherwise. Served from state refreshed in the background, never probes anything",
+                "response": {
+                    "status": "ready or unavailable",
+                    "checks": "capacity (in_flight, max_in_flight), queue (pending, limit), errors (error_rate, requests, window) and proxies (healthy, failing), each with ok",
+                    "checked_seconds_ago": "Age of the background snapshot"
+                }
+            },
+            {
+                "path": "/metrics",
+                "method": "GET",
+                "description": "Prometheus metrics: per-phase latency histograms, posts by outcome, error class and proxy, in-flight gauges (404 when METRICS_ENABLED is off)",
+                "response": "text/plain exposition format"
+            },
             {
                 "path": "/post",
                 "method": "POST",
-                "description": "Post a tweet with optional image",
+                "description": "Post a tweet with optional image. Accepts JSON or multipart/form-data (image as a file field, proxy as a JSON encoded field)",
                 "request_body": {
                     "api_key": "Twitter API key",
                     "api_secret": "Twitter API secret",
                     "access_token": "Twitter access token",
                     "access_secret": "Twitter access token secret",
+                    "account_id": "(Optional) ID of a registered account (see /accounts), instead of the four credentials",
                     "text": "Tweet text content",
-                    "image": "(Optional) Base64 encoded PNG image",
-                    "proxy": "(Optional) Proxy configuration object with http/https keys"
+                    "image": "(Optional) Base64 encoded PNG image, or an image file in multipart requests",
+                    "images": "(Optional) List of up to 4 base64 encoded images (or repeated 'image' files in multipart requests), uploaded in parallel. A GIF or MP4 video must be the only media",
+                    "proxy": "(Optional) Proxy configuration object with http/https keys",
+                    "proxy_pool": "(Optional) Name of a server-side proxy pool, instead of 'proxy'. Without either, the pool of the account (or the default pool) is used",
+                    "async": "(Optional) true to queue the post and get a job ID (also enabled by the 'Prefer: respond-async' header)",
+                    "callback_url": "(Optional) URL that receives the finished job as JSON in async mode",
+                    "verbose": "(Optional) false for a lean response without the echoed request and response details (also ?verbose=false or the 'Prefer: return=minimal' header); true forces them when RESPONSE_VERBOSE is off",
+                    "publish_at": "(Optional) ISO 8601 timestamp (UTC unless it has an offset) or Unix time; the post is stored and published at that time, answering 202 with a schedule_id"
+                },
+                "headers": {
+                    "Idempotency-Key": "(Optional) Client-chosen key; retries with the same key and body replay the first response (marked 'Idempotent-Replayed: true') instead of posting again. 422 when the key was used for a different body, 409 when the first request is still running",
+                    "X-Request-Deadline": "(Optional) Seconds the post may take, up to REQUEST_DEADLINE_MAX (default REQUEST_DEADLINE); 400 invalid_deadline when not a positive number"
                 },
                 "response": {
                     "status": "success",
                     "tweet_url": "URL to the posted tweet",
-                    "tweet_id": "ID of the posted tweet"
+                    "tweet_id": "ID of the posted tweet",
+                    "request": "Echo of the request with masked credentials (verbose responses only)",
+                    "response": "Details of the Twitter calls (verbose responses only)"
+                },
+                "validation_error_response": {
+                    "error_code": "invalid_request, tweet_too_long, invalid_media, media_too_large, unknown_proxy_pool or unknown_account (400, checked before any call to Twitter)",
+                    "message": "What is wrong with the request"
+                },
+                "rate_limited_response": {
+                    "error_code": "rate_limited (429 with Retry-After when the account or app is out of posts)",
+                    "retry_after": "Seconds until the post is expected to be accepted",
+                    "expected_send_at": "Same moment as an ISO 8601 UTC timestamp"
+                },
+                "deadline_exceeded_response": {
+                    "error_code": "deadline_exceeded (504 when the post is still running at its deadline)",
+                    "phase": "proxy_check, client_init, rate_limit_wait, media_upload or create_tweet; after create_tweet the tweet may have been created"
+                },
+                "duplicate_content_response": {
+                    "error_code": "duplicate_content (409 when DEDUP_ENABLED and the account posted the same text and media within DEDUP_WINDOW, or is posting it right now)",
+                    "tweet_id": "The earlier tweet, when it is known",
+                    "tweet_url": "URL of the earlier tweet",
+                    "posted_at": "When the earlier tweet was posted, ISO 8601 UTC"
+                },
+                "overloaded_response": {
+                    "error_code": "overloaded (503 with Retry-After when the worker already runs ADMISSION_MAX_IN_FLIGHT posts)",
+                    "retry_after": "Seconds after which the post should be sent again, ideally to another node"
+                },
+                "proxy_pool_unavailable_response": {
+                    "error_code": "proxy_pool_unavailable (503 with Retry-After when every proxy of the pool is out of rotation)",
+                    "retry_after": "Seconds until a proxy of the pool is tried again"
+                },
+                "async_response": {
+                    "status": "accepted",
+                    "job_id": "ID of the queued job (202 Accepted, 429 with Retry-After when the queue is full)",
+                    "status_url": "URL to poll for the job result"
+                }
+            },
+            {
+                "path": "/post/batch",
+                "method": "POST",
+                "description": "Post many tweets concurrently; results are streamed as one JSON line per post",
+                "request_body": {
+                    "accounts": "(Optional) Map of account name to credentials (and optional proxy or proxy name)",
+                    "proxies": "(Optional) Map of proxy name to proxy configuration object",
+                    "posts": "List of posts: /post bodies, optionally with 'account' and a proxy name instead of inline values",
+                    "verbose": "(Optional) false for lean results without the echoed request and response details",
+                    "concurrency": "(Optional) Lower the global limit of parallel posts",
+                    "account_concurrency": "(Optional) Lower the limit of parallel posts per account",
+                    "stream": "(Optional) false to get a single JSON document instead of NDJSON lines"
+                },
+                "response": {
+                    "index": "Position of the post in the request",
+                    "status_code": "HTTP status /post would have returned for this post",
+                    "result": "Response body /post would have returned for this post",
+                    "summary": "Last line: total, succeeded and failed counts"
+                }
+            },
+            {
+                "path": "/thread",
+                "method": "POST",
+                "description": "Post a thread: each tweet replies to the previous one; media are uploaded up front, in parallel",
+                "request_body": {
+                    "api_key": "Twitter API key (or account_id)",
+                    "api_secret": "Twitter API secret",
+                    "access_token": "Twitter access token",
+                    "access_secret": "Twitter access token secret",
+                    "account_id": "(Optional) Registered account instead of the four credentials",
+                    "proxy": "(Optional) Proxy configuration object, or proxy_pool",
+                    "tweets": "List of tweets in thread order: {text, image or images} as in /post (maximum THREAD_MAX_TWEETS)",
+                    "in_reply_to_tweet_id": "(Optional) Tweet the first tweet replies to",
+                    "verbose": "(Optional) false for a lean response"
+                },
+                "response": {
+                    "status": "success or error",
+                    "thread_id": "Identifies the thread; sending the same thread again resumes it",
+                    "tweet_id": "ID of the first tweet",
+                    "tweets": "Posted tweets: index, tweet_id and tweet_url",
+                    "failed_index": "On error, the first tweet not posted; send the same request again to resume from it",
+                    "error_code": "rate_limited (429), deadline_exceeded (504, with phase), overloaded (503), thread_in_progress (409) or a validation code (400, with index)"
+                }
+            },
+            {
+                "path": "/scheduled",
+                "method": "GET",
+                "description": "Posts waiting for their publish_at, in the order they are due",
+                "query": {
+                    "limit": "(Optional) Posts per page, 1 to 1000, default 100",
+                    "after": "(Optional) 'next' value of the previous page"
+                },
+                "response": {
+                    "posts": "List of scheduled posts (see /scheduled/<schedule_id>)",
+                    "next": "Value of 'after' for the next page, null on the last page"
+                }
+            },
+            {
+                "path": "/scheduled/<schedule_id>",
+                "method": "GET",
+                "description": "State of a scheduled post",
+                "response": {
+                    "schedule_id": "ID of the scheduled post",
+                    "state": "scheduled, dispatched or cancelled",
+                    "publish_at": "When the post is published, ISO 8601 UTC",
+                    "text": "Tweet text",
+                    "job_id": "Job posting the tweet once dispatched",
+                    "job": "State and result of that job (see /jobs/<job_id>)"
+                }
+            },
+            {
+                "path": "/scheduled/<schedule_id>",
+                "method": "DELETE",
+                "description": "Cancel a scheduled post; 409 once it was dispatched",
+                "response": "The cancelled post"
+            },
+            {
+                "path": "/accounts",
+                "method": "POST",
+                "description": "Register an account; its credentials and proxy are stored encrypted (404 unless ACCOUNTS_KEY is set)",
+                "request_body": {
+                    "api_key": "Twitter API key",
+                    "api_secret": "Twitter API secret",
+                    "access_token": "Twitter access token",
+                    "access_secret": "Twitter access token secret",
+                    "name": "(Optional) Label of the account",
+                    "proxy": "(Optional) Proxy configuration used by the account's posts",
+                    "proxy_pool": "(Optional) Proxy pool used by the account's posts when it has no proxy"
+                },
+                "response": "The account (201 Created with Location)"
+            },
+            {
+                "path": "/accounts",
+                "method": "GET",
+                "description": "Registered accounts in the order they were created",
+                "query": {
+                    "limit": "(Optional) Accounts per page, 1 to 1000, default 100",
+                    "after": "(Optional) 'next' value of the previous page"
+                },
+                "response": {
+                    "accounts": "List of accounts (see /accounts/<account_id>)",
+                    "next": "Value of 'after' for the next page, null on the last page"
+                }
+            },
+            {
+                "path": "/accounts/<account_id>",
+                "method": "GET",
+                "description": "A registered account; secrets are never returned",
+                "response": {
+                    "account_id": "ID to post with",
+                    "name": "Label of the account",
+                    "user_id": "Twitter user ID, from the access token",
+                    "api_key": "Last characters of the API key",
+                    "access_token": "Last characters of the access token",
+                    "proxy": "Masked proxy configuration",
+                    "proxy_pool": "Proxy pool of the account",
+                    "version": "Incremented by every update"
+                }
+            },
+            {
+                "path": "/accounts/<account_id>",
+                "method": "PATCH",
+                "description": "Change some fields of an account (same fields as POST /accounts, null removes proxy or proxy_pool)",
+                "response": "The updated account"
+            },
+            {
+                "path": "/accounts/<account_id>",
+                "method": "DELETE",
+                "description": "Remove an account",
+                "response": {
+                    "status": "deleted",
+                    "account_id": "ID of the removed account"
+                }
+            },
+            {
+                "path": "/jobs/<job_id>",
+                "method": "GET",
+                "description": "State and result of an asynchronous post",
+                "response": {
+                    "job_id": "ID of the job",
+                    "state": "queued, running, succeeded or failed",
+                    "status_code": "HTTP status the synchronous /post would have returned (finished jobs only)",
+                    "result": "Response body the synchronous /post would have returned (finished jobs only)",
+                    "attempts": "Attempts made so far (OUTBOX_ENABLED only)",
+                    "next_attempt_at": "When a failed post is retried (OUTBOX_ENABLED only)",
+                    "last_result": "Response of the last failed attempt (OUTBOX_ENABLED only)"
+                }
+            },
+            {
+                "path": "/api/clients/stats",
+                "method": "GET",
+                "description": "Hit/miss counters and size of the cached Twitter client pool",
+                "response": {
+                    "size": "Number of cached clients",
+                    "max_size": "Pool capacity",
+                    "idle_ttl": "Seconds an unused client is kept",
+                    "hits": "Lookups served from the pool",
+                    "misses": "Lookups that created a new client",
+                    "evictions": "Clients dropped because of capacity or idleness",
+                    "hit_ratio": "hits / (hits + misses)"
+                }
+            },
+            {
+                "path": "/api/media/stats",
+                "method": "GET",
+                "description": "Counters of the cache of uploaded media_ids reused for identical content from the same account",
+                "response": {
+                    "enabled": "Whether the media cache is enabled",
+                    "size": "Number of cached media_ids",
+                    "hits": "Uploads skipped because the content was already uploaded",
+                    "misses": "Uploads that went to Twitter",
+                    "evictions": "Entries dropped because the cache was full",
+                    "expirations": "Entries dropped because the media expired"
+                }
+            },
+            {
+                "path": "/api/rate-limits",
+                "method": "GET",
+                "description": "Counters of the per-account and per-app posting rate limiter",
+                "response": {
+                    "enabled": "Whether client-side rate limiting is enabled",
+                    "tracked": "Number of accounts and apps with a token bucket",
+                    "blocked": "Accounts currently blocked after a 429 or an exhausted platform limit",
+                    "deferred": "Posts answered with 429 because no slot was available in time",
+                    "rejected_by_platform": "Posts Twitter answered with 429"
+                }
+            },
+            {
+                "path": "/api/idempotency",
+                "method": "GET",
+                "description": "Counters of the Idempotency-Key store",
+                "response": {
+                    "enabled": "Whether Idempotency-Key is honoured",
+                    "running": "Keys whose request is still running",
+                    "done": "Keys with a stored response that is replayed",
+                    "failed": "Keys whose last attempt failed with 429 or 5xx and may be retried",
+                    "replays": "Responses replayed by this worker",
+                    "ttl": "Seconds a response is replayed"
+                }
+            },
+            {
+                "path": "/api/dedup",
+                "method": "GET",
+                "description": "Size of the index of recently posted content",
+                "response": {
+                    "enabled": "Whether duplicate content is rejected",
+                    "entries": "Exact fingerprints stored, including posts being sent",
+                    "accounts": "Accounts with stored fingerprints",
+                    "summaries": "Bloom summaries of fingerprints beyond max_per_account",
+                    "summary_bytes": "Total size of the summaries",
+                    "duplicates": "Posts rejected by this worker",
+                    "window": "Seconds identical content is rejected",
+                    "max_per_account": "Exact fingerprints kept per account",
+                    "bloom": "Whether older fingerprints are folded into summaries"
+                }
+            },
+            {
+                "path": "/api/proxies",
+                "method": "GET",
+                "description": "Cached health of the proxies used by recent posts (passwords masked)",
+                "response": {
+                    "proxies": [{
+                        "proxy": "Masked proxy configuration",
+                        "healthy": "Result of the last connection test",
+                        "error": "Error of the last connection test, if any",
+                        "latency_ms": "Duration of the last connection test",
+                        "checked_seconds_ago": "Age of the last connection test",
+                        "fresh": "Whether the result is still within its TTL",
+                        "probes": "Number of connection tests run",
+                        "failures": "Number of failed connection tests"
+                    }],
+                    "background_probing": "Whether proxies in use are re-tested in the background"
+                }
+            },
+            {
+                "path": "/api/proxy-pools",
+                "method": "GET",
+                "description": "State of the configured proxy pools and the circuit breakers of their proxies (passwords masked)",
+                "response": {
+                    "pools": {
+                        "<name>": {
+                            "proxies": [{
+                                "proxy": "Masked proxy configuration",
+                                "state": "closed (in rotation), open (out of rotation) or half_open (next post is a trial)",
+                                "latency_ms": "Average duration of posts through the proxy",
+                                "success_rate": "Average share of posts that reached Twitter",
+                                "requests": "Posts sent through the proxy",
+                                "errors": "Posts that failed because of the proxy",
+                                "retry_in": "Seconds until an open proxy is tried again"
+                            }],
+                            "available": "Proxies in rotation",
+                            "failovers": "Posts moved to another proxy",
+                            "unavailable": "Posts answered 503 because no proxy was available"
+                        }
+                    },
+                    "accounts": "Accounts pinned to a pool",
+                    "default": "Pool of the other accounts, if any"
                 }
             },
             {
@@ -45,4 +375,82 @@ def api_docs():
             }
         ]
     }
-    return jsonify(docs)
+
+
+@api_bp.route('/docs', methods=['GET'])
+def api_docs():
+    """
+    Return API documentation
+    """
+    return jsonify(get_api_docs())
+
+
+@api_bp.route('/clients/stats', methods=['GET'])
+def client_pool_stats():
+    """
+    Return counters of the shared Twitter client pool
+    """
+    return jsonify(get_client_pool().stats())
+
+
+@api_bp.route('/proxies', methods=['GET'])
+def proxy_status():
+    """
+    Return cached health and probe latency of known proxies
+    """
+    registry = get_proxy_health()
+    return jsonify({
+        "proxies": registry.status(),
+        "background_probing": registry.probe_interval > 0
+    })
+
+
+@api_bp.route('/proxy-pools', methods=['GET'])
+def proxy_pool_status():
+    """
+    Return the state of the configured proxy pools
+    """
+    return jsonify(get_proxy_pools().status())
+
+
+@api_bp.route('/media/stats', methods=['GET'])
+def media_cache_stats():
+    """
+    Return counters of the shared media upload cache
+    """
+    cache = get_media_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
+
+@api_bp.route('/rate-limits', methods=['GET'])
+def rate_limit_stats():
+    """
+    Return counters of the shared posting rate limiter
+    """
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(limiter.stats(), enabled=True))
+
+
+@api_bp.route('/idempotency', methods=['GET'])
+def idempotency_stats():
+    """
+    Return counters of the Idempotency-Key store
+    """
+    store = get_idempotency_store()
+    if store is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(store.stats(), enabled=True))
+
+
+@api_bp.route('/dedup', methods=['GET'])
+def dedup_stats():
+    """
+    Return the size of the index of recently posted content
+    """
+    if not config.DEDUP_ENABLED:
+        return jsonify({"enabled": False})
+    return jsonify(dict(get_dedup_index().stats(), enabled=True))
@@ -0,0 +1,302 @@
+# ASGI application running posts on the asynchronous engine
+import json
+import re
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from app import config, log, metrics
+from app.api import get_api_docs
+from app.async_service import get_async_client_pool
+from app.deadline import parse_deadline, run_blocking
+from app.idempotency import get_idempotency_store, idempotency_key, run_idempotent_async
+from app.jobs import QueueFullError, get_job_manager
+from app.posting import execute_post_async, validate_post_data
+from app.proxy_pool import get_proxy_pools
+from app.readiness import LoadMonitor, OverloadedError
+from app.responses import dumps, is_verbose, shape_job, shape_response
+from app.runtime import start_background_services
+from app.scheduler import get_scheduler, schedule_post
+from app.uploads import StreamingRequest, UploadError, read_post_data, read_uploads
+
+JOB_PATH = re.compile(r'^/jobs/([^/]+)$')
+SCHEDULED_PATH = re.compile(r'^/scheduled/([^/]+)$')
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+async def _read_body(receive, content_length):
+    """
+    Read the whole request body, at most MAX_CONTENT_LENGTH bytes
+    """
+    if content_length is not None and content_length > config.MAX_CONTENT_LENGTH:
+        raise _BodyTooLarge()
+    body = BytesIO()
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.write(message.get('body', b''))
+        if body.tell() > config.MAX_CONTENT_LENGTH:
+            raise _BodyTooLarge()
+        more_body = message.get('more_body', False)
+    return body.getvalue()
+
+
+async def _send_body(send, status, body, content_type, headers=None):
+    response_headers = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'content-length', str(len(body)).encode('latin-1'))
+    ]
+    for name, value in (headers or {}).items():
+        response_headers.append((name.lower().encode('latin-1'), str(value).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_json(send, status, payload, headers=None):
+    with metrics.timed('serialize'):
+        body = dumps(payload)
+    await _send_body(send, status, body, 'application/json', headers)
+    return status
+
+
+def _with_request_id(send, request_id):
+    """
+    Wrap send so the response carries the X-Request-ID header
+    """
+    async def send_with_request_id(message):
+        if message['type'] == 'http.response.start':
+            message = dict(message, headers=list(message.get('headers', [])) + [(b'x-request-id', request_id)])
+        await send(message)
+    return send_with_request_id
+
+
+def _query_value(scope, name):
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(name)
+    return values[0] if values else None
+
+
+def _parse_post_body(scope, headers, body):
+    """
+    Parse a /post body with the same rules as the WSGI app
+
+    Multipart bodies go through StreamingRequest and read_post_data(), so
+    form fields, the JSON proxy field and image files behave identically.
+    """
+    content_type = headers.get('content-type', '')
+    if content_type.split(';')[0].strip() == 'application/json':
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+        'SERVER_NAME': 'asgi',
+        'SERVER_PORT': '0',
+        'wsgi.url_scheme': scope.get('scheme', 'http')
+    }
+    request = StreamingRequest(environ)
+    if request.mimetype != 'multipart/form-data':
+        return None
+    return read_post_data(request)
+
+
+async def _post(scope, receive, send, headers):
+    try:
+        deadline = parse_deadline(headers.get('x-request-deadline'))
+    except ValueError as e:
+        return await _send_json(send, 400, {"status": "error", "error_code": "invalid_deadline", "message": str(e)})
+
+    try:
+        content_length = int(headers['content-length']) if 'content-length' in headers else None
+    except ValueError:
+        return await _send_json(send, 400, {"status": "error", "message": "Invalid Content-Length header"})
+
+    try:
+        body = await _read_body(receive, content_length)
+    except _BodyTooLarge:
+        return await _send_json(send, 413, {
+            "status": "error",
+            "message": f"Request body exceeds the limit of {config.MAX_CONTENT_LENGTH} bytes"
+        })
+
+    # Parsing, validation and every store below block on files, images or SQLite: run them off the event loop
+    try:
+        data = await run_blocking(_parse_post_body, scope, headers, body)
+    except UploadError as e:
+        return await _send_json(send, 400, {"status": "error", "message": str(e)})
+
+    # Lean responses drop the echoed credentials, text and proxy settings
+    verbose = is_verbose(data.get('verbose') if isinstance(data, dict) else None,
+                         _query_value(scope, 'verbose'), headers.get('prefer'))
+
+    error_response = await run_blocking(validate_post_data, data)
+    if error_response:
+        return await _send_json(send, 400, shape_response(error_response, verbose))
+
+    def submit_job():
+        # Asynchronous mode is served by the same job queue as the WSGI app
+        read_uploads(data)
+        try:
+            job = get_job_manager().submit(data, callback_url=data.get('callback_url'))
+        except QueueFullError as e:
+            return {"status": "error", "message": str(e), "retry_after": e.retry_after}, 429
+        return {
+            "status": "accepted",
+            "job_id": job['job_id'],
+            "status_url": f"/jobs/{job['job_id']}"
+        }, 202
+
+    async def publish():
+        if data.get('publish_at') is not None:
+            return await run_blocking(schedule_post, data)
+        if data.get('async') or 'respond-async' in headers.get('prefer', ''):
+            return await run_blocking(submit_job)
+        return await execute_post_async(data, deadline)
+
+    key, fingerprint = idempotency_key(data, headers.get('idempotency-key'))
+    if key is None:
+        response, status_code = await publish()
+        replayed = False
+    else:
+        response, status_code, replayed = await run_idempotent_async(get_idempotency_store(), key, fingerprint, publish)
+
+    response_headers = {}
+    if status_code == 202:
+        response_headers["Location"] = response["status_url"]
+    if status_code in (429, 503) and 'retry_after' in response:
+        response_headers["Retry-After"] = response['retry_after']
+    if replayed:
+        response_headers["Idempotent-Replayed"] = "true"
+    if not verbose and 'return=minimal' in headers.get('prefer', ''):
+        response_headers["Preference-Applied"] = "return=minimal"
+    return await _send_json(send, status_code, shape_response(response, verbose), response_headers)
+
+
+async def _scheduled(scope, send, schedule_id):
+    if not config.SCHEDULE_ENABLED:
+        return await _send_json(send, 404, {"status": "error", "message": "Scheduled posting is disabled"})
+    if schedule_id is None:
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        try:
+            limit = min(max(int(query.get('limit', ['100'])[0]), 1), 1000)
+        except ValueError:
+            limit = 100
+        posts = await run_blocking(get_scheduler().list, limit, query.get('after', [None])[0])
+        return await _send_json(send, 200, {
+            "posts": posts,
+            "next": posts[-1]["schedule_id"] if len(posts) == limit else None
+        })
+
+    try:
+        if scope['method'] == 'DELETE':
+            post = await run_blocking(get_scheduler().cancel, schedule_id)
+        else:
+            post = await run_blocking(get_scheduler().get, schedule_id)
+    except ValueError as e:
+        return await _send_json(send, 409, {"status": "error", "message": str(e)})
+    if post is None:
+        return await _send_json(send, 404, {"status": "error", "message": f"Scheduled post not found: {schedule_id}"})
+    return await _send_json(send, 200, post)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Resume posts left in the outbox and the schedule
+            start_background_services()
+            get_proxy_pools()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await get_async_client_pool().aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def create_asgi_app():
+    """
+    Create the ASGI application
+
+    It serves /health, /ready, /post, /jobs/<job_id>, /scheduled, /metrics
+    and /api/docs with the same contract as the Flask app; /post runs on
+    AsyncTwitterService.
+
+    Returns:
+        callable: ASGI 3 application
+    """
+    log.configure_logging()
+    # One event loop runs many posts: admit as many as a client has connections
+    load_monitor = LoadMonitor(max_in_flight=config.ADMISSION_MAX_IN_FLIGHT or config.ASYNC_MAX_CONNECTIONS)
+    if config.METRICS_ENABLED:
+        metrics.register_collector('admission', load_monitor.gauges)
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await _lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        method = scope['method']
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        # Each request runs in its own task, so the ID stays with this request
+        request_id = log.begin_request(headers.get('x-request-id')).encode('latin-1')
+        send = _with_request_id(send, request_id)
+        job_match = JOB_PATH.match(path)
+        scheduled_match = SCHEDULED_PATH.match(path)
+
+        if path == '/post' and method == 'POST':
+            endpoint = 'post_tweet'
+            try:
+                with load_monitor.admit():
+                    status = await _post(scope, receive, send, headers)
+            except OverloadedError as e:
+                status = await _send_json(send, 503, {
+                    "status": "error",
+                    "error_code": "overloaded",
+                    "message": str(e),
+                    "retry_after": e.retry_after
+                }, {"Retry-After": e.retry_after})
+            else:
+                load_monitor.record_result(status)
+        elif path == '/health' and method == 'GET':
+            endpoint = 'health_check'
+            status = await _send_json(send, 200, {"status": "ok"})
+        elif path == '/ready' and method == 'GET':
+            endpoint = 'readiness_check'
+            ready, body = load_monitor.ready()
+            status = await _send_json(send, 200 if ready else 503, body,
+                                      None if ready else {"Retry-After": load_monitor.retry_after})
+        elif path == '/api/docs' and method == 'GET':
+            endpoint = 'api.api_docs'
+            status = await _send_json(send, 200, get_api_docs())
+        elif job_match and method == 'GET':
+            endpoint = 'job_status'
+            job = await run_blocking(get_job_manager().get, job_match.group(1))
+            if job is None:
+                status = await _send_json(send, 404, {"status": "error", "message": f"Job not found: {job_match.group(1)}"})
+            else:
+                verbose = is_verbose(query=_query_value(scope, 'verbose'), prefer=headers.get('prefer'))
+                status = await _send_json(send, 200, shape_job(job, verbose))
+        elif path == '/scheduled' and method == 'GET':
+            endpoint = 'scheduled_posts'
+            status = await _scheduled(scope, send, None)
+        elif scheduled_match and method in ('GET', 'DELETE'):
+            endpoint = 'scheduled_post' if method == 'GET' else 'cancel_scheduled_post'
+            status = await _scheduled(scope, send, scheduled_match.group(1))
+        elif path == '/metrics' and method == 'GET' and config.METRICS_ENABLED:
+            endpoint = 'metrics_endpoint'
+            status = 200
+            await _send_body(send, 200, metrics.render().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            endpoint = None
+            status = await _send_json(send, 404, {"status": "error", "message": f"Not found: {method} {path}"})
+
+        metrics.record_request(endpoint, status)
+
+    return app
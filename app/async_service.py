@@ -0,0 +1,476 @@
+# Asynchronous variant of TwitterService for the ASGI engine
+import asyncio
+import json
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import httpx
+from oauthlib import oauth1
+
+from app import config, metrics
+from app.deadline import deadline_error, phase, phase_budget, run_blocking
+from app.media import (FILE_EXTENSIONS, MEDIA_CATEGORIES, check_media_combination,
+                       describe_media)
+from app.media_cache import content_digest
+from app.rate_limit import RateLimitedError
+from app.twitter_service import TwitterService
+
+API_URL = 'https://api.twitter.com'
+UPLOAD_URL = 'https://upload.twitter.com'
+
+
+class TwitterHTTPError(Exception):
+    """
+    Error response of the Twitter API, formatted like the tweepy exceptions
+
+    Attributes:
+        status_code (int): HTTP status code
+        headers (httpx.Headers): Response headers, including x-rate-limit-*
+    """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        message = f"{response.status_code} {response.reason_phrase}"
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict):
+            details = [error.get('message') or error.get('detail') for error in payload.get('errors', [])]
+            details = [detail for detail in details if detail] or [payload.get('detail')]
+            message += ''.join(f"\n{detail}" for detail in details if detail)
+        super().__init__(message)
+
+
+class AsyncClientPool:
+    """
+    httpx.AsyncClient instances shared by all accounts, one per proxy
+
+    OAuth 1.0a is applied per request, so unlike the synchronous pool the
+    clients do not depend on credentials: every account posting through the
+    same proxy (or directly) shares one connection pool.
+    """
+
+    def __init__(self, max_size=None, transport=None):
+        """
+        Args:
+            max_size (int, optional): Maximum number of clients, defaults to CLIENT_POOL_SIZE
+            transport (httpx.AsyncBaseTransport, optional): Transport used instead of the network, for tests
+        """
+        self.max_size = config.CLIENT_POOL_SIZE if max_size is None else max_size
+        self.transport = transport
+        self._clients = OrderedDict()
+
+    def get(self, proxy_url):
+        """
+        Return the client for a proxy URL (None for direct connections)
+        """
+        client = self._clients.get(proxy_url)
+        if client is not None:
+            self._clients.move_to_end(proxy_url)
+            return client
+
+        client = httpx.AsyncClient(
+            # A test transport replaces the network, proxy mounts would bypass it
+            proxies=proxy_url if self.transport is None else None,
+            transport=self.transport,
+            timeout=httpx.Timeout(config.ASYNC_READ_TIMEOUT, connect=config.ASYNC_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=config.ASYNC_MAX_CONNECTIONS),
+            # Do not let HTTP(S)_PROXY from the environment override the account proxy
+            trust_env=proxy_url is None
+        )
+        self._clients[proxy_url] = client
+        while len(self._clients) > self.max_size:
+            _, oldest = self._clients.popitem(last=False)
+            asyncio.ensure_future(oldest.aclose())
+        return client
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+class AsyncTwitterService(TwitterService):
+    """
+    TwitterService whose network calls are coroutines
+
+    Calls are signed with oauthlib and sent with httpx, so one event loop
+    serves many concurrent posts without a thread each. Proxy parsing, image
+    decoding, media validation, the media cache and the rate limiter are the
+    ones of the synchronous service.
+    """
+
+    def __init__(self, api_key, api_secret, access_token, access_secret, proxy=None, clients=None,
+                 proxy_health=None, media_cache=None, rate_limiter=None):
+        """
+        Args:
+            api_key (str): Twitter API key
+            api_secret (str): Twitter API secret
+            access_token (str): Twitter access token
+            access_secret (str): Twitter access token secret
+            proxy (dict, optional): Proxy configuration, same format as TwitterService
+            clients (AsyncClientPool, optional): Pool of HTTP clients, defaults to the shared pool
+            proxy_health (ProxyHealthRegistry, optional): Cached proxy checks, defaults to the shared registry
+            media_cache (MediaCache, optional): Cache of uploaded media_ids, defaults to the shared cache
+            rate_limiter (RateLimiter, optional): Posting scheduler, defaults to the shared limiter
+        """
+        # The synchronous constructor would build tweepy clients, only reuse its fields
+        self._init_fields(api_key, api_secret, access_token, access_secret, proxy,
+                          proxy_health, media_cache, rate_limiter)
+        self.clients = clients if clients is not None else get_async_client_pool()
+        self.oauth = oauth1.Client(
+            api_key, client_secret=api_secret,
+            resource_owner_key=access_token, resource_owner_secret=access_secret
+        )
+
+    def _http_proxy(self):
+        """
+        Proxy URL for httpx, or None for direct connections
+        """
+        if not self.proxy:
+            return None
+        proxy_url = self._session_proxies(self.proxy)['https']
+        # httpx resolves hostnames on the SOCKS proxy already and only knows the socks5 scheme
+        if proxy_url.startswith('socks5h://'):
+            proxy_url = 'socks5://' + proxy_url[len('socks5h://'):]
+        return proxy_url
+
+    def _sign(self, method, url, form=None):
+        """
+        OAuth 1.0a Authorization header; form bodies are part of the signature
+        """
+        if form is not None:
+            _, headers, _ = self.oauth.sign(
+                url, method, body=urlencode(form),
+                headers={'Content-Type': 'application/x-www-form-urlencoded'}
+            )
+        else:
+            _, headers, _ = self.oauth.sign(url, method)
+        return {'Authorization': headers['Authorization']}
+
+    async def _request(self, method, url, form=None, **kwargs):
+        """
+        Signed request; form fields are signed, multipart fields passed as data= are not
+        """
+        client = self.clients.get(self._http_proxy())
+        headers = self._sign(method, url, form)
+        if form is not None:
+            kwargs['data'] = form
+        response = await client.request(method, url, headers=headers, **kwargs)
+        if response.status_code >= 400:
+            raise TwitterHTTPError(response)
+        return response
+
+    async def _test_proxy_connection_async(self, proxy_settings):
+        """
+        Asynchronous version of _test_proxy_connection, same results and messages
+        """
+        if not proxy_settings:
+            return True, None
+        try:
+            proxy_url = self._session_proxies(proxy_settings)['https']
+        except Exception as e:
+            return False, f"Failed to parse proxy URL: {str(e)}"
+        protocol = 'socks5' if 'socks5' in proxy_settings else 'http'
+        if proxy_url.startswith('socks5h://'):
+            proxy_url = 'socks5://' + proxy_url[len('socks5h://'):]
+
+        try:
+            transport = self.clients.transport
+            async with httpx.AsyncClient(proxies=proxy_url if transport is None else None, transport=transport,
+                                         timeout=5, trust_env=False) as client:
+                # Only the connection matters, not the status of the response
+                await client.get(f"{API_URL}/2/users/me")
+            return True, None
+        except httpx.ProxyError:
+            return False, f"Socket error: {protocol.upper()} connection failed"
+        except httpx.TimeoutException:
+            return False, f"Socket error: {protocol.upper()} connection timeout"
+        except httpx.HTTPError as e:
+            error_msg = str(e)
+            if "connect" in error_msg.lower():
+                return False, f"Socket error: Could not connect to {protocol.upper()} proxy"
+            return False, f"Socket error: {protocol.upper()} proxy error - {error_msg}"
+
+    async def _create_tweet(self, text, media_ids=None):
+        payload = {"text": text}
+        if media_ids:
+            payload["media"] = {"media_ids": [str(media_id) for media_id in media_ids]}
+        self.rate_limit_reserved = False
+        response = await self._post_json(f"{API_URL}/2/tweets", payload)
+        return response.json()
+
+    async def _post_json(self, url, payload):
+        """
+        Signed JSON POST to the v2 API, feeding the rate limiter like the session hook does
+        """
+        client = self.clients.get(self._http_proxy())
+        headers = self._sign('POST', url)
+        headers['Content-Type'] = 'application/json'
+        response = await client.post(url, headers=headers, content=json.dumps(payload))
+        if self.rate_limiter is not None:
+            self.rate_limiter.update_from_headers(self.account_key, response.headers)
+            if response.status_code < 400:
+                self.rate_limiter.record_success(self.account_key)
+        if response.status_code >= 400:
+            raise TwitterHTTPError(response)
+        return response
+
+    async def _upload_one(self, media_file, mime_type, kind, size, index=0):
+        """
+        Asynchronous counterpart of app.media.upload_one()
+
+        Returns:
+            tuple: (media_id, expires_after_secs reported by the platform or None)
+        """
+        url = f"{UPLOAD_URL}/1.1/media/upload.json"
+        filename = f"media{index}{FILE_EXTENSIONS.get(mime_type, '')}"
+        if kind == 'image' and size <= config.MEDIA_CHUNKED_THRESHOLD:
+            content = await run_blocking(media_file.read)
+            response = await self._request('POST', url, files={'media': (filename, content, mime_type)})
+            media = response.json()
+            return media['media_id'], media.get('expires_after_secs')
+
+        init = await self._request('POST', url, form={
+            'command': 'INIT', 'total_bytes': str(size),
+            'media_type': mime_type, 'media_category': MEDIA_CATEGORIES[kind]
+        })
+        media_id = init.json()['media_id']
+
+        # Same chunk sizing as tweepy: at most 1000 segments of at most 5 MiB
+        chunk_size = max(min(config.MEDIA_CHUNK_SIZE, 5 * 1024 * 1024), -(-size // 1000))
+        segment_index = 0
+        while True:
+            chunk = await run_blocking(media_file.read, chunk_size)
+            if not chunk:
+                break
+            await self._request('POST', url, data={
+                'command': 'APPEND', 'media_id': str(media_id), 'segment_index': str(segment_index)
+            }, files={'media': (filename, chunk, 'application/octet-stream')})
+            segment_index += 1
+
+        media = (await self._request('POST', url, form={'command': 'FINALIZE', 'media_id': str(media_id)})).json()
+        while media.get('processing_info', {}).get('state') in ('pending', 'in_progress'):
+            await asyncio.sleep(media['processing_info'].get('check_after_secs', 1))
+            status_url = f"{url}?{urlencode({'command': 'STATUS', 'media_id': media_id})}"
+            media = (await self._request('GET', status_url)).json()
+        if media.get('processing_info', {}).get('state') == 'failed':
+            error = media['processing_info'].get('error', {})
+            raise Exception(f"Media processing failed: {error.get('message', 'unknown error')}")
+        return media_id, media.get('expires_after_secs')
+
+    async def _upload_media(self, media_files, reused=None):
+        """
+        Asynchronous counterpart of app.media.upload_media(), uploads run concurrently
+
+        Inspecting, hashing and reading the files runs in the executor, off the event loop.
+        """
+        described = [await run_blocking(describe_media, media_file) for media_file in media_files]
+        check_media_combination([kind for _, kind, _ in described])
+
+        media_ids = [None] * len(media_files)
+        digests = [None] * len(media_files)
+        if self.media_cache is not None:
+            for index, media_file in enumerate(media_files):
+                digests[index] = await run_blocking(content_digest, media_file)
+                media_ids[index] = self.media_cache.get(self.account_key, digests[index])
+                if media_ids[index] is not None and reused is not None:
+                    reused.append(index)
+
+        pending = [index for index, media_id in enumerate(media_ids) if media_id is None]
+        # Wait for every upload before raising so no upload outlives the request
+        results = await asyncio.gather(
+            *(self._upload_one(media_files[index], *described[index], index) for index in pending),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        for index, (media_id, expires_after) in zip(pending, results):
+            media_ids[index] = media_id
+            if self.media_cache is not None:
+                self.media_cache.put(self.account_key, digests[index], media_id, expires_after)
+        return media_ids
+
+    async def _wait_for_rate_limit_async(self):
+        phase('rate_limit_wait', config.REQUEST_DEADLINE_RESERVE)
+        if self.rate_limiter is None:
+            return 0.0
+        reserved, wait = self.rate_limiter.reserve(self.account_key, self.app_key,
+                                                   phase_budget(config.RATE_LIMIT_MAX_WAIT))
+        if not reserved:
+            raise RateLimitedError(f"Rate limit reached for this account, retry in {wait:.0f} seconds", wait)
+        self.rate_limit_reserved = True
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    async def post_tweet(self, text, image_data=None):
+        """
+        Post a tweet with optional image(s), GIF or video
+
+        Args:
+            text (str): Tweet text content
+            image_data (str|bytes|file|list, optional): Same as TwitterService.post_tweet()
+
+        Returns:
+            dict: Same structure as TwitterService.post_tweet()
+        """
+        request_details = self._request_details(text, image_data)
+        response_details = {}
+
+        if self.proxy:
+            phase('proxy_check', config.REQUEST_DEADLINE_RESERVE)
+            with metrics.timed('proxy_check'):
+                proxy_working, proxy_error = await self.proxy_health.check_async(
+                    self.proxy, self._test_proxy_connection_async
+                )
+            if not proxy_working:
+                error_message = f"Proxy connection test failed: {proxy_error}"
+                response_details["status"] = "error"
+                response_details["error"] = error_message
+                metrics.record_post('error', 'InitError', self.proxy)
+                return {
+                    "status": "error",
+                    "error": error_message,
+                    "proxy_unreachable": True,
+                    "request": request_details,
+                    "response": response_details
+                }
+
+        try:
+            with metrics.timed('rate_limit_wait'):
+                rate_limit_wait = await self._wait_for_rate_limit_async()
+            if rate_limit_wait:
+                response_details["rate_limit_wait"] = round(rate_limit_wait, 3)
+
+            media_ids = None
+            if image_data:
+                images = image_data if isinstance(image_data, list) else [image_data]
+                reused = []
+                try:
+                    with metrics.timed('media_decode'):
+                        media_files = [await run_blocking(self._open_image, image) for image in images]
+                    phase('media_upload', config.REQUEST_DEADLINE_RESERVE)
+                    with metrics.timed('media_upload'):
+                        media_ids = await self._upload_media(media_files, reused)
+                    response_details["media_id"] = media_ids[0]
+                    response_details["media_ids"] = media_ids
+                    response_details["media_reused"] = len(reused)
+                except Exception as e:
+                    raise Exception(f"Failed to upload image: {str(e)}") from e
+
+            try:
+                phase('create_tweet')
+                with metrics.timed('create_tweet'):
+                    response = await self._create_tweet(text, media_ids)
+            except TwitterHTTPError as e:
+                # A cached media_id may have expired early: upload the reused media again and retry once
+                if e.status_code != 400 or not media_ids or not reused:
+                    raise
+                self.media_cache.invalidate(self.account_key, [media_ids[index] for index in reused])
+                try:
+                    phase('media_upload', config.REQUEST_DEADLINE_RESERVE)
+                    with metrics.timed('media_upload'):
+                        fresh_ids = await self._upload_media([media_files[index] for index in reused])
+                except Exception as upload_error:
+                    raise Exception(f"Failed to upload image: {str(upload_error)}") from upload_error
+                for index, media_id in zip(reused, fresh_ids):
+                    media_ids[index] = media_id
+                response_details["media_id"] = media_ids[0]
+                response_details["media_ids"] = media_ids
+                response_details["media_reused"] = 0
+                phase('create_tweet')
+                with metrics.timed('create_tweet'):
+                    response = await self._create_tweet(text, media_ids)
+
+            if not response or 'id' not in response.get('data', {}):
+                raise Exception("Invalid response from Twitter API")
+
+            tweet_id = response['data']['id']
+            if media_ids is None:
+                response_details["tweet_type"] = "text_only"
+            else:
+                response_details["tweet_type"] = "with_image" if len(media_ids) == 1 else "with_images"
+
+            tweet_url = f"https://twitter.com/user/status/{tweet_id}"
+            response_details["status"] = "success"
+            response_details["tweet_id"] = tweet_id
+            response_details["tweet_url"] = tweet_url
+
+            self.proxy_health.report_success(self.proxy)
+            metrics.record_post('success', proxy_settings=self.proxy)
+
+            return {
+                "status": "success",
+                "tweet_id": tweet_id,
+                "tweet_url": tweet_url,
+                "request": request_details,
+                "response": response_details
+            }
+
+        except RateLimitedError as e:
+            return self._rate_limited_result(e, request_details, response_details)
+
+        except TwitterHTTPError as e:
+            if e.status_code != 429:
+                return await self._error_result(e, request_details, response_details)
+            retry_after = self.rate_limiter.record_rate_limited(self.account_key, e.headers) \
+                if self.rate_limiter is not None else 0
+            return self._rate_limited_result(
+                RateLimitedError(f"Rate limited by Twitter: {e}", retry_after), request_details, response_details
+            )
+
+        except Exception as e:
+            return await self._error_result(e, request_details, response_details)
+
+        finally:
+            self._refund_rate_limit()
+
+    async def _error_result(self, e, request_details, response_details):
+        exceeded = deadline_error(e)
+        if exceeded is not None:
+            return self._deadline_result(exceeded, request_details, response_details)
+        error_message = str(e)
+        response_details["status"] = "error"
+        response_details["error"] = error_message
+
+        # Same proxy diagnosis as the synchronous service
+        if self.proxy and ("proxy" in error_message.lower() or "socket" in error_message.lower() or "connect" in error_message.lower()):
+            self.proxy_health.report_error(self.proxy)
+            proxy_working, proxy_error = await self.proxy_health.check_async(
+                self.proxy, self._test_proxy_connection_async
+            )
+            if not proxy_working:
+                error_message = f"Proxy connection test failed: {proxy_error}"
+                response_details["error"] = error_message
+
+        metrics.record_post('error', type(e.__cause__ or e).__name__, self.proxy)
+
+        return {
+            "status": "error",
+            "error": error_message,
+            "request": request_details,
+            "response": response_details
+        }
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_async_client_pool():
+    """
+    Return the process-wide pool of httpx clients used by the asynchronous engine
+    """
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = AsyncClientPool()
+    return _default_pool
@@ -0,0 +1,176 @@
+# Fan-out of many posts from one POST /post/batch request
+import contextvars
+import hashlib
+from collections import OrderedDict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from app import config
+from app.posting import validate_post_data, execute_post
+
+# /post fields that schedule or queue a post; batch items are always posted right away
+DEFERRED_FIELDS = ['publish_at', 'async', 'callback_url']
+
+
+class BatchError(Exception):
+    """
+    Raised when the batch request itself is malformed
+    """
+
+
+def resolve_batch(data):
+    """
+    Expand a batch request into individual /post request bodies
+
+    Posts may reference entries of the "accounts" and "proxies" maps by name
+    instead of repeating credentials and proxy settings. An account may itself
+    reference a proxy by name. Inline values in a post override the account.
+    Items that ask to be scheduled or queued (DEFERRED_FIELDS) are rejected,
+    as the batch posts every item before it answers.
+
+    Args:
+        data (dict): Batch request body with "posts" and optional "accounts" and "proxies"
+
+    Returns:
+        list: One (post data, validation error or None) tuple per post, in request order
+
+    Raises:
+        BatchError: If the batch structure is invalid
+    """
+    if not isinstance(data, dict):
+        raise BatchError("Request body must be a JSON object")
+
+    posts = data.get('posts')
+    if not isinstance(posts, list) or not posts:
+        raise BatchError("Field 'posts' must be a non-empty list")
+    if len(posts) > config.BATCH_MAX_ITEMS:
+        raise BatchError(f"Too many posts in batch: {len(posts)} (maximum {config.BATCH_MAX_ITEMS})")
+
+    accounts = data.get('accounts') or {}
+    proxies = data.get('proxies') or {}
+    if not isinstance(accounts, dict) or not isinstance(proxies, dict):
+        raise BatchError("Fields 'accounts' and 'proxies' must be objects")
+
+    resolved = []
+    for index, post in enumerate(posts):
+        if not isinstance(post, dict):
+            resolved.append(({}, {"status": "error", "message": f"Post {index} must be an object"}))
+            continue
+
+        post_data = {}
+        account_name = post.get('account')
+        if account_name is not None:
+            account = accounts.get(account_name)
+            if not isinstance(account, dict):
+                resolved.append(({}, {"status": "error", "message": f"Unknown account: {account_name}"}))
+                continue
+            post_data.update(account)
+        post_data.update({key: value for key, value in post.items() if key != 'account'})
+        deferred = [field for field in DEFERRED_FIELDS if field in post_data]
+        if deferred:
+            message = f"Fields not supported in a batch: {', '.join(deferred)}"
+            resolved.append(({}, {"status": "error", "message": message}))
+            continue
+
+        # Proxies can be given inline or by name
+        proxy = post_data.get('proxy')
+        if isinstance(proxy, str):
+            if proxy not in proxies:
+                resolved.append(({}, {"status": "error", "message": f"Unknown proxy: {proxy}"}))
+                continue
+            post_data['proxy'] = proxies[proxy]
+
+        resolved.append((post_data, validate_post_data(post_data)))
+
+    return resolved
+
+
+def batch_limits(data):
+    """
+    Read the optional concurrency limits of a batch request
+
+    Callers may lower the configured limits, never raise them.
+
+    Returns:
+        tuple: (concurrency, account_concurrency)
+
+    Raises:
+        BatchError: If a limit is not a positive integer
+    """
+    limits = []
+    for field, maximum in (('concurrency', config.BATCH_CONCURRENCY),
+                           ('account_concurrency', config.BATCH_ACCOUNT_CONCURRENCY)):
+        value = data.get(field)
+        if value is None:
+            limits.append(maximum)
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise BatchError(f"Field '{field}' must be a positive integer")
+        limits.append(min(value, maximum))
+    return tuple(limits)
+
+
+def account_key(post_data):
+    """
+    Identify the account a post is published from, without keeping its secrets
+    """
+    material = '\0'.join(str(post_data.get(field, '')) for field in ('api_key', 'access_token'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def run_batch(posts, concurrency=None, account_concurrency=None, post_function=execute_post):
+    """
+    Publish posts concurrently and yield results as they finish
+
+    At most concurrency posts run at once, and at most account_concurrency
+    of them for the same account. Accounts are served round-robin so a large
+    account does not starve the others. A failing post never stops the batch.
+
+    Args:
+        posts (list): (index, post data) tuples of validated posts
+        concurrency (int, optional): Global limit of parallel posts
+        account_concurrency (int, optional): Limit of parallel posts per account
+        post_function (callable, optional): Function publishing one post, returns (body, status_code)
+
+    Yields:
+        tuple: (index, response body dict, HTTP status code)
+    """
+    concurrency = max(1, concurrency or config.BATCH_CONCURRENCY)
+    account_concurrency = max(1, account_concurrency or config.BATCH_ACCOUNT_CONCURRENCY)
+
+    queues = OrderedDict()
+    for index, post_data in posts:
+        queues.setdefault(account_key(post_data), deque()).append((index, post_data))
+
+    running = {}
+    active = Counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='post-batch') as executor:
+        def fill():
+            progress = True
+            while progress and len(running) < concurrency:
+                progress = False
+                for account, queue in list(queues.items()):
+                    if len(running) >= concurrency:
+                        break
+                    if active[account] < account_concurrency:
+                        index, post_data = queue.popleft()
+                        # Posts log under the request ID of the batch
+                        future = executor.submit(contextvars.copy_context().run, post_function, post_data)
+                        running[future] = (index, account)
+                        active[account] += 1
+                        progress = True
+                    if not queue:
+                        del queues[account]
+
+        fill()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, account = running.pop(future)
+                active[account] -= 1
+                try:
+                    body, status_code = future.result()
+                except Exception as e:
+                    body, status_code = {"status": "error", "message": str(e)}, 500
+                yield index, body, status_code
+            fill()
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from app import config
+from app.deadline import http_timeout
+
+
+class KeepAliveSession(requests.Session):
+    """
+    requests.Session that keeps its connection pool open between calls
+
+    tweepy.API closes its session after every request, which throws away the
+    TLS connection. Pooled clients only release connections on shutdown().
+    Every request gets connect and read timeouts: tweepy.Client sets none,
+    and under a request deadline they are cut to what is left of it.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        # tweepy passes everything but method and url by keyword
+        kwargs['timeout'] = http_timeout()
+        return super().request(method, url, *args, **kwargs)
+
+    def close(self):
+        # Ignore per-request close() calls coming from tweepy.API.request
+        pass
+
+    def shutdown(self):
+        """
+        Really close the pooled connections
+        """
+        super().close()
+
+
+class ClientPool:
+    """
+    Bounded LRU cache of ready-to-use tweepy clients
+
+    Entries are keyed on a hash of the credentials and proxy configuration,
+    so the raw secrets are never used as dictionary keys. Entries that were
+    not used for idle_ttl seconds are evicted and their sessions closed.
+    get() checks a client out until release(); a client evicted while
+    checked out is closed by its last release, so no request loses its
+    connections in the middle of a call.
+    """
+
+    def __init__(self, max_size=None, idle_ttl=None):
+        """
+        Args:
+            max_size (int, optional): Maximum number of cached clients
+            idle_ttl (float, optional): Seconds an unused client is kept
+        """
+        self.max_size = config.CLIENT_POOL_SIZE if max_size is None else max_size
+        self.idle_ttl = config.CLIENT_POOL_IDLE_TTL if idle_ttl is None else idle_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # id(client) -> requests holding it, and evicted clients waiting for their last release
+        self._checkouts = {}
+        self._retired = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(api_key, api_secret, access_token, access_secret, proxy=None):
+        """
+        Build the cache key for a set of credentials and proxy settings
+
+        Returns:
+            str: SHA-256 hex digest of credentials and proxy configuration
+        """
+        material = json.dumps(
+            [api_key, api_secret, access_token, access_secret, proxy],
+            sort_keys=True
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key, factory):
+        """
+        Check out the cached client for key, creating it with factory on a miss
+
+        Every get() must be followed by a release() of the client.
+
+        Args:
+            key (str): Cache key from make_key()
+            factory (callable): Called without arguments to build a new client
+
+        Returns:
+            tweepy.Client: Cached or newly created client
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._check_out(entry[0])
+            self.misses += 1
+
+        # Build outside the lock so a slow construction does not block other accounts
+        client = factory()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Another thread created the same client meanwhile, keep the first one
+                self._close_client(client)
+                entry[1] = now
+                self._entries.move_to_end(key)
+                return self._check_out(entry[0])
+            self._entries[key] = [client, now]
+            while len(self._entries) > self.max_size:
+                _, (old_client, _) = self._entries.popitem(last=False)
+                self._retire(old_client)
+                self.evictions += 1
+            return self._check_out(client)
+
+    def release(self, client):
+        """
+        Give back a client checked out with get(), closing it if it was evicted meanwhile
+        """
+        with self._lock:
+            users = self._checkouts.get(id(client), 0) - 1
+            if users > 0:
+                self._checkouts[id(client)] = users
+                return
+            self._checkouts.pop(id(client), None)
+            retired = self._retired.pop(id(client), None)
+        if retired is not None:
+            self._close_client(retired)
+
+    def discard(self, key):
+        """
+        Drop a cached client, e.g. after it failed in a way that may have broken it
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._retire(entry[0])
+
+    def clear(self):
+        """
+        Drop all cached clients and close their connections once they are released
+        """
+        with self._lock:
+            for client, _ in self._entries.values():
+                self._retire(client)
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return cache counters
+
+        Returns:
+            dict: size, max_size, idle_ttl, hits, misses, evictions and hit_ratio
+        """
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "idle_ttl": self.idle_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+    def _evict_idle(self, now):
+        # Entries are kept in last-used order, so expired ones are at the front
+        while self._entries:
+            key, (client, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._entries[key]
+            self._retire(client)
+            self.evictions += 1
+
+    def _check_out(self, client):
+        self._checkouts[id(client)] = self._checkouts.get(id(client), 0) + 1
+        return client
+
+    def _retire(self, client):
+        # Called with the lock held; a client still in use is closed by its last release()
+        if self._checkouts.get(id(client)):
+            self._retired[id(client)] = client
+        else:
+            self._close_client(client)
+
+    @staticmethod
+    def _close_client(client):
+        session = getattr(client, 'session', None)
+        if isinstance(session, KeepAliveSession):
+            session.shutdown()
+        elif session is not None:
+            session.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_client_pool():
+    """
+    Return the process-wide client pool, creating it on first use
+    """
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = ClientPool()
+    return _default_pool
@@ -0,0 +1,291 @@
+# Runtime settings for the Twitter Poster service
+# Every value can be overridden with an environment variable of the same name
+import os
+
+
+def env_int(name, default):
+    """
+    Read an integer setting from the environment
+
+    Args:
+        name (str): Environment variable name
+        default (int): Value used when the variable is unset or empty
+
+    Returns:
+        int: Parsed value
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+def env_float(name, default):
+    """
+    Read a float setting from the environment
+
+    Args:
+        name (str): Environment variable name
+        default (float): Value used when the variable is unset or empty
+
+    Returns:
+        float: Parsed value
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return float(value)
+
+
+def env_str(name, default):
+    """
+    Read a string setting from the environment
+
+    Args:
+        name (str): Environment variable name
+        default (str): Value used when the variable is unset or empty
+
+    Returns:
+        str: Stripped value
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip()
+
+
+def env_bool(name, default):
+    """
+    Read a boolean setting from the environment ("1", "true", "yes", "on" are true)
+
+    Args:
+        name (str): Environment variable name
+        default (bool): Value used when the variable is unset or empty
+
+    Returns:
+        bool: Parsed value
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Pool of ready-to-use tweepy clients keyed on credentials and proxy
+CLIENT_POOL_SIZE = env_int('CLIENT_POOL_SIZE', 256)
+CLIENT_POOL_IDLE_TTL = env_float('CLIENT_POOL_IDLE_TTL', 900.0)
+
+# Cached proxy health checks
+PROXY_HEALTH_TTL = env_float('PROXY_HEALTH_TTL', 60.0)
+PROXY_HEALTH_FAILURE_TTL = env_float('PROXY_HEALTH_FAILURE_TTL', 15.0)
+# Seconds between background re-probes of proxies in use, 0 disables the prober
+PROXY_PROBE_INTERVAL = env_float('PROXY_PROBE_INTERVAL', 0.0)
+# Proxies unused for this long are no longer probed and are forgotten
+PROXY_PROBE_IDLE = env_float('PROXY_PROBE_IDLE', 600.0)
+PROXY_PROBE_WORKERS = env_int('PROXY_PROBE_WORKERS', 4)
+
+# Named proxy pools: JSON {"pools": {name: [proxy, ...]}, "accounts": {user_id: name}, "default": name},
+# read from PROXY_POOLS_FILE if set, otherwise from PROXY_POOLS
+PROXY_POOLS = env_str('PROXY_POOLS', '')
+PROXY_POOLS_FILE = env_str('PROXY_POOLS_FILE', '')
+# Consecutive failures that take a pooled proxy out of rotation, and its first cooldown (doubled while it keeps failing)
+PROXY_BREAKER_FAILURES = env_int('PROXY_BREAKER_FAILURES', 3)
+PROXY_BREAKER_COOLDOWN = env_float('PROXY_BREAKER_COOLDOWN', 30.0)
+PROXY_BREAKER_COOLDOWN_MAX = env_float('PROXY_BREAKER_COOLDOWN_MAX', 600.0)
+# Proxies of a pool tried by one post before it fails
+PROXY_FAILOVER_ATTEMPTS = env_int('PROXY_FAILOVER_ATTEMPTS', 3)
+
+# Asynchronous /post jobs
+JOB_EXECUTOR = env_str('JOB_EXECUTOR', 'thread')  # "thread" or "process"
+JOB_WORKERS = env_int('JOB_WORKERS', 8)
+# Jobs waiting for a free worker before /post answers 429
+JOB_QUEUE_SIZE = env_int('JOB_QUEUE_SIZE', 100)
+JOB_RESULT_TTL = env_float('JOB_RESULT_TTL', 3600.0)
+JOB_WEBHOOK_TIMEOUT = env_float('JOB_WEBHOOK_TIMEOUT', 10.0)
+
+# POST /post/batch
+BATCH_MAX_ITEMS = env_int('BATCH_MAX_ITEMS', 500)
+# Posts of one batch running in parallel, and per account within the batch
+BATCH_CONCURRENCY = env_int('BATCH_CONCURRENCY', 16)
+BATCH_ACCOUNT_CONCURRENCY = env_int('BATCH_ACCOUNT_CONCURRENCY', 2)
+
+# Request size limits and multipart upload spooling
+MAX_CONTENT_LENGTH = env_int('MAX_CONTENT_LENGTH', 16 * 1024 * 1024)
+# Non-file multipart fields are kept in memory up to this size
+MAX_FORM_MEMORY_SIZE = env_int('MAX_FORM_MEMORY_SIZE', 64 * 1024)
+# Uploaded files larger than this are spooled to a temporary file on disk
+UPLOAD_SPOOL_SIZE = env_int('UPLOAD_SPOOL_SIZE', 64 * 1024)
+
+# Media uploads
+MEDIA_UPLOAD_WORKERS = env_int('MEDIA_UPLOAD_WORKERS', 8)
+# Images above this size, GIFs and videos use the chunked INIT/APPEND/FINALIZE upload
+MEDIA_CHUNKED_THRESHOLD = env_int('MEDIA_CHUNKED_THRESHOLD', 1024 * 1024)
+MEDIA_CHUNK_SIZE = env_int('MEDIA_CHUNK_SIZE', 1024 * 1024)
+
+# Reuse of uploaded media_ids for identical content from the same account
+MEDIA_CACHE_ENABLED = env_bool('MEDIA_CACHE_ENABLED', True)
+MEDIA_CACHE_SIZE = env_int('MEDIA_CACHE_SIZE', 10000)
+# Upper bound on reuse; uploaded media expire on the platform side (24 hours)
+MEDIA_CACHE_TTL = env_float('MEDIA_CACHE_TTL', 23 * 3600.0)
+
+# Client-side rate limiting of create_tweet
+RATE_LIMIT_ENABLED = env_bool('RATE_LIMIT_ENABLED', True)
+# Token bucket per account: RATE_LIMIT_ACCOUNT_POSTS posts per RATE_LIMIT_ACCOUNT_WINDOW seconds
+RATE_LIMIT_ACCOUNT_POSTS = env_int('RATE_LIMIT_ACCOUNT_POSTS', 200)
+RATE_LIMIT_ACCOUNT_WINDOW = env_float('RATE_LIMIT_ACCOUNT_WINDOW', 900.0)
+# Token bucket per app (API key), 0 disables it
+RATE_LIMIT_APP_POSTS = env_int('RATE_LIMIT_APP_POSTS', 0)
+RATE_LIMIT_APP_WINDOW = env_float('RATE_LIMIT_APP_WINDOW', 86400.0)
+# Longest a request waits for a token; longer waits are answered with 429 and the expected send time
+RATE_LIMIT_MAX_WAIT = env_float('RATE_LIMIT_MAX_WAIT', 5.0)
+# Backoff after a 429 without reset header: base * 2^(n-1), jittered, capped
+RATE_LIMIT_BACKOFF_BASE = env_float('RATE_LIMIT_BACKOFF_BASE', 30.0)
+RATE_LIMIT_BACKOFF_MAX = env_float('RATE_LIMIT_BACKOFF_MAX', 900.0)
+
+# Deadline of a post in seconds; the X-Request-Deadline header may ask for another one,
+# up to REQUEST_DEADLINE_MAX, which stays below GUNICORN_TIMEOUT
+REQUEST_DEADLINE = env_float('REQUEST_DEADLINE', 30.0)
+REQUEST_DEADLINE_MAX = env_float('REQUEST_DEADLINE_MAX', 90.0)
+# Deadline of a /thread request, which creates up to THREAD_MAX_TWEETS tweets
+THREAD_DEADLINE = env_float('THREAD_DEADLINE', 90.0)
+# Seconds the phases before create_tweet leave for it, at most half of the deadline
+REQUEST_DEADLINE_RESERVE = env_float('REQUEST_DEADLINE_RESERVE', 5.0)
+# Connect and read timeouts of every Twitter API call, shortened to what is left of the deadline
+HTTP_CONNECT_TIMEOUT = env_float('HTTP_CONNECT_TIMEOUT', 5.0)
+HTTP_READ_TIMEOUT = env_float('HTTP_READ_TIMEOUT', 30.0)
+
+# Admission control of /post, /post/batch and /thread, per worker process
+# Posts running at once before new ones are answered 503; 0 uses three quarters of GUNICORN_THREADS
+# (of GUNICORN_WORKER_CONNECTIONS with the gevent worker class)
+ADMISSION_MAX_IN_FLIGHT = env_int('ADMISSION_MAX_IN_FLIGHT', 0)
+# Retry-After of the requests turned away, in seconds
+ADMISSION_RETRY_AFTER = env_int('ADMISSION_RETRY_AFTER', 1)
+
+# Readiness (/ready), computed in the background every READY_REFRESH_INTERVAL seconds
+READY_REFRESH_INTERVAL = env_float('READY_REFRESH_INTERVAL', 2.0)
+# Not ready when more than READY_MAX_ERROR_RATE of the /post and /thread responses of the last
+# READY_ERROR_WINDOW seconds were 5xx, counted once there are READY_MIN_REQUESTS of them
+READY_ERROR_WINDOW = env_float('READY_ERROR_WINDOW', 60.0)
+READY_MAX_ERROR_RATE = env_float('READY_MAX_ERROR_RATE', 0.5)
+READY_MIN_REQUESTS = env_int('READY_MIN_REQUESTS', 20)
+# Not ready when the job queue (or outbox) is filled above this share of its limit
+READY_MAX_QUEUE_RATIO = env_float('READY_MAX_QUEUE_RATIO', 0.9)
+
+# Echo the request and the Twitter responses in /post responses, unless a request asks for
+# verbose=false or Prefer: return=minimal (and the other way round when off)
+RESPONSE_VERBOSE = env_bool('RESPONSE_VERBOSE', True)
+
+# Structured logging of the app.* loggers
+LOG_LEVEL = env_str('LOG_LEVEL', 'INFO')
+# "json" (one object per line) or "text"
+LOG_FORMAT = env_str('LOG_FORMAT', 'json')
+# Records waiting for the writer thread; records beyond it are dropped rather than blocking a request
+LOG_QUEUE_SIZE = env_int('LOG_QUEUE_SIZE', 10000)
+# Share of successful posts logged, failures are always logged
+LOG_SAMPLE_RATE = env_float('LOG_SAMPLE_RATE', 0.1)
+
+# Prometheus metrics at /metrics; when disabled the instrumentation is a no-op
+METRICS_ENABLED = env_bool('METRICS_ENABLED', True)
+
+# Asynchronous (ASGI) engine
+# Timeouts of Twitter API calls in seconds
+ASYNC_CONNECT_TIMEOUT = env_float('ASYNC_CONNECT_TIMEOUT', 10.0)
+ASYNC_READ_TIMEOUT = env_float('ASYNC_READ_TIMEOUT', 60.0)
+# Open connections per proxy (or direct) client
+ASYNC_MAX_CONNECTIONS = env_int('ASYNC_MAX_CONNECTIONS', 100)
+
+# Directory of the local SQLite stores
+DATA_DIR = env_str('DATA_DIR', 'data')
+
+# Idempotency of /post (Idempotency-Key header)
+IDEMPOTENCY_ENABLED = env_bool('IDEMPOTENCY_ENABLED', True)
+IDEMPOTENCY_DB = env_str('IDEMPOTENCY_DB', os.path.join(DATA_DIR, 'idempotency.sqlite3'))
+# Seconds a finished result is replayed for retries with the same key
+IDEMPOTENCY_TTL = env_int('IDEMPOTENCY_TTL', 86400)
+# Seconds after which an unfinished request (e.g. of a killed worker) may be taken over by a retry
+IDEMPOTENCY_LOCK_TIMEOUT = env_int('IDEMPOTENCY_LOCK_TIMEOUT', 300)
+# Seconds a retry waits for the original request before answering 409
+IDEMPOTENCY_WAIT = env_float('IDEMPOTENCY_WAIT', 30.0)
+# Derive a key from account, text and media when the header is missing
+IDEMPOTENCY_DERIVE_KEYS = env_bool('IDEMPOTENCY_DERIVE_KEYS', False)
+
+# Durable outbox for asynchronous /post jobs, replaces the in-memory job queue when enabled
+OUTBOX_ENABLED = env_bool('OUTBOX_ENABLED', False)
+OUTBOX_DB = env_str('OUTBOX_DB', os.path.join(DATA_DIR, 'outbox.sqlite3'))
+# Posts waiting in the outbox before /post answers 429
+OUTBOX_MAX_PENDING = env_int('OUTBOX_MAX_PENDING', 100000)
+OUTBOX_MAX_ATTEMPTS = env_int('OUTBOX_MAX_ATTEMPTS', 5)
+# Exponential backoff between attempts, with jitter
+OUTBOX_BACKOFF_BASE = env_float('OUTBOX_BACKOFF_BASE', 10.0)
+OUTBOX_BACKOFF_MAX = env_float('OUTBOX_BACKOFF_MAX', 900.0)
+# Seconds a worker owns a running post without renewing its lease; posts of a dead worker are retried after it
+OUTBOX_LEASE = env_float('OUTBOX_LEASE', 60.0)
+# Seconds between checks for posts queued by other workers
+OUTBOX_POLL_INTERVAL = env_float('OUTBOX_POLL_INTERVAL', 1.0)
+
+# Account registry (account_id in /post), enabled by setting ACCOUNTS_KEY
+# Comma separated Fernet keys encrypting the stored credentials; the first encrypts, all decrypt
+ACCOUNTS_KEY = env_str('ACCOUNTS_KEY', '')
+ACCOUNTS_DB = env_str('ACCOUNTS_DB', os.path.join(DATA_DIR, 'accounts.sqlite3'))
+
+# Scheduled posts (publish_at in /post)
+SCHEDULE_ENABLED = env_bool('SCHEDULE_ENABLED', True)
+SCHEDULE_DB = env_str('SCHEDULE_DB', os.path.join(DATA_DIR, 'schedule.sqlite3'))
+SCHEDULE_MAX_PENDING = env_int('SCHEDULE_MAX_PENDING', 1000000)
+# Due posts handed to the job queue per transaction
+SCHEDULE_BATCH_SIZE = env_int('SCHEDULE_BATCH_SIZE', 100)
+# Longest sleep of the dispatcher, bounds how late posts scheduled through another worker are seen if that worker dies
+SCHEDULE_MAX_SLEEP = env_float('SCHEDULE_MAX_SLEEP', 60.0)
+# Seconds dispatched and cancelled posts stay visible
+SCHEDULE_HISTORY_TTL = env_float('SCHEDULE_HISTORY_TTL', 86400.0)
+
+# POST /thread
+THREAD_MAX_TWEETS = env_int('THREAD_MAX_TWEETS', 25)
+# Tweets of each thread already posted, so a resent thread resumes after them
+THREAD_DB = env_str('THREAD_DB', os.path.join(DATA_DIR, 'threads.sqlite3'))
+# Seconds a thread can be resumed
+THREAD_TTL = env_int('THREAD_TTL', 86400)
+# Seconds after which a thread still posting (e.g. in a killed worker) may be resumed by another request
+THREAD_LOCK_TIMEOUT = env_int('THREAD_LOCK_TIMEOUT', 600)
+
+# Local rejection of /post content an account already posted (normalized text and media)
+DEDUP_ENABLED = env_bool('DEDUP_ENABLED', False)
+DEDUP_DB = env_str('DEDUP_DB', os.path.join(DATA_DIR, 'dedup.sqlite3'))
+# Seconds identical content of one account is rejected after it was posted
+DEDUP_WINDOW = env_int('DEDUP_WINDOW', 86400)
+# Exact fingerprints kept per account; older ones are forgotten, or folded into Bloom summaries
+DEDUP_MAX_PER_ACCOUNT = env_int('DEDUP_MAX_PER_ACCOUNT', 1000)
+# Seconds a post still being sent (e.g. in a killed worker) blocks identical content
+DEDUP_PENDING_TIMEOUT = env_int('DEDUP_PENDING_TIMEOUT', 300)
+# Bloom summaries of fingerprints beyond DEDUP_MAX_PER_ACCOUNT, one per account and quarter of the window
+DEDUP_BLOOM_ENABLED = env_bool('DEDUP_BLOOM_ENABLED', False)
+# Fingerprints per summary at DEDUP_BLOOM_ERROR_RATE false positives; sets its size (~180 KB at the defaults)
+DEDUP_BLOOM_CAPACITY = env_int('DEDUP_BLOOM_CAPACITY', 100000)
+DEDUP_BLOOM_ERROR_RATE = env_float('DEDUP_BLOOM_ERROR_RATE', 0.001)
+
+# Pre-flight validation of /post requests
+# Weighted length limit of a tweet (URLs count 23, most non-Latin characters 2)
+TWEET_MAX_LENGTH = env_int('TWEET_MAX_LENGTH', 280)
+# Downscale and re-encode images over the size limit or IMAGE_MAX_DIMENSION (requires Pillow)
+IMAGE_RESIZE_ENABLED = env_bool('IMAGE_RESIZE_ENABLED', True)
+IMAGE_MAX_DIMENSION = env_int('IMAGE_MAX_DIMENSION', 4096)
+
+# Gunicorn runtime (gunicorn.conf.py)
+GUNICORN_BIND = env_str('GUNICORN_BIND', '0.0.0.0:5000')
+# "gthread" (threads), "gevent" (greenlets, requires gevent) or "sync"
+GUNICORN_WORKER_CLASS = env_str('GUNICORN_WORKER_CLASS', 'gthread')
+# Worker processes, 0 for one per CPU core
+GUNICORN_WORKERS = env_int('GUNICORN_WORKERS', 0)
+# Requests in flight per worker: threads of gthread workers, greenlets of gevent workers
+GUNICORN_THREADS = env_int('GUNICORN_THREADS', 32)
+GUNICORN_WORKER_CONNECTIONS = env_int('GUNICORN_WORKER_CONNECTIONS', 1000)
+# Load the app once in the master and fork the workers from it
+GUNICORN_PRELOAD = env_bool('GUNICORN_PRELOAD', True)
+# Seconds a silent worker lives before it is killed, and a stopping worker gets to finish its requests;
+# both exceed the slowest post (proxy checks, rate limit wait, Twitter calls and chunked uploads)
+GUNICORN_TIMEOUT = env_int('GUNICORN_TIMEOUT', 120)
+GUNICORN_GRACEFUL_TIMEOUT = env_int('GUNICORN_GRACEFUL_TIMEOUT', 120)
+GUNICORN_KEEPALIVE = env_int('GUNICORN_KEEPALIVE', 5)
+# Requests after which a worker is replaced, jittered so workers do not restart together; 0 disables
+GUNICORN_MAX_REQUESTS = env_int('GUNICORN_MAX_REQUESTS', 10000)
+GUNICORN_MAX_REQUESTS_JITTER = env_int('GUNICORN_MAX_REQUESTS_JITTER', 1000)
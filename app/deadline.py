@@ -0,0 +1,209 @@
+# Per-request deadlines: the time budget of a post, split across its phases and HTTP calls
+import asyncio
+import contextvars
+import time
+
+import requests
+
+from app import config
+
+# A timeout with less budget left than this is blamed on the deadline rather than on the network
+EXHAUSTED = 0.25
+
+_current = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request has no time left for its next step
+
+    Attributes:
+        phase (str): Phase that ran out of time, e.g. media_upload
+    """
+
+    def __init__(self, phase):
+        super().__init__(f"Request deadline exceeded during {phase}")
+        self.phase = phase
+
+
+class Deadline:
+    """
+    Point in time by which a request must be answered
+
+    The request moves through phases (proxy_check, client_init,
+    rate_limit_wait, media_upload, create_tweet). A phase may keep a reserve
+    for the phases after it, so slow uploads fail early rather than leaving
+    no time to create the tweet. Every HTTP call gets connect and read
+    timeouts cut to what is left of the budget of its phase.
+    """
+
+    def __init__(self, seconds):
+        """
+        Args:
+            seconds (float): Budget of the whole request
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.phase = 'start'
+        self.reserve = 0.0
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self):
+        """
+        Seconds the current phase may still use
+        """
+        return max(0.0, self.remaining() - self.reserve)
+
+    def start(self, phase, reserve=0.0):
+        """
+        Enter a phase that must end reserve seconds before the deadline
+
+        The reserve is at most half of the whole deadline, so short
+        deadlines still leave time to the first phases.
+
+        Raises:
+            DeadlineExceeded: If the phase has no time left
+        """
+        self.phase = phase
+        self.reserve = min(reserve, self.seconds / 2)
+        self.check()
+
+    def check(self):
+        if self.budget() <= 0:
+            raise DeadlineExceeded(self.phase)
+
+    def timeout(self, connect=None, read=None):
+        """
+        (connect, read) timeout of one HTTP call of the current phase
+
+        Raises:
+            DeadlineExceeded: If the phase has no time left
+        """
+        self.check()
+        budget = self.budget()
+        connect = config.HTTP_CONNECT_TIMEOUT if connect is None else connect
+        read = config.HTTP_READ_TIMEOUT if read is None else read
+        return min(connect, budget), min(read, budget)
+
+
+def parse_deadline(header_value=None, default=None, maximum=None):
+    """
+    Deadline of a request, from its X-Request-Deadline header (seconds) or the default
+
+    Args:
+        header_value (str, optional): X-Request-Deadline sent by the client
+        default (float, optional): Seconds without header, defaults to REQUEST_DEADLINE
+        maximum (float, optional): Longest deadline a header may ask for, defaults to REQUEST_DEADLINE_MAX
+
+    Returns:
+        Deadline: Starting now
+
+    Raises:
+        ValueError: If the header is not a positive number of seconds
+    """
+    default = config.REQUEST_DEADLINE if default is None else default
+    maximum = config.REQUEST_DEADLINE_MAX if maximum is None else maximum
+    if header_value is None or not header_value.strip():
+        return Deadline(default)
+    try:
+        seconds = float(header_value)
+    except ValueError:
+        raise ValueError("X-Request-Deadline must be a number of seconds")
+    if not 0 < seconds < float('inf'):
+        raise ValueError("X-Request-Deadline must be a positive number of seconds")
+    return Deadline(min(seconds, maximum))
+
+
+def current_deadline():
+    """
+    Deadline of the request running in this thread or task, or None
+    """
+    return _current.get()
+
+
+class deadline_scope:
+    """
+    Context manager running a block under a deadline
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def __enter__(self):
+        self._token = _current.set(self.deadline)
+        return self.deadline
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.reset(self._token)
+        return False
+
+
+async def run_blocking(function, *args):
+    """
+    Run blocking work (SQLite, image decoding) in the default executor, off the event loop
+
+    The work runs in a copy of the caller's context, so it keeps the request
+    deadline and the log correlation.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, function, *args)
+
+
+def phase(name, reserve=0.0):
+    """
+    Enter a phase of the current deadline, if there is one
+
+    Raises:
+        DeadlineExceeded: If the phase has no time left
+    """
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.start(name, reserve)
+
+
+def phase_budget(default):
+    """
+    Seconds the current phase may use, at most default
+    """
+    deadline = _current.get()
+    return default if deadline is None else min(default, deadline.budget())
+
+
+def http_timeout(connect=None, read=None):
+    """
+    (connect, read) timeout of an HTTP call: cut to the current deadline,
+    HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT outside of one
+
+    Raises:
+        DeadlineExceeded: If the current phase has no time left
+    """
+    deadline = _current.get()
+    if deadline is not None:
+        return deadline.timeout(connect, read)
+    return (config.HTTP_CONNECT_TIMEOUT if connect is None else connect,
+            config.HTTP_READ_TIMEOUT if read is None else read)
+
+
+def deadline_error(error):
+    """
+    The DeadlineExceeded behind an error, if the error comes from a spent deadline
+
+    Libraries wrap the errors of the HTTP calls (tweepy turns them into
+    TweepyException), so the whole chain is searched. A network timeout
+    counts when it used up the budget of its phase.
+
+    Returns:
+        DeadlineExceeded: Or None for any other error
+    """
+    deadline = _current.get()
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, DeadlineExceeded):
+            return error
+        if isinstance(error, requests.Timeout) and deadline is not None and deadline.budget() < EXHAUSTED:
+            return DeadlineExceeded(deadline.phase)
+        error = error.__cause__ or error.__context__
+    return None
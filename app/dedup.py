@@ -0,0 +1,302 @@
+# Index of the content each account posted recently, to reject duplicates before calling Twitter
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from app import config
+from app.media_cache import media_digest
+from app.proxy_pool import account_user_id
+from app.storage import SQLiteStore
+
+# Seconds between purges of expired fingerprints and summaries
+PURGE_INTERVAL = 60
+# Bloom summaries split the window into this many slices, which expire one by one
+SUMMARY_SLICES = 4
+# Bloom summaries kept in memory, least recently used ones are read again from the database
+SUMMARY_CACHE_SIZE = 64
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """
+    Text as compared for duplicates: Unicode NFC, whitespace runs collapsed, ends stripped
+    """
+    return WHITESPACE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def content_key(data):
+    """
+    Account and content fingerprint of a post
+
+    Args:
+        data (dict): Validated /post body
+
+    Returns:
+        tuple: (account, 16 byte fingerprint of the normalized text and the media digests)
+    """
+    account = account_user_id(data['access_token']) or \
+        hashlib.sha256(data['access_token'].encode('utf-8')).hexdigest()[:32]
+    images = data.get('images') or ([data['image']] if data.get('image') else [])
+    content = [normalize_text(data['text']), [media_digest(image) for image in images]]
+    fingerprint = hashlib.blake2b(json.dumps(content).encode('utf-8'), digest_size=16).digest()
+    return account, fingerprint
+
+
+class BloomFilter:
+    """
+    Fixed-size set of fingerprints answering "probably seen" or "never seen"
+
+    Fingerprints are uniformly distributed already, so the bit positions come
+    from their two 64-bit halves by double hashing.
+    """
+
+    def __init__(self, capacity=None, error_rate=None, bits=None, hashes=None):
+        """
+        Args:
+            capacity (int, optional): Fingerprints held at error_rate false positives
+            error_rate (float, optional): Share of false positives at capacity
+            bits (bytes, optional): Stored filter, restored with its hashes
+            hashes (int, optional): Bit positions per fingerprint of a stored filter
+        """
+        if bits is None:
+            capacity = config.DEDUP_BLOOM_CAPACITY if capacity is None else capacity
+            error_rate = config.DEDUP_BLOOM_ERROR_RATE if error_rate is None else error_rate
+            size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+            bits = bytes((size + 7) // 8)
+            hashes = max(1, round(size / capacity * math.log(2)))
+        self.bits = bytearray(bits)
+        self.size = len(self.bits) * 8
+        self.hashes = hashes
+
+    def _positions(self, fingerprint):
+        first = int.from_bytes(fingerprint[:8], 'big')
+        second = int.from_bytes(fingerprint[8:16], 'big') | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fingerprint))
+
+
+class DedupIndex(SQLiteStore):
+    """
+    Fingerprints of the content each account posted within the window
+
+    A post claims its content before it is sent (state pending), so two
+    identical posts sent at once are not both tried; the claim becomes a
+    posted entry with its tweet_id on success and is dropped on failure. A
+    pending claim older than pending_timeout belongs to a dead worker and
+    is ignored. Every account keeps at most max_per_account exact
+    fingerprints; older ones are dropped or, with bloom, folded into Bloom
+    summaries of their slice of the window, which answer "probably posted".
+    """
+
+    def __init__(self, path=None, window=None, max_per_account=None, pending_timeout=None, bloom=None):
+        """
+        Args:
+            path (str, optional): SQLite database file
+            window (int, optional): Seconds identical content is rejected after it was posted
+            max_per_account (int, optional): Exact fingerprints kept per account
+            pending_timeout (int, optional): Seconds a claim of a post being sent blocks identical content
+            bloom (bool, optional): Fold fingerprints beyond max_per_account into Bloom summaries
+        """
+        super().__init__(config.DEDUP_DB if path is None else path, [
+            '''
+            CREATE TABLE IF NOT EXISTS dedup (
+                account TEXT NOT NULL,
+                fingerprint BLOB NOT NULL,
+                state TEXT NOT NULL,
+                tweet_id TEXT,
+                posted_at REAL NOT NULL,
+                PRIMARY KEY (account, fingerprint)
+            ) WITHOUT ROWID
+            ''',
+            'CREATE INDEX IF NOT EXISTS dedup_account_posted ON dedup (account, posted_at)',
+            'CREATE INDEX IF NOT EXISTS dedup_posted ON dedup (posted_at)',
+            '''
+            CREATE TABLE IF NOT EXISTS dedup_summaries (
+                account TEXT NOT NULL,
+                slice INTEGER NOT NULL,
+                hashes INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                bits BLOB NOT NULL,
+                PRIMARY KEY (account, slice)
+            ) WITHOUT ROWID
+            '''
+        ])
+        self.window = config.DEDUP_WINDOW if window is None else window
+        self.max_per_account = config.DEDUP_MAX_PER_ACCOUNT if max_per_account is None else max_per_account
+        self.pending_timeout = config.DEDUP_PENDING_TIMEOUT if pending_timeout is None else pending_timeout
+        self.bloom = config.DEDUP_BLOOM_ENABLED if bloom is None else bloom
+        self.slice_seconds = self.window / SUMMARY_SLICES
+        # (account, slice) -> (count, BloomFilter) as last read from the database
+        self._summaries = OrderedDict()
+        self._summaries_lock = threading.Lock()
+        self._last_purge = 0.0
+        self.duplicates = 0
+
+    def claim(self, account, fingerprint):
+        """
+        Claim content before posting it, unless the account posted it within the window
+
+        Returns:
+            dict: None when claimed, otherwise the earlier post: state (posted,
+            pending or probable), tweet_id and posted_at when known
+        """
+        now = time.time()
+        if now - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = now
+            self.purge_expired(now)
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT state, tweet_id, posted_at FROM dedup WHERE account = ? AND fingerprint = ?',
+                (account, fingerprint)
+            ).fetchone()
+            duplicate = None
+            if row is not None and row[0] == 'posted' and row[2] > now - self.window:
+                duplicate = {"state": "posted", "tweet_id": row[1], "posted_at": row[2]}
+            elif row is not None and row[0] == 'pending' and row[2] > now - self.pending_timeout:
+                duplicate = {"state": "pending"}
+            elif row is None and self.bloom and self._in_summaries(connection, account, fingerprint, now):
+                duplicate = {"state": "probable"}
+            if duplicate is None:
+                connection.execute(
+                    'INSERT OR REPLACE INTO dedup (account, fingerprint, state, tweet_id, posted_at) '
+                    'VALUES (?, ?, ?, NULL, ?)',
+                    (account, fingerprint, 'pending', now)
+                )
+        if duplicate is not None:
+            self.duplicates += 1
+        return duplicate
+
+    def finish(self, account, fingerprint, tweet_id=None):
+        """
+        Record the tweet_id of claimed content that was posted, or drop the claim of a failed post
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            if tweet_id is None:
+                connection.execute(
+                    'DELETE FROM dedup WHERE account = ? AND fingerprint = ? AND state = ?',
+                    (account, fingerprint, 'pending')
+                )
+                return
+            connection.execute(
+                'UPDATE dedup SET state = ?, tweet_id = ?, posted_at = ? WHERE account = ? AND fingerprint = ?',
+                ('posted', str(tweet_id), now, account, fingerprint)
+            )
+            self._evict_oldest(connection, account)
+
+    def purge_expired(self, now=None):
+        now = time.time() if now is None else now
+        with self.transaction() as connection:
+            connection.execute(
+                'DELETE FROM dedup WHERE posted_at <= ? AND (state = ? OR posted_at <= ?)',
+                (now - self.window, 'posted', now - self.pending_timeout)
+            )
+            connection.execute(
+                'DELETE FROM dedup_summaries WHERE slice < ?', (self._first_slice(now),)
+            )
+
+    def stats(self):
+        with self.transaction(write=False) as connection:
+            entries, accounts = connection.execute('SELECT COUNT(*), COUNT(DISTINCT account) FROM dedup').fetchone()
+            summaries, summary_bytes = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(bits)), 0) FROM dedup_summaries'
+            ).fetchone()
+        return {
+            "window": self.window,
+            "max_per_account": self.max_per_account,
+            "bloom": self.bloom,
+            "entries": entries,
+            "accounts": accounts,
+            "summaries": summaries,
+            "summary_bytes": summary_bytes,
+            "duplicates": self.duplicates
+        }
+
+    def _first_slice(self, now):
+        # Oldest slice still overlapping the window
+        return math.floor((now - self.window) / self.slice_seconds)
+
+    def _evict_oldest(self, connection, account):
+        count = connection.execute('SELECT COUNT(*) FROM dedup WHERE account = ?', (account,)).fetchone()[0]
+        if count <= self.max_per_account:
+            return
+        oldest = connection.execute(
+            'SELECT fingerprint, posted_at FROM dedup WHERE account = ? AND state = ? ORDER BY posted_at LIMIT ?',
+            (account, 'posted', count - self.max_per_account)
+        ).fetchall()
+        if self.bloom:
+            by_slice = {}
+            for fingerprint, posted_at in oldest:
+                by_slice.setdefault(math.floor(posted_at / self.slice_seconds), []).append(fingerprint)
+            for slice_index, fingerprints in by_slice.items():
+                self._fold(connection, account, slice_index, fingerprints)
+        connection.executemany(
+            'DELETE FROM dedup WHERE account = ? AND fingerprint = ?',
+            [(account, fingerprint) for fingerprint, _ in oldest]
+        )
+
+    def _fold(self, connection, account, slice_index, fingerprints):
+        row = connection.execute(
+            'SELECT hashes, count, bits FROM dedup_summaries WHERE account = ? AND slice = ?', (account, slice_index)
+        ).fetchone()
+        summary = BloomFilter(bits=row[2], hashes=row[0]) if row is not None else BloomFilter()
+        for fingerprint in fingerprints:
+            summary.add(fingerprint)
+        connection.execute(
+            'INSERT OR REPLACE INTO dedup_summaries (account, slice, hashes, count, bits) VALUES (?, ?, ?, ?, ?)',
+            (account, slice_index, summary.hashes, (row[1] if row is not None else 0) + len(fingerprints),
+             bytes(summary.bits))
+        )
+
+    def _in_summaries(self, connection, account, fingerprint, now):
+        # Only the counts are read on every check; a summary is loaded again when another worker grew it
+        slices = connection.execute(
+            'SELECT slice, count FROM dedup_summaries WHERE account = ? AND slice >= ?',
+            (account, self._first_slice(now))
+        ).fetchall()
+        for slice_index, count in slices:
+            key = (account, slice_index)
+            with self._summaries_lock:
+                cached = self._summaries.get(key)
+                if cached is not None:
+                    self._summaries.move_to_end(key)
+            if cached is None or cached[0] != count:
+                hashes, bits = connection.execute(
+                    'SELECT hashes, bits FROM dedup_summaries WHERE account = ? AND slice = ?', (account, slice_index)
+                ).fetchone()
+                cached = (count, BloomFilter(bits=bits, hashes=hashes))
+                with self._summaries_lock:
+                    self._summaries[key] = cached
+                    while len(self._summaries) > SUMMARY_CACHE_SIZE:
+                        self._summaries.popitem(last=False)
+            if fingerprint in cached[1]:
+                return True
+        return False
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def get_dedup_index():
+    """
+    Return the process-wide content index
+    """
+    global _default_index
+    if _default_index is None:
+        with _default_index_lock:
+            if _default_index is None:
+                _default_index = DedupIndex()
+    return _default_index
@@ -0,0 +1,311 @@
+# Idempotency keys for /post, backed by a local SQLite store
+import hashlib
+import json
+import threading
+import time
+
+from app import config
+from app.deadline import run_blocking
+from app.media_cache import media_digest
+from app.storage import SQLiteStore
+
+# Outcomes of IdempotencyStore.begin() and wait()
+NEW = 'new'
+REPLAY = 'replay'
+IN_PROGRESS = 'in_progress'
+MISMATCH = 'mismatch'
+
+# Seconds between purges of expired keys
+PURGE_INTERVAL = 60
+
+# Interval at which a retry polls for a result produced by another worker
+POLL_INTERVAL = 0.1
+
+
+def failed_before_sending(body, status_code):
+    """
+    Whether a post failed before anything was sent to create_tweet, so running it again cannot duplicate it
+
+    That is the case for rate limits (429), unavailable proxy pools or
+    workers (503), unreachable proxies and deadlines spent in an earlier
+    phase. Any other failure may have created the tweet.
+    """
+    if status_code < 500 and status_code != 429:
+        return False
+    if status_code in (429, 503) or body.get('proxy_unreachable'):
+        return True
+    return status_code == 504 and body.get('phase') not in (None, 'create_tweet')
+
+
+def request_fingerprint(data):
+    """
+    Hash of what a post request publishes: account, text, media and proxy
+
+    Args:
+        data (dict): Validated /post body
+
+    Returns:
+        str: Hex digest
+    """
+    images = data.get('images') or ([data['image']] if data.get('image') else [])
+    content = {
+        "api_key": data['api_key'],
+        "access_token": data['access_token'],
+        "text": data['text'],
+        "media": [media_digest(image) for image in images],
+        "proxy": data.get('proxy')
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def idempotency_key(data, header_value):
+    """
+    Key under which a post is deduplicated
+
+    A client key is scoped to the account so two clients can never collide.
+    Without a header the key is derived from the request when
+    IDEMPOTENCY_DERIVE_KEYS is on.
+
+    Args:
+        data (dict): Validated /post body
+        header_value (str): Idempotency-Key header, or None
+
+    Returns:
+        tuple: (key, request fingerprint), or (None, None) when the post is not idempotent
+    """
+    if not config.IDEMPOTENCY_ENABLED or (not header_value and not config.IDEMPOTENCY_DERIVE_KEYS):
+        return None, None
+    fingerprint = request_fingerprint(data)
+    if header_value:
+        scope = f"{data['api_key']}:{data['access_token']}:{header_value}"
+        return 'key:' + hashlib.sha256(scope.encode('utf-8')).hexdigest(), fingerprint
+    return 'derived:' + fingerprint, fingerprint
+
+
+class IdempotencyStore(SQLiteStore):
+    """
+    Durable record of post requests by idempotency key
+
+    A key is claimed by the first request (state running). Retries of a
+    finished request replay its stored response without touching Twitter;
+    retries of a running one wait for it, in-process through an event and
+    across workers by polling the database. Responses of posts that failed
+    before create_tweet (see failed_before_sending()) are handed to waiting
+    retries but not replayed afterwards; any other response, errors and
+    timeouts after the send included, is replayed, as the tweet may exist.
+    Keys expire after ttl seconds; a running key older than lock_timeout
+    belongs to a dead worker and is taken over.
+    """
+
+    def __init__(self, path=None, ttl=None, lock_timeout=None):
+        """
+        Args:
+            path (str, optional): SQLite database file
+            ttl (int, optional): Seconds a result is replayed
+            lock_timeout (int, optional): Seconds after which a running key is taken over
+        """
+        super().__init__(config.IDEMPOTENCY_DB if path is None else path, [
+            '''
+            CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                status_code INTEGER,
+                body TEXT,
+                started_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idempotency_expires ON idempotency (expires_at)'
+        ])
+        self.ttl = config.IDEMPOTENCY_TTL if ttl is None else ttl
+        self.lock_timeout = config.IDEMPOTENCY_LOCK_TIMEOUT if lock_timeout is None else lock_timeout
+        self._events = {}
+        self._events_lock = threading.Lock()
+        self._last_purge = 0.0
+        self.replays = 0
+
+    def begin(self, key, fingerprint):
+        """
+        Claim a key or find out what happened to it
+
+        Returns:
+            tuple: (outcome, body, status_code); body and status_code are set for REPLAY
+        """
+        now = time.time()
+        self._maybe_purge(now)
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT state, fingerprint, status_code, body, started_at, expires_at FROM idempotency WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is not None and row[1] != fingerprint and row[5] > now:
+                return MISMATCH, None, None
+
+            if row is None or row[5] <= now or row[0] == 'failed' or \
+                    (row[0] == 'running' and row[4] < now - self.lock_timeout):
+                connection.execute(
+                    'INSERT OR REPLACE INTO idempotency (key, state, fingerprint, started_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, 'running', fingerprint, now, now + self.ttl)
+                )
+                with self._events_lock:
+                    self._events[key] = threading.Event()
+                return NEW, None, None
+
+            if row[0] == 'done':
+                self.replays += 1
+                return REPLAY, json.loads(row[3]), row[2]
+            return IN_PROGRESS, None, None
+
+    def finish(self, key, body, status_code):
+        """
+        Store the response of a claimed key and wake up waiting retries
+        """
+        # Only posts that never reached create_tweet are run again by a later retry
+        state = 'failed' if failed_before_sending(body, status_code) else 'done'
+        with self.transaction() as connection:
+            connection.execute(
+                'UPDATE idempotency SET state = ?, status_code = ?, body = ? WHERE key = ?',
+                (state, status_code, json.dumps(body), key)
+            )
+        with self._events_lock:
+            event = self._events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, key, timeout):
+        """
+        Wait for the request holding a key to finish
+
+        Returns:
+            tuple: (REPLAY, body, status_code), or (IN_PROGRESS, None, None) on timeout
+        """
+        with self._events_lock:
+            event = self._events.get(key)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.transaction(write=False) as connection:
+                row = connection.execute(
+                    'SELECT state, status_code, body FROM idempotency WHERE key = ?', (key,)
+                ).fetchone()
+            if row is not None and row[0] in ('done', 'failed'):
+                self.replays += 1
+                return REPLAY, json.loads(row[2]), row[1]
+            remaining = deadline - time.monotonic()
+            if row is None or remaining <= 0:
+                return IN_PROGRESS, None, None
+            if event is not None:
+                event.wait(remaining)
+                # Poll from now on, the key may have been claimed again in the meantime
+                event = None
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
+
+    def stats(self):
+        with self.transaction(write=False) as connection:
+            counts = dict(connection.execute('SELECT state, COUNT(*) FROM idempotency GROUP BY state').fetchall())
+        return {
+            "running": counts.get('running', 0),
+            "done": counts.get('done', 0),
+            "failed": counts.get('failed', 0),
+            "replays": self.replays,
+            "ttl": self.ttl
+        }
+
+    def purge_expired(self, now=None):
+        now = time.time() if now is None else now
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM idempotency WHERE expires_at <= ?', (now,))
+
+    def _maybe_purge(self, now):
+        if now - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = now
+            self.purge_expired(now)
+
+
+def _conflict_response(outcome):
+    if outcome == MISMATCH:
+        return {
+            "status": "error",
+            "error_code": "idempotency_key_reused",
+            "message": "Idempotency-Key was already used for a different request"
+        }, 422
+    return {
+        "status": "error",
+        "error_code": "request_in_progress",
+        "message": "A request with this Idempotency-Key is still in progress, retry later"
+    }, 409
+
+
+def run_idempotent(store, key, fingerprint, post_function):
+    """
+    Run post_function once per key
+
+    Args:
+        store (IdempotencyStore): Store of the keys
+        key (str): Idempotency key
+        fingerprint (str): request_fingerprint() of the request
+        post_function (callable): Returns (response body dict, HTTP status code)
+
+    Returns:
+        tuple: (response body dict, HTTP status code, replayed)
+    """
+    outcome, body, status_code = store.begin(key, fingerprint)
+    if outcome == IN_PROGRESS:
+        outcome, body, status_code = store.wait(key, config.IDEMPOTENCY_WAIT)
+    if outcome in (MISMATCH, IN_PROGRESS):
+        return _conflict_response(outcome) + (False,)
+    if outcome == REPLAY:
+        return body, status_code, True
+
+    try:
+        body, status_code = post_function()
+    except Exception:
+        store.finish(key, {"status": "error", "message": "Internal error"}, 500)
+        raise
+    store.finish(key, body, status_code)
+    return body, status_code, False
+
+
+async def run_idempotent_async(store, key, fingerprint, post_coroutine):
+    """
+    Same as run_idempotent() for the asynchronous engine
+
+    Args:
+        post_coroutine (coroutine function): Returns (response body dict, HTTP status code)
+    """
+    # The store waits on SQLite locks and may poll the database, keep it off the event loop
+    outcome, body, status_code = await run_blocking(store.begin, key, fingerprint)
+    if outcome == IN_PROGRESS:
+        outcome, body, status_code = await run_blocking(store.wait, key, config.IDEMPOTENCY_WAIT)
+    if outcome in (MISMATCH, IN_PROGRESS):
+        return _conflict_response(outcome) + (False,)
+    if outcome == REPLAY:
+        return body, status_code, True
+
+    try:
+        body, status_code = await post_coroutine()
+    except Exception:
+        await run_blocking(store.finish, key, {"status": "error", "message": "Internal error"}, 500)
+        raise
+    await run_blocking(store.finish, key, body, status_code)
+    return body, status_code, False
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_idempotency_store():
+    """
+    Return the process-wide idempotency store, or None when IDEMPOTENCY_ENABLED is off
+    """
+    global _default_store
+    if not config.IDEMPOTENCY_ENABLED:
+        return None
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = IdempotencyStore()
+    return _default_store
@@ -0,0 +1,252 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import requests
+
+from app import config
+from app.log import correlation, log_event
+from app.posting import execute_post
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the job queue has no room left
+
+    Attributes:
+        retry_after (int): Suggested number of seconds before retrying
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _run_job(post_function, job_id, data):
+    # Module level so process workers can unpickle it; the job logs under its job_id
+    with correlation(job_id):
+        return post_function(data)
+
+
+class _Job:
+    __slots__ = ('id', 'future', 'created_at', 'queued_at', 'finished_at', 'status_code',
+                 'result', 'error', 'callback_url', 'webhook_status')
+
+    def __init__(self, job_id, callback_url):
+        self.id = job_id
+        self.future = None
+        self.created_at = time.time()
+        self.queued_at = None
+        self.finished_at = None
+        self.status_code = None
+        self.result = None
+        self.error = None
+        self.callback_url = callback_url
+        self.webhook_status = 'pending' if callback_url else None
+
+    @property
+    def state(self):
+        if self.finished_at is not None:
+            return 'succeeded' if self.status_code is not None and self.status_code < 400 else 'failed'
+        if self.future is not None and self.future.running():
+            return 'running'
+        return 'queued'
+
+    def to_dict(self):
+        job = {
+            "job_id": self.id,
+            "state": self.state,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+        if self.finished_at is not None:
+            job["status_code"] = self.status_code
+            job["result"] = self.result if self.result is not None else {"status": "error", "message": self.error}
+        if self.callback_url:
+            job["webhook"] = self.webhook_status
+        return job
+
+
+class JobManager:
+    """
+    Runs /post requests on a bounded worker pool and keeps their results
+
+    At most workers jobs run at once and at most queue_size more wait for a
+    worker. Further submissions raise QueueFullError so the HTTP layer can
+    answer 429 instead of holding connections open. Finished jobs are kept
+    for result_ttl seconds for polling.
+    """
+
+    def __init__(self, workers=None, queue_size=None, result_ttl=None, executor=None,
+                 webhook_timeout=None, post_function=execute_post):
+        """
+        Args:
+            workers (int, optional): Number of parallel posting workers
+            queue_size (int, optional): Jobs allowed to wait for a worker
+            result_ttl (float, optional): Seconds a finished job is kept
+            executor (str, optional): "thread" or "process"
+            webhook_timeout (float, optional): Timeout of webhook callbacks
+            post_function (callable, optional): Function run for each job, returns (body, status_code)
+        """
+        self.workers = config.JOB_WORKERS if workers is None else workers
+        self.queue_size = config.JOB_QUEUE_SIZE if queue_size is None else queue_size
+        self.result_ttl = config.JOB_RESULT_TTL if result_ttl is None else result_ttl
+        self.executor_type = config.JOB_EXECUTOR if executor is None else executor
+        self.webhook_timeout = config.JOB_WEBHOOK_TIMEOUT if webhook_timeout is None else webhook_timeout
+        self.post_function = post_function
+
+        if self.executor_type == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        elif self.executor_type == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='post-job')
+        else:
+            raise ValueError(f"Unknown job executor: {self.executor_type}")
+        self._webhooks = ThreadPoolExecutor(max_workers=2, thread_name_prefix='post-webhook')
+
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._average_duration = None
+        self.submitted = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self):
+        return self.workers + self.queue_size
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def submit(self, data, callback_url=None):
+        """
+        Queue a post request
+
+        Args:
+            data (dict): Validated request body
+            callback_url (str, optional): URL that receives the job as JSON when it finishes
+
+        Returns:
+            dict: Public view of the queued job
+
+        Raises:
+            QueueFullError: If all workers are busy and the queue is full
+        """
+        with self._lock:
+            self._purge_expired()
+            if self._pending >= self.capacity:
+                self.rejected += 1
+                raise QueueFullError("Job queue is full", self._retry_after())
+            job = _Job(uuid.uuid4().hex, callback_url)
+            self._jobs[job.id] = job
+            self._pending += 1
+            self.submitted += 1
+
+        job.queued_at = time.monotonic()
+        try:
+            job.future = self._executor.submit(_run_job, self.post_function, job.id, data)
+        except Exception:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+                self._pending -= 1
+            raise
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        log_event(logger, logging.INFO, 'job_queued', job_id=job.id)
+        return job.to_dict()
+
+    def get(self, job_id):
+        """
+        Return the public view of a job, or None if it is unknown or expired
+        """
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+        return job.to_dict() if job is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "executor": self.executor_type,
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "pending": self._pending,
+                "stored": len(self._jobs),
+                "submitted": self.submitted,
+                "rejected": self.rejected
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        self._webhooks.shutdown(wait=wait)
+
+    def _finish(self, job, future):
+        try:
+            job.result, job.status_code = future.result()
+        except Exception as e:
+            job.error = f"Job failed: {str(e)}"
+            job.status_code = 500
+            logger.error('job_crashed', exc_info=e, extra={'fields': {'job_id': job.id}})
+        job.finished_at = time.time()
+
+        duration = time.monotonic() - job.queued_at
+        with self._lock:
+            self._pending -= 1
+            if self._average_duration is None:
+                self._average_duration = duration
+            else:
+                self._average_duration = 0.8 * self._average_duration + 0.2 * duration
+
+        if job.callback_url:
+            self._webhooks.submit(self._deliver_webhook, job)
+
+    def _deliver_webhook(self, job):
+        try:
+            response = requests.post(job.callback_url, json=job.to_dict(), timeout=self.webhook_timeout)
+            job.webhook_status = 'delivered' if response.ok else f"failed: HTTP {response.status_code}"
+        except requests.RequestException as e:
+            job.webhook_status = f"failed: {str(e)}"
+        if job.webhook_status != 'delivered':
+            log_event(logger, logging.WARNING, 'webhook_failed', job_id=job.id, error=job.webhook_status)
+
+    def _retry_after(self):
+        # Rough time for the queued backlog to drain, at least one second
+        if not self._average_duration:
+            return 1
+        return max(1, int(round(self._average_duration * self.queue_size / max(1, self.workers))))
+
+    def _purge_expired(self):
+        # Jobs are stored in submission order; stop at the first one that must stay
+        cutoff = time.time() - self.result_ttl
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if job.finished_at is None or job.finished_at > cutoff:
+                break
+            self._jobs.popitem(last=False)
+
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """
+    Return the process-wide job manager, creating its worker pool on first use
+
+    With OUTBOX_ENABLED this is the durable Outbox, which has the same interface.
+    """
+    global _default_manager
+    if _default_manager is None:
+        with _default_manager_lock:
+            if _default_manager is None:
+                if config.OUTBOX_ENABLED:
+                    # app.outbox imports this module
+                    from app.outbox import Outbox
+                    _default_manager = Outbox()
+                else:
+                    _default_manager = JobManager()
+    return _default_manager
@@ -1,15 +1,116 @@
-from flask import Flask, request, jsonify, render_template
-import os
-import json
-from app.twitter_service import TwitterService
+import contextlib
+import functools
+
+from flask import Flask, Response, request, jsonify, render_template, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+from app import config, log, metrics
+from app.accounts import get_account_registry
 from app.api import api_bp
+from app.client_pool import get_client_pool
+from app.deadline import parse_deadline
+from app.batch import BatchError, batch_limits, resolve_batch, run_batch
+from app.idempotency import get_idempotency_store, idempotency_key, run_idempotent
+from app.jobs import QueueFullError, get_job_manager
+from app.posting import execute_post, execute_thread, validate_post_data, validate_thread_data
+from app.proxy_pool import get_proxy_pools
+from app.readiness import LoadMonitor, OverloadedError
+from app.responses import dumps, is_verbose, shape_job, shape_response
+from app.runtime import start_background_services
+from app.scheduler import get_scheduler, schedule_post
+from app.uploads import StreamingRequest, UploadError, read_post_data, read_uploads
+
+def runtime_gauges():
+    """
+    Sizes and counters of the shared pools, sampled when /metrics is scraped
+    """
+    pool = get_client_pool().stats()
+    jobs = get_job_manager().stats()
+    return [
+        ('client_pool_size', 'Cached Twitter clients', pool['size']),
+        ('client_pool_hits_total', 'Client lookups served from the pool', pool['hits'], 'counter'),
+        ('client_pool_misses_total', 'Client lookups that built a new client', pool['misses'], 'counter'),
+        ('jobs_pending', 'Asynchronous posts queued or running', jobs['pending']),
+        ('log_records_dropped_total', 'Log records dropped because the log queue was full', log.dropped_records(),
+         'counter')
+    ]
+
+
+def json_response(payload, status_code, headers=None):
+    """
+    JSON response encoded with the fast encoder of app.responses
+    """
+    return Response(dumps(payload), status=status_code, headers=headers, mimetype='application/json')
+
 
 def create_app():
     app = Flask(__name__)
+    app.request_class = StreamingRequest
+    app.config['MAX_CONTENT_LENGTH'] = config.MAX_CONTENT_LENGTH
+    log.configure_logging()
     
     # Register API blueprint
     app.register_blueprint(api_bp, url_prefix='/api')
     
+    # Resume posts left in the outbox and the schedule without waiting for a request
+    start_background_services()
+    # Fail at startup rather than on the first post if the proxy pools are misconfigured
+    get_proxy_pools()
+    # In-flight posts, recent errors and readiness of this worker process
+    load_monitor = LoadMonitor()
+    
+    def admitted(view):
+        # Shed posts beyond the capacity of the worker, count the results of the others
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                with load_monitor.admit():
+                    response = app.make_response(view(*args, **kwargs))
+            except OverloadedError as e:
+                return overloaded(e)
+            load_monitor.record_result(response.status_code)
+            return response
+        return wrapper
+    
+    def overloaded(error):
+        return jsonify({
+            "status": "error",
+            "error_code": "overloaded",
+            "message": str(error),
+            "retry_after": error.retry_after
+        }), 503, {"Retry-After": str(error.retry_after)}
+    
+    @app.before_request
+    def set_request_id():
+        # Every log record of the request carries this ID, the client gets it back
+        log.begin_request(request.headers.get('X-Request-ID'))
+    
+    @app.after_request
+    def add_request_id(response):
+        response.headers['X-Request-ID'] = log.get_request_id()
+        return response
+    
+    @app.before_request
+    def check_content_length():
+        # Reject oversized bodies from the Content-Length header, before reading them
+        if request.content_length is not None and request.content_length > config.MAX_CONTENT_LENGTH:
+            raise RequestEntityTooLarge()
+    
+    if config.METRICS_ENABLED:
+        metrics.register_collector('runtime', runtime_gauges)
+        metrics.register_collector('admission', load_monitor.gauges)
+        
+        @app.after_request
+        def count_request(response):
+            metrics.record_request(request.endpoint, response.status_code)
+            return response
+    
+    @app.errorhandler(RequestEntityTooLarge)
+    def request_too_large(error):
+        return jsonify({
+            "status": "error",
+            "message": f"Request body exceeds the limit of {config.MAX_CONTENT_LENGTH} bytes"
+        }), 413
+    
     @app.route('/', methods=['GET'])
     def index():
         return render_template('index.html')
@@ -18,103 +119,260 @@ def create_app():
     def health_check():
         return jsonify({"status": "ok"}), 200
     
+    @app.route('/ready', methods=['GET'])
+    def readiness_check():
+        # Cached state only, so a saturated worker still answers at once
+        ready, status = load_monitor.ready()
+        if ready:
+            return jsonify(status), 200
+        return jsonify(status), 503, {"Retry-After": str(load_monitor.retry_after)}
+    
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        if not config.METRICS_ENABLED:
+            return jsonify({"status": "error", "message": "Metrics are disabled"}), 404
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+    
     @app.route('/post', methods=['POST'])
+    @admitted
     def post_tweet():
-        data = request.json
+        # The deadline starts before the body is read, uploads count against it
+        try:
+            deadline = parse_deadline(request.headers.get('X-Request-Deadline'))
+        except ValueError as e:
+            return jsonify({"status": "error", "error_code": "invalid_deadline", "message": str(e)}), 400
         
-        # Validate required fields
-        required_fields = ['api_key', 'api_secret', 'access_token', 'access_secret', 'text']
-        missing_fields = [field for field in required_fields if field not in data]
+        try:
+            data = read_post_data(request)
+        except UploadError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
         
-        if missing_fields:
-            error_response = {
-                "status": "error",
-                "message": f"Missing required fields: {', '.join(missing_fields)}",
-                "request": {
-                    "credentials": {
-                        "api_key": data.get('api_key', ''),
-                        "api_secret": "***" + data.get('api_secret', '')[-4:] if data.get('api_secret') and len(data.get('api_secret')) > 4 else "***",
-                        "access_token": data.get('access_token', ''),
-                        "access_secret": "***" + data.get('access_secret', '')[-4:] if data.get('access_secret') and len(data.get('access_secret')) > 4 else "***"
-                    },
-                    "text": data.get('text', ''),
-                    "has_image": 'image' in data and data['image'] is not None,
-                    "proxy_settings": data.get('proxy')
-                }
-            }
-            return jsonify(error_response), 400
+        # Lean responses drop the echoed credentials, text and proxy settings
+        verbose = is_verbose(data.get('verbose') if isinstance(data, dict) else None,
+                             request.args.get('verbose'), request.headers.get('Prefer'))
         
-        # Initialize Twitter service with credentials
-        twitter_service = TwitterService(
-            api_key=data['api_key'],
-            api_secret=data['api_secret'],
-            access_token=data['access_token'],
-            access_secret=data['access_secret'],
-            proxy=data.get('proxy')
-        )
+        # Validate required fields
+        error_response = validate_post_data(data)
+        if error_response:
+            return json_response(shape_response(error_response, verbose), 400)
         
-        # Post tweet
-        try:
-            image_data = None
-            if 'image' in data and data['image']:
-                image_data = data['image']
-                
-            result = twitter_service.post_tweet(data['text'], image_data)
+        def publish():
+            if data.get('publish_at') is not None:
+                return schedule_post(data)
             
-            # Check if the result indicates an error
-            if result.get('status') == 'error':
-                error_response = {
-                    "status": "error",
-                    "error": result.get('error', 'Unknown error occurred'),
-                    "request": result.get('request', {}),
-                    "response": result.get('response', {})
-                }
-                return jsonify(error_response), 500
-            
-            # Return complete result including request and response details
-            response = {
-                "status": "success",
-                "tweet_url": result.get('tweet_url'),
-                "tweet_id": result.get('tweet_id'),
-                "request": result.get('request', {}),
-                "response": result.get('response', {})
-            }
-            
-            return jsonify(response), 201
-            
-        except Exception as e:
-            error_message = str(e)
-            
-            # Проверяем, не связана ли ошибка с прокси
-            proxy_error = None
-            if data.get('proxy') and ("proxy" in error_message.lower() or "socket" in error_message.lower() or "connect" in error_message.lower()):
+            # Opt-in asynchronous mode: queue the post and answer right away
+            if data.get('async') or 'respond-async' in request.headers.get('Prefer', ''):
+                # Spooled uploads are closed with the request, the job gets the bytes
+                read_uploads(data)
                 try:
-                    # Attempt to directly test proxy connection
-                    proxy_working, proxy_error = twitter_service._test_proxy_connection(data.get('proxy'))
-                    if not proxy_working:
-                        error_message = f"Proxy connection test failed: {proxy_error}"
-                except Exception as proxy_test_error:
-                    proxy_error = str(proxy_test_error)
+                    job = get_job_manager().submit(data, callback_url=data.get('callback_url'))
+                except QueueFullError as e:
+                    return {
+                        "status": "error",
+                        "message": str(e),
+                        "retry_after": e.retry_after
+                    }, 429
+                
+                return {
+                    "status": "accepted",
+                    "job_id": job['job_id'],
+                    "status_url": url_for('job_status', job_id=job['job_id'])
+                }, 202
             
-            error_response = {
-                "status": "error",
-                "message": error_message,
-                "request": {
-                    "credentials": {
-                        "api_key": data['api_key'],
-                        "api_secret": "***" + data['api_secret'][-4:] if len(data['api_secret']) > 4 else "***",
-                        "access_token": data['access_token'],
-                        "access_secret": "***" + data['access_secret'][-4:] if len(data['access_secret']) > 4 else "***"
-                    },
-                    "text": data['text'],
-                    "has_image": 'image' in data and data['image'] is not None,
-                    "proxy_settings": data.get('proxy')
-                }
-            }
+            return execute_post(data, deadline)
+        
+        # Retries with the same Idempotency-Key attach to or replay the first request
+        key, fingerprint = idempotency_key(data, request.headers.get('Idempotency-Key'))
+        if key is None:
+            response, status_code = publish()
+            replayed = False
+        else:
+            response, status_code, replayed = run_idempotent(get_idempotency_store(), key, fingerprint, publish)
+        
+        headers = {}
+        if status_code == 202:
+            headers["Location"] = response["status_url"]
+        if status_code in (429, 503) and 'retry_after' in response:
+            headers["Retry-After"] = str(response['retry_after'])
+        if replayed:
+            headers["Idempotent-Replayed"] = "true"
+        if not verbose and 'return=minimal' in request.headers.get('Prefer', ''):
+            headers["Preference-Applied"] = "return=minimal"
+        with metrics.timed('serialize'):
+            return json_response(shape_response(response, verbose), status_code, headers)
+    
+    @app.route('/post/batch', methods=['POST'])
+    def post_batch():
+        data = request.get_json(silent=True)
+        
+        try:
+            resolved = resolve_batch(data)
+            concurrency, account_concurrency = batch_limits(data)
+        except BatchError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        verbose = is_verbose(data.get('verbose'), request.args.get('verbose'), request.headers.get('Prefer'))
+        
+        # Hold a slot per post the batch runs at once; a batch wider than the worker runs narrower
+        valid_count = sum(1 for _, error_response in resolved if not error_response)
+        slots = max(1, min(concurrency or config.BATCH_CONCURRENCY, valid_count))
+        if load_monitor.max_in_flight:
+            slots = min(slots, load_monitor.max_in_flight)
+        admission = contextlib.ExitStack()
+        try:
+            admission.enter_context(load_monitor.admit(slots))
+        except OverloadedError as e:
+            return overloaded(e)
+        
+        def results():
+            succeeded = 0
+            failed = 0
+            valid_posts = []
+            for index, (post_data, error_response) in enumerate(resolved):
+                if error_response:
+                    failed += 1
+                    yield {"index": index, "status_code": 400, "result": shape_response(error_response, verbose)}
+                else:
+                    valid_posts.append((index, post_data))
             
-            if proxy_error:
-                error_response["proxy_error"] = proxy_error
-                
-            return jsonify(error_response), 500
+            for index, body, status_code in run_batch(valid_posts, slots, account_concurrency):
+                load_monitor.record_result(status_code)
+                if status_code < 400:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield {"index": index, "status_code": status_code, "result": shape_response(body, verbose)}
+            
+            yield {"summary": {"total": len(resolved), "succeeded": succeeded, "failed": failed}}
+        
+        # Stream one JSON line per finished post unless the caller wants a single document
+        if data.get('stream', True):
+            lines = (dumps(item) + b"\n" for item in results())
+            response = Response(lines, status=200, mimetype='application/x-ndjson')
+            # The posts run while the response streams, the slots are given back once it is closed
+            response.call_on_close(admission.close)
+            return response
+        
+        with admission:
+            items = list(results())
+        summary = items.pop()["summary"]
+        items.sort(key=lambda item: item["index"])
+        return json_response({"status": "completed", "results": items, "summary": summary}, 200)
+    
+    @app.route('/thread', methods=['POST'])
+    @admitted
+    def post_thread():
+        try:
+            deadline = parse_deadline(request.headers.get('X-Request-Deadline'),
+                                      config.THREAD_DEADLINE, config.THREAD_DEADLINE)
+        except ValueError as e:
+            return jsonify({"status": "error", "error_code": "invalid_deadline", "message": str(e)}), 400
+        
+        data = request.get_json(silent=True)
+        verbose = is_verbose(data.get('verbose') if isinstance(data, dict) else None,
+                             request.args.get('verbose'), request.headers.get('Prefer'))
+        
+        error_response = validate_thread_data(data)
+        if error_response:
+            return json_response(shape_response(error_response, verbose), 400)
+        
+        response, status_code = execute_thread(data, deadline)
+        headers = {}
+        if status_code in (429, 503) and 'retry_after' in response:
+            headers["Retry-After"] = str(response['retry_after'])
+        return json_response(shape_response(response, verbose), status_code, headers)
+    
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = get_job_manager().get(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": f"Job not found: {job_id}"}), 404
+        verbose = is_verbose(query=request.args.get('verbose'), prefer=request.headers.get('Prefer'))
+        return json_response(shape_job(job, verbose), 200)
+    
+    @app.route('/scheduled', methods=['GET'])
+    def scheduled_posts():
+        if not config.SCHEDULE_ENABLED:
+            return jsonify({"status": "error", "message": "Scheduled posting is disabled"}), 404
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        posts = get_scheduler().list(limit, request.args.get('after'))
+        return jsonify({
+            "posts": posts,
+            "next": posts[-1]["schedule_id"] if len(posts) == limit else None
+        }), 200
+    
+    @app.route('/scheduled/<schedule_id>', methods=['GET'])
+    def scheduled_post(schedule_id):
+        post = get_scheduler().get(schedule_id) if config.SCHEDULE_ENABLED else None
+        if post is None:
+            return jsonify({"status": "error", "message": f"Scheduled post not found: {schedule_id}"}), 404
+        return jsonify(post), 200
+    
+    @app.route('/scheduled/<schedule_id>', methods=['DELETE'])
+    def cancel_scheduled_post(schedule_id):
+        try:
+            post = get_scheduler().cancel(schedule_id) if config.SCHEDULE_ENABLED else None
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 409
+        if post is None:
+            return jsonify({"status": "error", "message": f"Scheduled post not found: {schedule_id}"}), 404
+        return jsonify(post), 200
+    
+    def account_registry_disabled():
+        return jsonify({"status": "error", "message": "The account registry is disabled, set ACCOUNTS_KEY"}), 404
+    
+    @app.route('/accounts', methods=['POST'])
+    def create_account():
+        registry = get_account_registry()
+        if registry is None:
+            return account_registry_disabled()
+        try:
+            account = registry.create(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify(account), 201, {"Location": url_for('get_account', account_id=account['account_id'])}
+    
+    @app.route('/accounts', methods=['GET'])
+    def list_accounts():
+        registry = get_account_registry()
+        if registry is None:
+            return account_registry_disabled()
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        accounts = registry.list(limit, request.args.get('after'))
+        return jsonify({
+            "accounts": accounts,
+            "next": accounts[-1]["account_id"] if len(accounts) == limit else None
+        }), 200
+    
+    @app.route('/accounts/<account_id>', methods=['GET'])
+    def get_account(account_id):
+        registry = get_account_registry()
+        if registry is None:
+            return account_registry_disabled()
+        account = registry.get(account_id)
+        if account is None:
+            return jsonify({"status": "error", "message": f"Account not found: {account_id}"}), 404
+        return jsonify(account), 200
+    
+    @app.route('/accounts/<account_id>', methods=['PATCH'])
+    def update_account(account_id):
+        registry = get_account_registry()
+        if registry is None:
+            return account_registry_disabled()
+        try:
+            account = registry.update(account_id, request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if account is None:
+            return jsonify({"status": "error", "message": f"Account not found: {account_id}"}), 404
+        return jsonify(account), 200
+    
+    @app.route('/accounts/<account_id>', methods=['DELETE'])
+    def delete_account(account_id):
+        registry = get_account_registry()
+        if registry is None:
+            return account_registry_disabled()
+        if not registry.delete(account_id):
+            return jsonify({"status": "error", "message": f"Account not found: {account_id}"}), 404
+        return jsonify({"status": "deleted", "account_id": account_id}), 200
     
     return app
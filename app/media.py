@@ -0,0 +1,299 @@
+# Media type detection and parallel upload of the media attached to a tweet
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import config
+from app.media_cache import content_digest
+
+MAX_IMAGES_PER_TWEET = 4
+
+# Platform limits per media kind, in bytes
+MAX_MEDIA_SIZE = {
+    'image': 5 * 1024 * 1024,
+    'gif': 15 * 1024 * 1024,
+    'video': 512 * 1024 * 1024
+}
+
+# Largest width or height of an image Twitter accepts
+MAX_IMAGE_DIMENSION = 8192
+
+MEDIA_CATEGORIES = {
+    'image': 'tweet_image',
+    'gif': 'tweet_gif',
+    'video': 'tweet_video'
+}
+
+FILE_EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+    'video/mp4': '.mp4',
+    'video/quicktime': '.mov'
+}
+
+
+class MediaError(Exception):
+    """
+    Raised when the media attached to a tweet cannot be uploaded as given
+    """
+
+
+def detect_media_type(header):
+    """
+    Detect the MIME type of media from its first bytes
+
+    Args:
+        header (bytes): At least the first 12 bytes of the file
+
+    Returns:
+        str: MIME type, or None if the format is not supported
+    """
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header[4:8] == b'ftyp':
+        return 'video/quicktime' if header[8:10] == b'qt' else 'video/mp4'
+    return None
+
+
+def image_dimensions(header, mime_type):
+    """
+    Read the width and height of an image from its first bytes
+
+    Args:
+        header (bytes): Start of the file; JPEG dimensions may need a few KB
+        mime_type (str): Type returned by detect_media_type()
+
+    Returns:
+        tuple: (width, height), or None if they are not within the header
+    """
+    if mime_type == 'image/png' and len(header) >= 24:
+        return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+    if mime_type == 'image/gif' and len(header) >= 10:
+        return int.from_bytes(header[6:8], 'little'), int.from_bytes(header[8:10], 'little')
+    if mime_type == 'image/webp' and len(header) >= 30:
+        chunk = header[12:16]
+        if chunk == b'VP8 ':
+            return int.from_bytes(header[26:28], 'little') & 0x3fff, int.from_bytes(header[28:30], 'little') & 0x3fff
+        if chunk == b'VP8L':
+            bits = int.from_bytes(header[21:25], 'little')
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b'VP8X':
+            return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+        return None
+    if mime_type == 'image/jpeg':
+        # Walk the segments up to the start of frame
+        position = 2
+        while position + 9 <= len(header):
+            if header[position] != 0xff:
+                return None
+            marker = header[position + 1]
+            if marker == 0xff:
+                position += 1
+                continue
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                return (int.from_bytes(header[position + 7:position + 9], 'big'),
+                        int.from_bytes(header[position + 5:position + 7], 'big'))
+            if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+                position += 2
+            else:
+                position += 2 + int.from_bytes(header[position + 2:position + 4], 'big')
+    return None
+
+
+def media_kind(mime_type):
+    """
+    Map a MIME type to image, gif or video
+    """
+    if mime_type == 'image/gif':
+        return 'gif'
+    if mime_type.startswith('video/'):
+        return 'video'
+    return 'image'
+
+
+def describe_media(media_file):
+    """
+    Inspect a media file without reading it into memory
+
+    Args:
+        media_file (file): Binary file object positioned at the start of the media
+
+    Returns:
+        tuple: (mime type, kind, size in bytes)
+
+    Raises:
+        MediaError: If the format is unsupported or the file is too large
+    """
+    start = media_file.tell()
+    header = media_file.read(16)
+    media_file.seek(0, 2)
+    size = media_file.tell() - start
+    media_file.seek(start)
+
+    mime_type = detect_media_type(header)
+    if mime_type is None:
+        raise MediaError("Unsupported media format, expected PNG, JPEG, WEBP, GIF or MP4")
+
+    kind = media_kind(mime_type)
+    if size > MAX_MEDIA_SIZE[kind]:
+        raise MediaError(f"Media too large: {size} bytes (maximum {MAX_MEDIA_SIZE[kind]} for {kind})")
+    return mime_type, kind, size
+
+
+def check_media_combination(kinds):
+    """
+    Check the platform rule: up to 4 images, or a single GIF or video
+
+    Raises:
+        MediaError: If the combination is not allowed in one tweet
+    """
+    if len(kinds) > MAX_IMAGES_PER_TWEET:
+        raise MediaError(f"Too many media files: {len(kinds)} (maximum {MAX_IMAGES_PER_TWEET})")
+    if len(kinds) > 1 and any(kind != 'image' for kind in kinds):
+        raise MediaError("A GIF or video must be the only media of a tweet")
+
+
+def upload_one(api, media_file, mime_type, kind, size, index=0):
+    """
+    Upload one media file
+
+    Small images use the single-request upload; GIFs, videos and images
+    above MEDIA_CHUNKED_THRESHOLD use the chunked INIT/APPEND/FINALIZE flow,
+    which streams the file in MEDIA_CHUNK_SIZE segments and waits for the
+    asynchronous processing of videos.
+
+    Returns:
+        tuple: (media_id, expires_after_secs reported by the platform or None)
+    """
+    filename = f"media{index}{FILE_EXTENSIONS.get(mime_type, '')}"
+    if kind == 'image' and size <= config.MEDIA_CHUNKED_THRESHOLD:
+        media = api.simple_upload(filename=filename, file=media_file)
+    else:
+        media = api.chunked_upload(
+            filename=filename, file=media_file, file_type=mime_type,
+            media_category=MEDIA_CATEGORIES[kind], chunk_size=config.MEDIA_CHUNK_SIZE
+        )
+    return media.media_id, getattr(media, 'expires_after_secs', None)
+
+
+def upload_media(api, media_files, executor=None, cache=None, account=None, reused=None):
+    """
+    Upload all media of a tweet, in parallel when there is more than one
+
+    The uploads share the keep-alive session of the pooled API client. With a
+    cache, content this account already uploaded reuses its media_id.
+
+    Args:
+        api (tweepy.API): v1.1 API client used for uploads
+        media_files (list): Binary file objects, positioned at the start of the media
+        executor (Executor, optional): Pool running parallel uploads, defaults to the shared pool
+        cache (MediaCache, optional): Cache of uploaded media_ids
+        account (str, optional): Account identifier for the cache, required with cache
+        reused (list, optional): Receives the indexes of media_files served from the cache
+
+    Returns:
+        list: media_ids in the order of media_files
+
+    Raises:
+        MediaError: If the media are invalid
+        Exception: The first upload error, after all uploads finished
+    """
+    reused_groups = [] if reused is not None else None
+    media_ids = upload_media_groups(api, [media_files], executor, cache, account, reused_groups)[0]
+    if reused is not None:
+        reused.extend(index for _, index in reused_groups)
+    return media_ids
+
+
+def upload_media_groups(api, groups, executor=None, cache=None, account=None, reused=None):
+    """
+    Upload the media of several tweets at once, e.g. all tweets of a thread
+
+    Every group is checked as the media of one tweet; the uploads of all
+    groups run in parallel.
+
+    Args:
+        api (tweepy.API): v1.1 API client used for uploads
+        groups (list): Lists of binary file objects, one list per tweet
+        executor (Executor, optional): Pool running parallel uploads, defaults to the shared pool
+        cache (MediaCache, optional): Cache of uploaded media_ids
+        account (str, optional): Account identifier for the cache, required with cache
+        reused (list, optional): Receives (group, index) of the media served from the cache
+
+    Returns:
+        list: Lists of media_ids in the order of groups and of their media files
+
+    Raises:
+        MediaError: If the media of a group are invalid
+        Exception: The first upload error, after all uploads finished
+    """
+    described = {}
+    for group, media_files in enumerate(groups):
+        kinds = []
+        for index, media_file in enumerate(media_files):
+            described[group, index] = describe_media(media_file)
+            kinds.append(described[group, index][1])
+        check_media_combination(kinds)
+
+    media_ids = {position: None for position in described}
+    digests = {}
+    if cache is not None:
+        for group, index in described:
+            digests[group, index] = content_digest(groups[group][index])
+            media_ids[group, index] = cache.get(account, digests[group, index])
+            if media_ids[group, index] is not None and reused is not None:
+                reused.append((group, index))
+
+    pending = [position for position, media_id in media_ids.items() if media_id is None]
+    if len(pending) == 1:
+        group, index = pending[0]
+        results = {pending[0]: upload_one(api, groups[group][index], *described[group, index], index)}
+    elif pending:
+        executor = executor or get_upload_executor()
+        # Each upload runs in a copy of the request context, so it keeps the request deadline
+        futures = {
+            (group, index): executor.submit(contextvars.copy_context().run, upload_one, api, groups[group][index],
+                                            *described[group, index], index)
+            for group, index in pending
+        }
+        # Wait for every upload before raising so no upload outlives the request
+        errors = [future.exception() for future in futures.values()]
+        for error in errors:
+            if error is not None:
+                raise error
+        results = {position: future.result() for position, future in futures.items()}
+    else:
+        results = {}
+
+    for position, (media_id, expires_after) in results.items():
+        media_ids[position] = media_id
+        if cache is not None:
+            cache.put(account, digests[position], media_id, expires_after)
+    return [[media_ids[group, index] for index in range(len(media_files))]
+            for group, media_files in enumerate(groups)]
+
+
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+
+def get_upload_executor():
+    """
+    Return the process-wide thread pool used for parallel media uploads
+    """
+    global _upload_executor
+    if _upload_executor is None:
+        with _upload_executor_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(
+                    max_workers=config.MEDIA_UPLOAD_WORKERS, thread_name_prefix='media-upload'
+                )
+    return _upload_executor
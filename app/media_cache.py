@@ -0,0 +1,182 @@
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from app import config
+
+# Margin kept before the platform expiry so a cached media_id is never used at the last second
+EXPIRY_MARGIN = 300
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def content_digest(media_file):
+    """
+    SHA-256 of a media file, read in chunks and rewound afterwards
+
+    Args:
+        media_file (file): Binary file object positioned at the start of the media
+
+    Returns:
+        str: Hex digest of the content
+    """
+    start = media_file.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: media_file.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    media_file.seek(start)
+    return digest.hexdigest()
+
+
+def media_digest(image):
+    """
+    SHA-256 of the decoded content of an image of a request
+
+    Base64 strings are decoded first, so base64 and multipart uploads of one image match.
+
+    Args:
+        image (str|bytes|file): Base64 encoded image, raw bytes or binary file object
+
+    Returns:
+        str: Hex digest of the content
+    """
+    if hasattr(image, 'read'):
+        return content_digest(image)
+    if isinstance(image, str):
+        image = base64.b64decode(image)
+    return hashlib.sha256(image).hexdigest()
+
+
+class MediaCache:
+    """
+    Content-addressed cache of uploaded media_ids
+
+    Media belong to the account that uploaded them, so entries are keyed on
+    (account, content digest). An entry lives until the platform expiry
+    reported by the upload (minus a margin), at most ttl seconds, and the
+    least recently used entries are dropped beyond max_size.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        """
+        Args:
+            max_size (int, optional): Maximum number of cached media_ids
+            ttl (float, optional): Maximum seconds a media_id is reused
+        """
+        self.max_size = config.MEDIA_CACHE_SIZE if max_size is None else max_size
+        self.ttl = config.MEDIA_CACHE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, account, digest):
+        """
+        Return the cached media_id for content uploaded by account, or None
+        """
+        key = (account, digest)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, account, digest, media_id, expires_after=None):
+        """
+        Remember an uploaded media_id
+
+        Args:
+            account (str): Account identifier (not a secret)
+            digest (str): Content digest from content_digest()
+            media_id (int): Media ID returned by the upload
+            expires_after (int, optional): expires_after_secs reported by the upload
+        """
+        lifetime = self.ttl
+        if expires_after:
+            lifetime = min(lifetime, expires_after - EXPIRY_MARGIN)
+        if lifetime <= 0:
+            return
+        key = (account, digest)
+        now = time.monotonic()
+        with self._lock:
+            # Drop expired entries at the least recently used end
+            while self._entries:
+                oldest_key, (_, expires_at) = next(iter(self._entries.items()))
+                if expires_at > now:
+                    break
+                del self._entries[oldest_key]
+                self.expirations += 1
+            self._entries[key] = (media_id, now + lifetime)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, account, media_ids):
+        """
+        Drop cached entries of account pointing at any of media_ids
+
+        Returns:
+            bool: Whether an entry was dropped
+        """
+        media_ids = set(media_ids)
+        with self._lock:
+            stale = [key for key, (media_id, _) in self._entries.items()
+                     if key[0] == account and media_id in media_ids]
+            for key in stale:
+                del self._entries[key]
+        return bool(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return cache counters
+
+        Returns:
+            dict: size, max_size, ttl, hits, misses, evictions, expirations and hit_ratio
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_media_cache():
+    """
+    Return the process-wide media cache, or None when MEDIA_CACHE_ENABLED is off
+    """
+    global _default_cache
+    if not config.MEDIA_CACHE_ENABLED:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = MediaCache()
+    return _default_cache
@@ -0,0 +1,279 @@
+# In-process metrics rendered in the Prometheus text exposition format
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from app import config
+
+# Upper bounds in seconds, from a cached proxy check up to a chunked video upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'twitterposter'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = f'{PREFIX}_{name}'
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.extend(self._render_sample(labels, value))
+        return lines
+
+    def _render_sample(self, labels, value):
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def _render_sample(self, labels, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+        label_text = _format_labels(self.labelnames, labels)
+        lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+        lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+PHASE_SECONDS = Histogram(
+    'phase_seconds', 'Duration of the phases of a post',
+    ['phase']
+)
+POSTS = Counter(
+    'posts_total', 'Finished posts by outcome and error class',
+    ['outcome', 'error_class']
+)
+PROXY_POSTS = Counter(
+    'proxy_posts_total', 'Finished posts by proxy (host only) and outcome',
+    ['proxy', 'outcome']
+)
+PROXY_FAILOVERS = Counter(
+    'proxy_failovers_total', 'Posts moved to another proxy of a pool after a proxy failure',
+    ['pool']
+)
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests by endpoint and status code',
+    ['endpoint', 'status']
+)
+IN_FLIGHT = Gauge(
+    'in_flight', 'Requests and posts currently being processed',
+    ['kind']
+)
+
+METRICS = [PHASE_SECONDS, POSTS, PROXY_POSTS, PROXY_FAILOVERS, HTTP_REQUESTS, IN_FLIGHT]
+
+# Callables returning [(name, documentation, value)] gauges sampled at scrape time, by name
+_collectors = {}
+
+
+class _NullContext:
+    """
+    Shared no-op context manager returned by timed() and in_flight() when metrics are off
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+@contextmanager
+def _timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.observe(phase, value=time.perf_counter() - start)
+
+
+@contextmanager
+def _in_flight(kind):
+    IN_FLIGHT.inc(kind)
+    try:
+        yield
+    finally:
+        IN_FLIGHT.dec(kind)
+
+
+def timed(phase):
+    """
+    Context manager recording the duration of a phase
+
+    Args:
+        phase (str): Phase name, e.g. proxy_check, media_upload or create_tweet
+
+    Returns:
+        context manager: A shared no-op one when METRICS_ENABLED is off
+    """
+    if not config.METRICS_ENABLED:
+        return _NULL_CONTEXT
+    return _timed(phase)
+
+
+def in_flight(kind):
+    """
+    Context manager counting work in progress of a kind (post, batch, job)
+    """
+    if not config.METRICS_ENABLED:
+        return _NULL_CONTEXT
+    return _in_flight(kind)
+
+
+def proxy_label(proxy_settings):
+    """
+    Identify a proxy by scheme, host and port, never by its credentials
+
+    Args:
+        proxy_settings (dict): Proxy configuration, or None
+
+    Returns:
+        str: e.g. socks5://host:1080, or "none"
+    """
+    if not proxy_settings:
+        return 'none'
+    url = proxy_settings.get('socks5') or proxy_settings.get('https') or proxy_settings.get('http')
+    try:
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.hostname}:{parsed.port}"
+    except (TypeError, ValueError):
+        return 'invalid'
+
+
+def record_post(outcome, error_class=None, proxy_settings=None):
+    """
+    Count a finished post
+
+    Args:
+        outcome (str): success, error, rate_limited or duplicate
+        error_class (str, optional): Exception class name of a failed post
+        proxy_settings (dict, optional): Proxy the post went through
+    """
+    if not config.METRICS_ENABLED:
+        return
+    POSTS.inc(outcome, error_class or '')
+    PROXY_POSTS.inc(proxy_label(proxy_settings), outcome)
+
+
+def record_failover(pool):
+    if not config.METRICS_ENABLED:
+        return
+    PROXY_FAILOVERS.inc(pool)
+
+
+def record_request(endpoint, status):
+    if not config.METRICS_ENABLED:
+        return
+    HTTP_REQUESTS.inc(endpoint or 'unknown', str(status))
+
+
+def register_collector(name, collector):
+    """
+    Add (or replace) a callable returning [(name, documentation, value)] samples taken on every scrape
+
+    Samples are gauges; a sample of a monotonic count adds 'counter' as a
+    fourth element and has a name ending in _total.
+    """
+    _collectors[name] = collector
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text exposition format
+
+    Returns:
+        str: Exposition text, one metric family after another
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collector in list(_collectors.values()):
+        for name, documentation, value, *kind in collector():
+            lines.append(f'# HELP {PREFIX}_{name} {documentation}')
+            lines.append(f'# TYPE {PREFIX}_{name} {kind[0] if kind else "gauge"}')
+            lines.append(f'{PREFIX}_{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in METRICS:
+        metric.clear()
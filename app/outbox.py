@@ -0,0 +1,403 @@
+# Durable outbox running asynchronous posts with retries
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app import config
+from app.jobs import QueueFullError
+from app.log import correlation, log_event
+from app.posting import execute_post, serialize_post_data
+from app.storage import SQLiteStore
+
+logger = logging.getLogger(__name__)
+
+# Seconds between purges of expired results
+PURGE_INTERVAL = 60
+
+# Twitter API errors are reported as "403 Forbidden\n..."
+STATUS_PREFIX = re.compile(r'^(\d{3}) ')
+
+
+def is_retryable(body, status_code):
+    """
+    Whether a failed post may succeed on a later attempt
+
+    Rate limits, proxy and network errors are retried. Errors Twitter
+    answers with a 4xx status (bad credentials, duplicate content, invalid
+    media) fail the same way every time.
+
+    Args:
+        body (dict): Response body returned by execute_post()
+        status_code (int): HTTP status code returned by execute_post()
+
+    Returns:
+        bool: True if the post should be attempted again
+    """
+    if status_code == 429:
+        return True
+    if status_code < 500:
+        return False
+    match = STATUS_PREFIX.match(str(body.get('error') or body.get('message') or ''))
+    return not (match and 400 <= int(match.group(1)) < 500)
+
+
+class Outbox(SQLiteStore):
+    """
+    Durable replacement of JobManager
+
+    A post is written to the outbox before /post answers 202, so it survives
+    a killed or restarted worker. A dispatcher thread per process claims due
+    posts in batches no larger than its free workers, so memory stays flat
+    however many posts are queued. A claim is a lease renewed while the post
+    runs; posts of a worker that died are claimed again once their lease
+    expires, on startup of the next worker at the latest. Delivery is
+    at-least-once: a worker killed right after Twitter accepted a tweet
+    posts it again. Failed attempts are retried with jittered exponential
+    backoff, at least as late as a rate limit asks for, up to max_attempts.
+    """
+
+    def __init__(self, path=None, workers=None, max_pending=None, max_attempts=None, backoff_base=None,
+                 backoff_max=None, lease=None, poll_interval=None, result_ttl=None, webhook_timeout=None,
+                 post_function=execute_post):
+        """
+        Args:
+            path (str, optional): SQLite database file
+            workers (int, optional): Number of parallel posting workers
+            max_pending (int, optional): Posts allowed to wait in the outbox
+            max_attempts (int, optional): Attempts before a post is failed
+            backoff_base (float, optional): Seconds before the first retry
+            backoff_max (float, optional): Longest delay between attempts
+            lease (float, optional): Seconds a claim lasts without renewal
+            poll_interval (float, optional): Seconds between checks for due posts
+            result_ttl (float, optional): Seconds a finished post is kept
+            webhook_timeout (float, optional): Timeout of webhook callbacks
+            post_function (callable, optional): Function run for each post, returns (body, status_code)
+        """
+        super().__init__(config.OUTBOX_DB if path is None else path, [
+            '''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                payload TEXT,
+                callback_url TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                owner TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                status_code INTEGER,
+                result TEXT,
+                webhook TEXT
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at)',
+            'CREATE INDEX IF NOT EXISTS outbox_lease ON outbox (state, lease_until)',
+            'CREATE INDEX IF NOT EXISTS outbox_finished ON outbox (finished_at)',
+            # Posts per state, kept by triggers so submit() and pending do not count the outbox
+            'CREATE TABLE IF NOT EXISTS outbox_counts (state TEXT PRIMARY KEY, posts INTEGER NOT NULL)',
+            # An outbox created before the counts starts from its current rows
+            '''
+            INSERT INTO outbox_counts (state, posts)
+            SELECT state, COUNT(*) FROM outbox WHERE NOT EXISTS (SELECT 1 FROM outbox_counts) GROUP BY state
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS outbox_insert AFTER INSERT ON outbox BEGIN
+                INSERT INTO outbox_counts (state, posts) VALUES (NEW.state, 1)
+                    ON CONFLICT (state) DO UPDATE SET posts = posts + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS outbox_update AFTER UPDATE OF state ON outbox
+            WHEN OLD.state != NEW.state BEGIN
+                UPDATE outbox_counts SET posts = posts - 1 WHERE state = OLD.state;
+                INSERT INTO outbox_counts (state, posts) VALUES (NEW.state, 1)
+                    ON CONFLICT (state) DO UPDATE SET posts = posts + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS outbox_delete AFTER DELETE ON outbox BEGIN
+                UPDATE outbox_counts SET posts = posts - 1 WHERE state = OLD.state;
+            END
+            '''
+        ])
+        self.workers = config.JOB_WORKERS if workers is None else workers
+        self.max_pending = config.OUTBOX_MAX_PENDING if max_pending is None else max_pending
+        self.max_attempts = config.OUTBOX_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.backoff_base = config.OUTBOX_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = config.OUTBOX_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.lease = config.OUTBOX_LEASE if lease is None else lease
+        self.poll_interval = config.OUTBOX_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.result_ttl = config.JOB_RESULT_TTL if result_ttl is None else result_ttl
+        self.webhook_timeout = config.JOB_WEBHOOK_TIMEOUT if webhook_timeout is None else webhook_timeout
+        self.post_function = post_function
+
+        # Identifies the claims of this process
+        self.owner = uuid.uuid4().hex
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox')
+        self._webhooks = ThreadPoolExecutor(max_workers=2, thread_name_prefix='outbox-webhook')
+        self._lock = threading.Lock()
+        self._active = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.submitted = 0
+        self.rejected = 0
+        self.retried = 0
+        self.recovered = 0
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name='outbox-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    @property
+    def pending(self):
+        with self.transaction(write=False) as connection:
+            return self._pending(connection)
+
+    @staticmethod
+    def _pending(connection):
+        return connection.execute(
+            "SELECT COALESCE(SUM(posts), 0) FROM outbox_counts WHERE state IN ('queued', 'running')"
+        ).fetchone()[0]
+
+    def submit(self, data, callback_url=None):
+        """
+        Store a post request; it runs once a worker is free
+
+        Args:
+            data (dict): Validated request body
+            callback_url (str, optional): URL that receives the job as JSON when it finishes
+
+        Returns:
+            dict: Public view of the queued job
+
+        Raises:
+            QueueFullError: If max_pending posts are already waiting
+        """
+        payload = serialize_post_data(data)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as connection:
+            if self._pending(connection) >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError("Outbox is full", max(1, int(self.backoff_base)))
+            connection.execute(
+                'INSERT INTO outbox (id, state, payload, callback_url, next_attempt_at, created_at, webhook) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', payload, callback_url, now, now, 'pending' if callback_url else None)
+            )
+        self.submitted += 1
+        self._wakeup.set()
+        log_event(logger, logging.INFO, 'job_queued', job_id=job_id)
+        return {"job_id": job_id, "state": "queued", "created_at": now, "finished_at": None, "attempts": 0}
+
+    def get(self, job_id):
+        """
+        Return the public view of a job, or None if it is unknown or expired
+        """
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                'SELECT state, attempts, next_attempt_at, created_at, finished_at, status_code, result, '
+                'callback_url, webhook FROM outbox WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        state, attempts, next_attempt_at, created_at, finished_at, status_code, result, callback_url, webhook = row
+        job = {
+            "job_id": job_id,
+            "state": state,
+            "created_at": created_at,
+            "finished_at": finished_at,
+            "attempts": attempts
+        }
+        if finished_at is not None:
+            job["status_code"] = status_code
+            job["result"] = json.loads(result)
+        elif state == 'queued' and attempts:
+            # Result of the last failed attempt and when the next one is due
+            job["next_attempt_at"] = next_attempt_at
+            job["last_result"] = json.loads(result) if result else None
+        if callback_url:
+            job["webhook"] = webhook
+        return job
+
+    def stats(self):
+        with self.transaction(write=False) as connection:
+            counts = dict(connection.execute('SELECT state, posts FROM outbox_counts').fetchall())
+        return {
+            "executor": "outbox",
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": counts.get('queued', 0) + counts.get('running', 0),
+            "queued": counts.get('queued', 0),
+            "running": counts.get('running', 0),
+            "succeeded": counts.get('succeeded', 0),
+            "failed": counts.get('failed', 0),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "retried": self.retried,
+            "recovered": self.recovered
+        }
+
+    def shutdown(self, wait=True):
+        """
+        Stop claiming posts; with wait, let the running ones finish
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        self._dispatcher.join()
+        self._executor.shutdown(wait=wait)
+        self._webhooks.shutdown(wait=wait)
+
+    def _dispatch(self):
+        renew_at = 0.0
+        purge_at = 0.0
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            now = time.time()
+            try:
+                if now >= renew_at:
+                    self._renew_leases(now)
+                    renew_at = now + self.lease / 3
+                if now >= purge_at:
+                    self._purge_finished(now)
+                    purge_at = now + PURGE_INTERVAL
+
+                with self._lock:
+                    free = self.workers - self._active
+                claimed = self._claim(free, now) if free > 0 else []
+            except Exception as e:
+                # E.g. "database is locked" while workers contend: log it and try again, never stop dispatching
+                logger.error('outbox_dispatch_failed', exc_info=e)
+                self._wakeup.wait(min(self.poll_interval, self.lease / 3))
+                continue
+            for job_id, payload, callback_url, attempts in claimed:
+                with self._lock:
+                    self._active += 1
+                self._executor.submit(self._run, job_id, payload, callback_url, attempts)
+            if claimed and len(claimed) == free:
+                # Every worker is busy, a finishing post wakes us up
+                self._wakeup.wait(self.lease / 3)
+            elif not claimed:
+                self._wakeup.wait(min(self.poll_interval, self.lease / 3))
+
+    def _claim(self, limit, now):
+        """
+        Lease up to limit due posts, including posts of workers that died
+        """
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, payload, callback_url, attempts, owner FROM outbox "
+                "WHERE state = 'queued' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            if len(rows) < limit:
+                abandoned = connection.execute(
+                    "SELECT id, payload, callback_url, attempts, owner FROM outbox "
+                    "WHERE state = 'running' AND lease_until < ? LIMIT ?",
+                    (now, limit - len(rows))
+                ).fetchall()
+                self.recovered += len(abandoned)
+                rows.extend(abandoned)
+
+            claimed = []
+            for job_id, payload, callback_url, attempts, owner in rows:
+                if attempts >= self.max_attempts:
+                    # Its last attempt died with the worker
+                    self._finish(connection, job_id, owner, {
+                        "status": "error",
+                        "message": f"Worker stopped while posting, gave up after {attempts} attempts"
+                    }, 500, now)
+                    continue
+                connection.execute(
+                    "UPDATE outbox SET state = 'running', owner = ?, lease_until = ?, attempts = ? WHERE id = ?",
+                    (self.owner, now + self.lease, attempts + 1, job_id)
+                )
+                claimed.append((job_id, payload, callback_url, attempts + 1))
+        return claimed
+
+    def _run(self, job_id, payload, callback_url, attempt):
+        try:
+            with correlation(job_id):
+                try:
+                    body, status_code = self.post_function(json.loads(payload))
+                except Exception as e:
+                    logger.error('job_crashed', exc_info=e, extra={'fields': {'job_id': job_id, 'attempt': attempt}})
+                    body, status_code = {"status": "error", "message": f"Job failed: {str(e)}"}, 500
+                self._complete(job_id, callback_url, attempt, body, status_code)
+        finally:
+            with self._lock:
+                self._active -= 1
+            self._wakeup.set()
+
+    def _complete(self, job_id, callback_url, attempt, body, status_code):
+        now = time.time()
+        retry = status_code >= 400 and attempt < self.max_attempts and is_retryable(body, status_code)
+        with self.transaction() as connection:
+            if retry:
+                self.retried += 1
+                delay = self._backoff(attempt, body)
+                connection.execute(
+                    "UPDATE outbox SET state = 'queued', owner = NULL, lease_until = NULL, next_attempt_at = ?, "
+                    "status_code = ?, result = ? WHERE id = ? AND owner = ?",
+                    (now + delay, status_code, json.dumps(body), job_id, self.owner)
+                )
+                log_event(logger, logging.INFO, 'job_retry_scheduled', job_id=job_id, attempt=attempt,
+                          status_code=status_code, delay=round(delay, 1))
+                return
+            finished = self._finish(connection, job_id, self.owner, body, status_code, now)
+        if not finished:
+            # Our lease expired and another worker took the post over; its outcome is the one recorded
+            log_event(logger, logging.WARNING, 'job_lease_lost', job_id=job_id, attempt=attempt,
+                      status_code=status_code)
+            return
+        if callback_url:
+            self._webhooks.submit(self._deliver_webhook, job_id, callback_url)
+
+    def _finish(self, connection, job_id, owner, body, status_code, now):
+        """
+        Record the outcome of a post, unless owner no longer holds its claim
+
+        Returns:
+            bool: True if the outcome was recorded
+        """
+        # The payload holds credentials and media, it is dropped once the post is done
+        return connection.execute(
+            "UPDATE outbox SET state = ?, payload = NULL, owner = NULL, lease_until = NULL, finished_at = ?, "
+            "status_code = ?, result = ? WHERE id = ? AND owner IS ?",
+            ('succeeded' if status_code < 400 else 'failed', now, status_code, json.dumps(body), job_id, owner)
+        ).rowcount == 1
+
+    def _backoff(self, attempt, body):
+        # Jitter spreads the retries of posts that failed together
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        return max(delay, body.get('retry_after') or 0)
+
+    def _renew_leases(self, now):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE outbox SET lease_until = ? WHERE owner = ? AND state = 'running'",
+                (now + self.lease, self.owner)
+            )
+
+    def _purge_finished(self, now):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM outbox WHERE finished_at < ?', (now - self.result_ttl,))
+
+    def _deliver_webhook(self, job_id, callback_url):
+        try:
+            response = requests.post(callback_url, json=self.get(job_id), timeout=self.webhook_timeout)
+            status = 'delivered' if response.ok else f"failed: HTTP {response.status_code}"
+        except requests.RequestException as e:
+            status = f"failed: {str(e)}"
+        if status != 'delivered':
+            log_event(logger, logging.WARNING, 'webhook_failed', job_id=job_id, error=status)
+        with self.transaction() as connection:
+            connection.execute('UPDATE outbox SET webhook = ? WHERE id = ?', (status, job_id))
@@ -0,0 +1,566 @@
+# Posting pipeline shared by the synchronous /post route and the job workers
+import asyncio
+import base64
+import json
+import logging
+import time
+from datetime import datetime, timezone
+
+from app import config, metrics
+from app.accounts import account_reference, apply_account
+from app.async_service import AsyncTwitterService
+from app.deadline import DeadlineExceeded, deadline_error, deadline_scope, parse_deadline, run_blocking
+from app.dedup import content_key, get_dedup_index
+from app.log import log_event
+from app.proxy_pool import account_user_id, get_proxy_pools
+from app.threads import get_thread_store, thread_key
+from app.twitter_service import TwitterService
+from app.validation import CREDENTIAL_FIELDS, ValidationError, preflight
+
+REQUIRED_FIELDS = ['api_key', 'api_secret', 'access_token', 'access_secret', 'text']
+
+# Fields of a /thread body besides the credentials, and of each of its tweets
+THREAD_FIELDS = ['account_id', 'proxy', 'proxy_pool', 'tweets', 'in_reply_to_tweet_id', 'verbose']
+THREAD_TWEET_FIELDS = ['text', 'image', 'images']
+
+logger = logging.getLogger(__name__)
+
+
+def validate_post_data(data):
+    """
+    Check that a post request carries all required fields and passes preflight()
+
+    The credentials of a post referencing an account_id are filled in from
+    the account registry first.
+
+    Args:
+        data (dict): Parsed request body; media may be replaced by shrunk images
+
+    Returns:
+        dict: Error response body, or None if the request is valid
+    """
+    if not isinstance(data, dict):
+        return {"status": "error", "error_code": "invalid_request", "message": "Request body must be a JSON object"}
+    if 'account_id' in data:
+        try:
+            apply_account(data)
+        except ValidationError as e:
+            return {"status": "error", "error_code": e.error_code, "message": str(e)}
+
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
+
+    if not missing_fields:
+        try:
+            with metrics.timed('validate'):
+                preflight(data)
+        except ValidationError as e:
+            return {"status": "error", "error_code": e.error_code, "message": str(e)}
+        return None
+
+    return {
+        "status": "error",
+        "message": f"Missing required fields: {', '.join(missing_fields)}",
+        "request": {
+            "credentials": {
+                "api_key": data.get('api_key', ''),
+                "api_secret": "***" + data.get('api_secret', '')[-4:] if data.get('api_secret') and len(data.get('api_secret')) > 4 else "***",
+                "access_token": data.get('access_token', ''),
+                "access_secret": "***" + data.get('access_secret', '')[-4:] if data.get('access_secret') and len(data.get('access_secret')) > 4 else "***"
+            },
+            "text": data.get('text', ''),
+            "has_image": bool(data.get('images')) or ('image' in data and data['image'] is not None),
+            "proxy_settings": data.get('proxy')
+        }
+    }
+
+
+def execute_post(data, deadline=None):
+    """
+    Post the tweet described by a validated request body
+
+    Posts without a proxy of their own go through the pool they name, or the
+    pool of their account; an unreachable proxy is replaced by another one of
+    the pool. A post still running at its deadline fails with 504. With
+    DEDUP_ENABLED, content the account posted within DEDUP_WINDOW is
+    rejected with 409 before any proxy or Twitter call.
+
+    Args:
+        data (dict): Request body that passed validate_post_data()
+        deadline (Deadline, optional): Deadline of the request, defaults to REQUEST_DEADLINE from now
+
+    Returns:
+        tuple: (response body dict, HTTP status code)
+    """
+    started = time.monotonic()
+    deadline = parse_deadline() if deadline is None else deadline
+    if 'account_id' in data and 'access_token' not in data:
+        # A stored post only references its account, the credentials are read when it runs
+        try:
+            apply_account(data)
+        except ValidationError as e:
+            return {"status": "error", "error_code": e.error_code, "message": str(e)}, 400
+    content, duplicate = _claim_content(data)
+    if duplicate is not None:
+        _log_result('post', data, duplicate, started)
+        return duplicate
+    response = None
+    try:
+        with deadline_scope(deadline), metrics.in_flight('post'), metrics.timed('total'):
+            pool = get_proxy_pools().for_post(data)
+            if pool is not None:
+                response = pool.run(data, _execute_post)
+            else:
+                response = _execute_post(data)
+    finally:
+        _finish_content(content, response)
+    _log_result('post', data, response, started)
+    return _account_response(data, response)
+
+
+async def execute_post_async(data, deadline=None):
+    """
+    Same as execute_post() on the asynchronous engine
+
+    The post is cancelled when its deadline runs out, whatever call it is
+    waiting on.
+
+    Args:
+        data (dict): Request body that passed validate_post_data()
+        deadline (Deadline, optional): Deadline of the request, defaults to REQUEST_DEADLINE from now
+
+    Returns:
+        tuple: (response body dict, HTTP status code)
+    """
+    started = time.monotonic()
+    deadline = parse_deadline() if deadline is None else deadline
+    # The dedup index waits on SQLite, keep it off the event loop
+    content, duplicate = await run_blocking(_claim_content, data) if config.DEDUP_ENABLED else (None, None)
+    if duplicate is not None:
+        _log_result('post', data, duplicate, started)
+        return duplicate
+    response = None
+    try:
+        with deadline_scope(deadline), metrics.in_flight('post'), metrics.timed('total'):
+            pool = get_proxy_pools().for_post(data)
+            if pool is not None:
+                post = pool.run_async(data, _execute_post_async)
+            else:
+                post = _execute_post_async(data)
+            try:
+                response = await asyncio.wait_for(post, deadline.remaining())
+            except asyncio.TimeoutError:
+                metrics.record_post('error', 'DeadlineExceeded', data.get('proxy'))
+                response = _deadline_response(data, DeadlineExceeded(deadline.phase))
+    finally:
+        if content is not None:
+            await run_blocking(_finish_content, content, response)
+    _log_result('post', data, response, started)
+    return _account_response(data, response)
+
+
+def validate_thread_data(data):
+    """
+    Check a thread request; every tweet is checked like a /post request
+
+    Args:
+        data (dict): Parsed request body; media may be replaced by shrunk images
+
+    Returns:
+        dict: Error response body, with the index of the invalid tweet if any, or None if the thread is valid
+    """
+    def error(message, error_code='invalid_request'):
+        return {"status": "error", "error_code": error_code, "message": message}
+
+    if not isinstance(data, dict):
+        return error("Request body must be a JSON object")
+    unknown = set(data) - set(CREDENTIAL_FIELDS) - set(THREAD_FIELDS)
+    if unknown:
+        return error(f"Unknown fields: {', '.join(sorted(unknown))}")
+    tweets = data.get('tweets')
+    if not isinstance(tweets, list) or not tweets:
+        return error("Field 'tweets' must be a non-empty list")
+    if len(tweets) > config.THREAD_MAX_TWEETS:
+        return error(f"Too many tweets in thread: {len(tweets)} (maximum {config.THREAD_MAX_TWEETS})")
+    in_reply_to_tweet_id = data.get('in_reply_to_tweet_id')
+    if in_reply_to_tweet_id is not None and (
+        not isinstance(in_reply_to_tweet_id, str) or not in_reply_to_tweet_id.isdigit()
+    ):
+        return error("Field 'in_reply_to_tweet_id' must be a tweet ID string")
+    if 'account_id' in data:
+        try:
+            apply_account(data)
+        except ValidationError as e:
+            return error(str(e), e.error_code)
+
+    common = {field: value for field, value in data.items()
+              if field not in ('account_id', 'tweets', 'in_reply_to_tweet_id')}
+    for index, tweet in enumerate(tweets):
+        if not isinstance(tweet, dict):
+            return dict(error(f"Tweet {index} must be an object"), index=index)
+        unknown = set(tweet) - set(THREAD_TWEET_FIELDS)
+        if unknown:
+            return dict(error(f"Tweet {index}: unknown fields: {', '.join(sorted(unknown))}"), index=index)
+        post_data = dict(common, **tweet)
+        error_response = validate_post_data(post_data)
+        if error_response:
+            error_response["message"] = f"Tweet {index}: {error_response['message']}"
+            error_response["index"] = index
+            return error_response
+        # Keep the media preflight() shrank
+        for field in ('image', 'images'):
+            if field in tweet:
+                tweet[field] = post_data[field]
+    return None
+
+
+def execute_thread(data, deadline=None):
+    """
+    Post the thread described by a validated request body
+
+    Progress is stored after every tweet: the same thread sent again after
+    a failure resumes after the last tweet posted, and a thread sent again
+    after it completed returns its tweets without posting them twice. That
+    includes a thread stopped by its deadline.
+
+    Args:
+        data (dict): Request body that passed validate_thread_data()
+        deadline (Deadline, optional): Deadline of the request, defaults to THREAD_DEADLINE from now
+
+    Returns:
+        tuple: (response body dict, HTTP status code)
+    """
+    started = time.monotonic()
+    deadline = parse_deadline(default=config.THREAD_DEADLINE) if deadline is None else deadline
+    with deadline_scope(deadline), metrics.in_flight('thread'), metrics.timed('thread_total'):
+        key = thread_key(data)
+        store = get_thread_store()
+        posted = store.begin(key)
+        if posted is None:
+            return {
+                "status": "error",
+                "error_code": "thread_in_progress",
+                "message": "This thread is being posted by another request",
+                "thread_id": key
+            }, 409
+
+        def on_posted(index, tweet_id):
+            posted.append(tweet_id)
+            store.record(key, posted)
+
+        def post_thread(attempt_data):
+            return _execute_thread(attempt_data, posted, on_posted)
+
+        response = None
+        try:
+            pool = get_proxy_pools().for_post(data)
+            response = pool.run(data, post_thread) if pool is not None else post_thread(data)
+        finally:
+            store.finish(key, response is not None and response[1] == 201)
+        _log_result('thread', data, response, started, thread_id=key, posted=len(posted),
+                    failed_index=response[0].get('failed_index'))
+        body, status_code = _account_response(data, response)
+        body["thread_id"] = key
+        return body, status_code
+
+
+def serialize_post_data(data):
+    """
+    Encode a post request as JSON, for posts stored until they run
+
+    Uploaded files arrive as bytes; they are stored base64 encoded, which
+    TwitterService accepts as well. A post referencing an account_id is
+    stored without the account's credentials; execute_post() reads them
+    again when it runs.
+
+    Args:
+        data (dict): Validated request body with uploads read into bytes
+
+    Returns:
+        str: JSON document
+    """
+    payload = account_reference(data) if 'account_id' in data else dict(data)
+    if isinstance(payload.get('image'), (bytes, bytearray)):
+        payload['image'] = base64.b64encode(payload['image']).decode('ascii')
+    if payload.get('images'):
+        payload['images'] = [
+            base64.b64encode(image).decode('ascii') if isinstance(image, (bytes, bytearray)) else image
+            for image in payload['images']
+        ]
+    return json.dumps(payload)
+
+
+def _image_data(data):
+    if data.get('images'):
+        # Several images (up to 4) attached to one tweet
+        return data['images']
+    if 'image' in data and data['image']:
+        return data['image']
+    return None
+
+
+def _looks_like_proxy_error(data, error_message):
+    # Проверяем, не связана ли ошибка с прокси
+    return bool(data.get('proxy')) and (
+        "proxy" in error_message.lower() or "socket" in error_message.lower() or "connect" in error_message.lower()
+    )
+
+
+def _log_result(kind, data, response, started, **fields):
+    """
+    Log the outcome of a post or thread; successes are sampled, failures always logged
+    """
+    body, status_code = response
+    fields.update(
+        status_code=status_code,
+        account=account_user_id(data['access_token']),
+        proxy=metrics.proxy_label(data.get('proxy')),
+        duration_ms=round((time.monotonic() - started) * 1000, 1)
+    )
+    if isinstance(body.get('proxy_pool'), dict):
+        fields['proxy_pool'] = body['proxy_pool'].get('name')
+    if status_code < 400:
+        log_event(logger, logging.INFO, f'{kind}_succeeded', sampled=True, tweet_id=body.get('tweet_id'), **fields)
+    else:
+        log_event(logger, logging.WARNING, f'{kind}_failed', error=body.get('error') or body.get('message'),
+                  error_code=body.get('error_code'), **fields)
+
+
+def _claim_content(data):
+    """
+    Claim the content of a post in the dedup index
+
+    Returns:
+        tuple: (account and fingerprint to pass to _finish_content(), or None
+        when DEDUP_ENABLED is off; 409 response when the content is a duplicate)
+    """
+    if not config.DEDUP_ENABLED:
+        return None, None
+    content = content_key(data)
+    earlier = get_dedup_index().claim(*content)
+    if earlier is None:
+        return content, None
+    metrics.record_post('duplicate', proxy_settings=data.get('proxy'))
+    return None, _duplicate_response(earlier)
+
+
+def _finish_content(content, response):
+    """
+    Record the tweet of claimed content that was posted, or release the claim of a failed post
+    """
+    if content is None:
+        return
+    tweet_id = response[0].get('tweet_id') if response is not None and response[1] == 201 else None
+    get_dedup_index().finish(*content, tweet_id=tweet_id)
+
+
+def _duplicate_response(earlier):
+    """
+    Response body and status code for content the account already posted
+    """
+    response = {"status": "error", "error_code": "duplicate_content"}
+    if earlier["state"] == "pending":
+        response["message"] = "The same content is being posted for this account by another request"
+    elif earlier["state"] == "probable":
+        response["message"] = (f"This account has most likely posted the same content "
+                               f"in the last {config.DEDUP_WINDOW} seconds")
+    else:
+        response["message"] = f"This account already posted the same content in the last {config.DEDUP_WINDOW} seconds"
+        response["tweet_id"] = earlier["tweet_id"]
+        response["tweet_url"] = f"https://twitter.com/user/status/{earlier['tweet_id']}"
+        response["posted_at"] = datetime.fromtimestamp(earlier["posted_at"], timezone.utc).isoformat(timespec='seconds')
+    return response, 409
+
+
+def _account_response(data, response):
+    """
+    Echo the account_id of a post instead of its credentials
+    """
+    body, status_code = response
+    request_details = body.get('request')
+    if data.get('account_id') and isinstance(request_details, dict) and 'credentials' in request_details:
+        request_details['credentials'] = {"account_id": data['account_id']}
+    return body, status_code
+
+
+def _result_response(result):
+    """
+    Map the result of TwitterService.post_tweet() to a response body and status code
+    """
+    # Check if the result indicates an error
+    if result.get('status') == 'error':
+        error_response = {
+            "status": "error",
+            "error": result.get('error', 'Unknown error occurred'),
+            "request": result.get('request', {}),
+            "response": result.get('response', {})
+        }
+        if result.get('proxy_unreachable'):
+            error_response["proxy_unreachable"] = True
+        if result.get('error_code') == 'rate_limited':
+            # Tell the caller when the post is expected to go through
+            error_response["error_code"] = "rate_limited"
+            error_response["retry_after"] = result['retry_after']
+            error_response["expected_send_at"] = result['expected_send_at']
+            return error_response, 429
+        if result.get('error_code') == 'deadline_exceeded':
+            error_response["error_code"] = "deadline_exceeded"
+            error_response["phase"] = result['phase']
+            return error_response, 504
+        return error_response, 500
+
+    # Return complete result including request and response details
+    response = {
+        "status": "success",
+        "tweet_url": result.get('tweet_url'),
+        "tweet_id": result.get('tweet_id'),
+        "request": result.get('request', {}),
+        "response": result.get('response', {})
+    }
+
+    return response, 201
+
+
+def _thread_response(result):
+    """
+    Map the result of TwitterService.post_thread() to a response body and status code
+    """
+    if result.get('status') != 'error':
+        return result, 201
+    response = {
+        "status": "error",
+        "error": result['error'],
+        "failed_index": result['failed_index'],
+        "tweets": result['tweets'],
+        "request": result['request'],
+        "response": result['response']
+    }
+    if result.get('proxy_unreachable'):
+        response["proxy_unreachable"] = True
+    if result.get('error_code') == 'rate_limited':
+        response["error_code"] = "rate_limited"
+        response["retry_after"] = result['retry_after']
+        response["expected_send_at"] = result['expected_send_at']
+        return response, 429
+    if result.get('error_code') == 'deadline_exceeded':
+        response["error_code"] = "deadline_exceeded"
+        response["phase"] = result['phase']
+        return response, 504
+    return response, 500
+
+
+def _exception_response(data, error_message, proxy_error=None):
+    """
+    Response body and status code for an exception raised while posting
+    """
+    error_response = {
+        "status": "error",
+        "message": error_message,
+        "request": {
+            "credentials": {
+                "api_key": data['api_key'],
+                "api_secret": "***" + data['api_secret'][-4:] if len(data['api_secret']) > 4 else "***",
+                "access_token": data['access_token'],
+                "access_secret": "***" + data['access_secret'][-4:] if len(data['access_secret']) > 4 else "***"
+            },
+            "text": data['text'],
+            "has_image": bool(data.get('images')) or ('image' in data and data['image'] is not None),
+            "proxy_settings": data.get('proxy')
+        }
+    }
+
+    if proxy_error:
+        error_response["proxy_error"] = proxy_error
+
+    return error_response, 500
+
+
+def _deadline_response(data, error):
+    """
+    Response body and status code for a post stopped by its deadline
+    """
+    error_response, _ = _exception_response(data, str(error))
+    error_response["error_code"] = "deadline_exceeded"
+    error_response["phase"] = error.phase
+    return error_response, 504
+
+
+def _execute_post(data):
+    # Initialize Twitter service with credentials
+    twitter_service = TwitterService(
+        api_key=data['api_key'],
+        api_secret=data['api_secret'],
+        access_token=data['access_token'],
+        access_secret=data['access_secret'],
+        proxy=data.get('proxy')
+    )
+
+    # Post tweet
+    try:
+        result = twitter_service.post_tweet(data['text'], _image_data(data))
+        return _result_response(result)
+
+    except Exception as e:
+        exceeded = deadline_error(e)
+        if exceeded is not None:
+            return _deadline_response(data, exceeded)
+        error_message = str(e)
+
+        proxy_error = None
+        if _looks_like_proxy_error(data, error_message):
+            try:
+                # Attempt to directly test proxy connection
+                proxy_working, proxy_error = twitter_service.proxy_health.check(
+                    data.get('proxy'), twitter_service._test_proxy_connection
+                )
+                if not proxy_working:
+                    error_message = f"Proxy connection test failed: {proxy_error}"
+            except Exception as proxy_test_error:
+                proxy_error = str(proxy_test_error)
+
+        return _exception_response(data, error_message, proxy_error)
+    finally:
+        twitter_service.close()
+
+
+async def _execute_post_async(data):
+    twitter_service = AsyncTwitterService(
+        api_key=data['api_key'],
+        api_secret=data['api_secret'],
+        access_token=data['access_token'],
+        access_secret=data['access_secret'],
+        proxy=data.get('proxy')
+    )
+    try:
+        result = await twitter_service.post_tweet(data['text'], _image_data(data))
+        return _result_response(result)
+    except DeadlineExceeded as e:
+        return _deadline_response(data, e)
+    except Exception as e:
+        error_message = str(e)
+        proxy_error = None
+        if _looks_like_proxy_error(data, error_message):
+            try:
+                proxy_working, proxy_error = await twitter_service.proxy_health.check_async(
+                    data.get('proxy'), twitter_service._test_proxy_connection_async
+                )
+                if not proxy_working:
+                    error_message = f"Proxy connection test failed: {proxy_error}"
+            except Exception as proxy_test_error:
+                proxy_error = str(proxy_test_error)
+        return _exception_response(data, error_message, proxy_error)
+
+
+def _execute_thread(data, posted, on_posted):
+    twitter_service = TwitterService(
+        api_key=data['api_key'],
+        api_secret=data['api_secret'],
+        access_token=data['access_token'],
+        access_secret=data['access_secret'],
+        proxy=data.get('proxy')
+    )
+    tweets = [(tweet['text'], _image_data(tweet)) for tweet in data['tweets']]
+    try:
+        result = twitter_service.post_thread(tweets, data.get('in_reply_to_tweet_id'), posted, on_posted)
+    finally:
+        twitter_service.close()
+    return _thread_response(result)
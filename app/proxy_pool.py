@@ -0,0 +1,393 @@
+# Named proxy pools with weighted selection, circuit breakers and failover
+import json
+import math
+import random
+import threading
+import time
+
+from app import config, metrics
+from app.proxy_health import mask_proxy_settings
+
+# Message prefix of posts that failed because their proxy is unreachable
+PROXY_FAILURE_PREFIX = "Proxy connection test failed"
+
+# Smoothing factor of the latency and success rate averages
+EWMA_ALPHA = 0.2
+# Assumed latency of a proxy before its first post, in seconds
+INITIAL_LATENCY = 1.0
+# Floor of the success rate, so a recovered proxy is still picked now and then
+MIN_SUCCESS_RATE = 0.05
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def proxy_settings(entry):
+    """
+    Normalize a pool entry to the proxy configuration accepted by TwitterService
+
+    Args:
+        entry: Proxy configuration dict, or a proxy URL string
+
+    Returns:
+        dict: Proxy configuration
+
+    Raises:
+        ValueError: If the entry is neither
+    """
+    if isinstance(entry, str) and '://' in entry:
+        if entry.lower().startswith('socks5'):
+            return {'socks5': entry}
+        return {'http': entry, 'https': entry}
+    if isinstance(entry, dict) and entry and all(isinstance(value, str) for value in entry.values()):
+        return dict(entry)
+    raise ValueError(f"Invalid proxy in pool: {mask_proxy_settings(entry)!r}")
+
+
+def account_user_id(access_token):
+    """
+    Twitter user ID of an account, the prefix of its OAuth access token
+
+    Returns:
+        str: User ID, or None if the token does not carry one
+    """
+    user_id = str(access_token or '').split('-', 1)[0]
+    return user_id if user_id.isdigit() else None
+
+
+class _PooledProxy:
+    __slots__ = ('settings', 'latency', 'success_rate', 'state', 'failures', 'trips',
+                 'open_until', 'trial', 'requests', 'errors')
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.latency = None
+        self.success_rate = 1.0
+        self.state = CLOSED
+        # Consecutive failures, reset by a success
+        self.failures = 0
+        # Consecutive openings of the circuit, each doubles the cooldown
+        self.trips = 0
+        self.open_until = 0.0
+        # A half-open circuit lets a single post through
+        self.trial = False
+        self.requests = 0
+        self.errors = 0
+
+
+class ProxyPool:
+    """
+    Named set of interchangeable proxies
+
+    Proxies are picked at random, weighted by their success rate divided by
+    their average post latency, so fast and reliable proxies carry most of
+    the traffic. After breaker_failures consecutive failures a proxy's
+    circuit opens and it leaves rotation for breaker_cooldown seconds,
+    doubled every time it fails again, up to breaker_cooldown_max. It then
+    half-opens: one post goes through it, and its outcome closes or reopens
+    the circuit.
+    """
+
+    def __init__(self, name, proxies, breaker_failures=None, breaker_cooldown=None,
+                 breaker_cooldown_max=None, failover_attempts=None):
+        """
+        Args:
+            name (str): Pool name
+            proxies (list): Proxy configurations or URLs
+            breaker_failures (int, optional): Consecutive failures that open a circuit
+            breaker_cooldown (float, optional): First cooldown of an open circuit in seconds
+            breaker_cooldown_max (float, optional): Longest cooldown in seconds
+            failover_attempts (int, optional): Proxies tried by one post
+        """
+        if not proxies:
+            raise ValueError(f"Proxy pool '{name}' is empty")
+        self.name = name
+        self.breaker_failures = config.PROXY_BREAKER_FAILURES if breaker_failures is None else breaker_failures
+        self.breaker_cooldown = config.PROXY_BREAKER_COOLDOWN if breaker_cooldown is None else breaker_cooldown
+        self.breaker_cooldown_max = config.PROXY_BREAKER_COOLDOWN_MAX \
+            if breaker_cooldown_max is None else breaker_cooldown_max
+        self.failover_attempts = config.PROXY_FAILOVER_ATTEMPTS if failover_attempts is None else failover_attempts
+        self._proxies = [_PooledProxy(proxy_settings(entry)) for entry in proxies]
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._failovers = 0
+        self._unavailable = 0
+
+    def acquire(self, exclude=()):
+        """
+        Pick a proxy for the next attempt of a post
+
+        Args:
+            exclude (iterable): Proxies (as returned by acquire) already tried by the post
+
+        Returns:
+            _PooledProxy: Proxy to use, or None if none is in rotation
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for proxy in self._proxies:
+                if proxy in exclude:
+                    continue
+                if proxy.state == OPEN and now >= proxy.open_until:
+                    proxy.state = HALF_OPEN
+                    proxy.trial = False
+                if proxy.state == CLOSED or (proxy.state == HALF_OPEN and not proxy.trial):
+                    candidates.append(proxy)
+            if not candidates:
+                return None
+
+            # Try recovering proxies first, otherwise they would never get their trial post
+            half_open = [proxy for proxy in candidates if proxy.state == HALF_OPEN]
+            if half_open:
+                proxy = half_open[0]
+                proxy.trial = True
+                return proxy
+
+            default_latency = self._mean_latency()
+            weights = [max(proxy.success_rate, MIN_SUCCESS_RATE) / max(proxy.latency or default_latency, 0.001)
+                       for proxy in candidates]
+            return self._random.choices(candidates, weights)[0]
+
+    def release(self, proxy, success, latency):
+        """
+        Record the outcome of a post through a proxy
+
+        Args:
+            proxy (_PooledProxy): Proxy returned by acquire()
+            success (bool): False if the post failed because of the proxy
+            latency (float): Duration of the attempt in seconds
+        """
+        with self._lock:
+            proxy.requests += 1
+            proxy.success_rate += EWMA_ALPHA * ((1.0 if success else 0.0) - proxy.success_rate)
+            if success:
+                proxy.latency = latency if proxy.latency is None else \
+                    proxy.latency + EWMA_ALPHA * (latency - proxy.latency)
+                proxy.state = CLOSED
+                proxy.failures = 0
+                proxy.trips = 0
+                return
+
+            proxy.errors += 1
+            proxy.failures += 1
+            if proxy.state == HALF_OPEN or proxy.failures >= self.breaker_failures:
+                proxy.trips += 1
+                cooldown = min(self.breaker_cooldown * 2 ** (proxy.trips - 1), self.breaker_cooldown_max)
+                proxy.state = OPEN
+                proxy.open_until = time.monotonic() + cooldown
+
+    def retry_after(self):
+        """
+        Seconds until a proxy of the pool is back in rotation
+        """
+        now = time.monotonic()
+        with self._lock:
+            return max(0.0, min(proxy.open_until for proxy in self._proxies) - now)
+
+    def run(self, data, post_function):
+        """
+        Post through the pool, failing over to another proxy when one is unreachable
+
+        Only posts marked proxy_unreachable are retried: they failed the proxy
+        connection test or client creation, before anything was sent to
+        Twitter. A post whose proxy failed later may have created the tweet;
+        it counts against the breaker of its proxy but is not retried. An
+        exception escaping post_function counts as a failure of the proxy.
+
+        Args:
+            data (dict): Validated request body without a proxy
+            post_function (callable): post_function(data) -> (response body, status code)
+
+        Returns:
+            tuple: (response body dict, HTTP status code)
+        """
+        tried = []
+        response = None
+        while len(tried) < self.failover_attempts:
+            proxy = self.acquire(tried)
+            if proxy is None:
+                break
+            tried.append(proxy)
+            started = time.monotonic()
+            try:
+                response = post_function(dict(data, proxy=proxy.settings))
+            except BaseException:
+                # Give the proxy back, a half-open one would otherwise keep its trial forever
+                self.release(proxy, False, time.monotonic() - started)
+                raise
+            if self._finish(proxy, response, started):
+                break
+        return self._response(response, len(tried))
+
+    async def run_async(self, data, post_function):
+        """
+        Same as run() for a coroutine function
+        """
+        tried = []
+        response = None
+        while len(tried) < self.failover_attempts:
+            proxy = self.acquire(tried)
+            if proxy is None:
+                break
+            tried.append(proxy)
+            started = time.monotonic()
+            try:
+                response = await post_function(dict(data, proxy=proxy.settings))
+            except BaseException:
+                self.release(proxy, False, time.monotonic() - started)
+                raise
+            if self._finish(proxy, response, started):
+                break
+        return self._response(response, len(tried))
+
+    def _finish(self, proxy, response, started):
+        self.release(proxy, not is_proxy_failure(response[0]), time.monotonic() - started)
+        if not response[0].get('proxy_unreachable'):
+            return True
+        with self._lock:
+            self._failovers += 1
+        metrics.record_failover(self.name)
+        return False
+
+    def _response(self, response, attempts):
+        if response is None:
+            with self._lock:
+                self._unavailable += 1
+            return {
+                "status": "error",
+                "error_code": "proxy_pool_unavailable",
+                "message": f"No proxy of pool '{self.name}' is available",
+                "retry_after": math.ceil(self.retry_after())
+            }, 503
+        body, status_code = response
+        body["proxy_pool"] = {"name": self.name, "attempts": attempts}
+        return body, status_code
+
+    def _mean_latency(self):
+        latencies = [proxy.latency for proxy in self._proxies if proxy.latency is not None]
+        return sum(latencies) / len(latencies) if latencies else INITIAL_LATENCY
+
+    def status(self):
+        """
+        Describe the pool and the state of its proxies (passwords masked)
+
+        Returns:
+            dict: Pool counters and one dict per proxy
+        """
+        now = time.monotonic()
+        with self._lock:
+            proxies = [{
+                "proxy": mask_proxy_settings(proxy.settings),
+                "state": proxy.state if proxy.state != OPEN or now < proxy.open_until else HALF_OPEN,
+                "latency_ms": round(proxy.latency * 1000, 1) if proxy.latency is not None else None,
+                "success_rate": round(proxy.success_rate, 3),
+                "requests": proxy.requests,
+                "errors": proxy.errors,
+                "retry_in": round(proxy.open_until - now, 1) if proxy.state == OPEN and now < proxy.open_until else 0
+            } for proxy in self._proxies]
+            return {
+                "proxies": proxies,
+                "available": sum(1 for proxy in proxies if proxy["state"] != OPEN),
+                "failovers": self._failovers,
+                "unavailable": self._unavailable
+            }
+
+
+def is_proxy_failure(body):
+    """
+    Whether a post failed because of its proxy, before or after it was sent
+    """
+    if body.get('proxy_unreachable'):
+        return True
+    message = body.get('error') or body.get('message') or ''
+    return isinstance(message, str) and message.startswith(PROXY_FAILURE_PREFIX)
+
+
+class ProxyPools:
+    """
+    Registry of the configured pools and of the account to pool affinities
+    """
+
+    def __init__(self, pools=None, accounts=None, default=None, **pool_options):
+        """
+        Args:
+            pools (dict, optional): Pool name to list of proxy configurations or URLs
+            accounts (dict, optional): Twitter user ID to pool name
+            default (str, optional): Pool of accounts without affinity
+            pool_options: Breaker and failover settings passed to every ProxyPool
+        """
+        self.pools = {name: ProxyPool(name, proxies, **pool_options) for name, proxies in (pools or {}).items()}
+        self.accounts = {str(user_id): name for user_id, name in (accounts or {}).items()}
+        self.default = default or None
+        for name in list(self.accounts.values()) + ([self.default] if self.default else []):
+            if name not in self.pools:
+                raise ValueError(f"Unknown proxy pool: {name}")
+
+    @classmethod
+    def from_json(cls, document):
+        """
+        Build the registry from a JSON document
+
+        Args:
+            document (str): {"pools": {...}, "accounts": {...}, "default": "..."}
+
+        Raises:
+            ValueError: If the document is invalid
+        """
+        settings = json.loads(document) if document else {}
+        if not isinstance(settings, dict) or not isinstance(settings.get('pools', {}), dict) \
+                or not isinstance(settings.get('accounts', {}), dict):
+            raise ValueError("Proxy pools must be a JSON object with 'pools' and 'accounts' objects")
+        return cls(settings.get('pools'), settings.get('accounts'), settings.get('default'))
+
+    def get(self, name):
+        return self.pools.get(name)
+
+    def for_post(self, data):
+        """
+        Pool a post goes through
+
+        An explicit proxy wins, then the pool named in the request, then the
+        pool of the account, then the default pool.
+
+        Args:
+            data (dict): Validated request body
+
+        Returns:
+            ProxyPool: Pool to post through, or None to use the request as is
+        """
+        if data.get('proxy'):
+            return None
+        name = data.get('proxy_pool') or self.accounts.get(account_user_id(data.get('access_token'))) \
+            or self.default
+        return self.pools.get(name) if name else None
+
+    def status(self):
+        return {
+            "pools": {name: pool.status() for name, pool in self.pools.items()},
+            "accounts": len(self.accounts),
+            "default": self.default
+        }
+
+
+_default_pools = None
+_default_pools_lock = threading.Lock()
+
+
+def get_proxy_pools():
+    """
+    Return the process-wide pool registry, read from PROXY_POOLS_FILE or PROXY_POOLS
+    """
+    global _default_pools
+    if _default_pools is None:
+        with _default_pools_lock:
+            if _default_pools is None:
+                if config.PROXY_POOLS_FILE:
+                    with open(config.PROXY_POOLS_FILE, encoding='utf-8') as pools_file:
+                        document = pools_file.read()
+                else:
+                    document = config.PROXY_POOLS
+                _default_pools = ProxyPools.from_json(document)
+    return _default_pools
@@ -0,0 +1,283 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+from app import config
+
+# Accounts and apps tracked at most; the least recently used are forgotten
+MAX_TRACKED_KEYS = 100000
+
+# Path of the v2 create_tweet endpoint whose rate-limit headers are tracked
+CREATE_TWEET_PATH = '/2/tweets'
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when a post cannot be sent before the rate limit allows it
+
+    Attributes:
+        retry_after (int): Seconds until the post is expected to be sendable
+        expected_send_at (str): Same moment as an ISO 8601 UTC timestamp
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+        self.expected_send_at = (
+            datetime.now(timezone.utc) + timedelta(seconds=retry_after)
+        ).isoformat(timespec='seconds')
+
+
+class TokenBucket:
+    """
+    Token bucket allowing capacity posts per window seconds
+    """
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated_at')
+
+    def __init__(self, capacity, window):
+        self.capacity = float(capacity)
+        self.rate = capacity / window
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        # May go below zero when the caller decided to wait for the token
+        self.tokens -= 1
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class _LimitState:
+    __slots__ = ('bucket', 'blocked_until', 'consecutive_429', 'remaining', 'limit')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        self.consecutive_429 = 0
+        self.remaining = None
+        self.limit = None
+
+
+class RateLimiter:
+    """
+    Per-account and per-app posting scheduler
+
+    Every post reserves a token from its account bucket (and app bucket when
+    configured). The buckets are corrected by the x-rate-limit-* headers of
+    the platform responses; a 429 blocks the account until the reported
+    reset or, without headers, for a jittered exponential backoff. Callers
+    learn how long a post has to wait and can defer it instead of sending a
+    request that would be rejected.
+    """
+
+    def __init__(self, account_posts=None, account_window=None, app_posts=None,
+                 app_window=None, backoff_base=None, backoff_max=None):
+        """
+        Args:
+            account_posts (int, optional): Posts allowed per account per account_window
+            account_window (float, optional): Account bucket window in seconds
+            app_posts (int, optional): Posts allowed per app per app_window, 0 disables the app bucket
+            app_window (float, optional): App bucket window in seconds
+            backoff_base (float, optional): First backoff after a 429 without reset header
+            backoff_max (float, optional): Longest backoff
+        """
+        self.account_posts = config.RATE_LIMIT_ACCOUNT_POSTS if account_posts is None else account_posts
+        self.account_window = config.RATE_LIMIT_ACCOUNT_WINDOW if account_window is None else account_window
+        self.app_posts = config.RATE_LIMIT_APP_POSTS if app_posts is None else app_posts
+        self.app_window = config.RATE_LIMIT_APP_WINDOW if app_window is None else app_window
+        self.backoff_base = config.RATE_LIMIT_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = config.RATE_LIMIT_BACKOFF_MAX if backoff_max is None else backoff_max
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.deferred = 0
+        self.rejected_by_platform = 0
+
+    def reserve(self, account, app=None, max_wait=0.0):
+        """
+        Reserve a posting slot for account (and app)
+
+        Args:
+            account (str): Account identifier
+            app (str, optional): App identifier
+            max_wait (float): Longest acceptable wait in seconds
+
+        Returns:
+            tuple: (reserved, wait seconds). When reserved is False nothing was
+                consumed and wait is the expected time until the post can be sent.
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = [self._state(('account', account), self.account_posts, self.account_window)]
+            if app is not None and self.app_posts > 0:
+                states.append(self._state(('app', app), self.app_posts, self.app_window))
+
+            wait = 0.0
+            for state in states:
+                wait = max(wait, state.blocked_until - now, state.bucket.wait_time(now))
+
+            if wait > max_wait:
+                self.deferred += 1
+                return False, wait
+
+            for state in states:
+                state.bucket.consume()
+            return True, wait
+
+    def refund(self, account, app=None):
+        """
+        Give back a slot taken by reserve() for a post that never reached the platform
+
+        Args:
+            account (str): Account identifier passed to reserve()
+            app (str, optional): App identifier passed to reserve()
+        """
+        with self._lock:
+            keys = [('account', account)]
+            if app is not None and self.app_posts > 0:
+                keys.append(('app', app))
+            for key in keys:
+                state = self._states.get(key)
+                if state is not None:
+                    state.bucket.refund()
+
+    def update_from_headers(self, account, headers):
+        """
+        Align the account with the x-rate-limit-* headers of a create_tweet response
+        """
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        limit = headers.get('x-rate-limit-limit')
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset_in = max(0.0, int(reset) - time.time()) if reset is not None else None
+        except ValueError:
+            return
+
+        with self._lock:
+            state = self._state(('account', account), self.account_posts, self.account_window)
+            state.remaining = remaining
+            state.limit = int(limit) if limit is not None and limit.isdigit() else state.limit
+            # Never believe we have more tokens than the platform says are left
+            state.bucket.tokens = min(state.bucket.tokens, float(remaining))
+            if remaining <= 0 and reset_in is not None:
+                state.blocked_until = max(state.blocked_until, time.monotonic() + reset_in + random.uniform(0, 1))
+
+    def record_success(self, account):
+        with self._lock:
+            state = self._states.get(('account', account))
+            if state is not None:
+                state.consecutive_429 = 0
+
+    def record_rate_limited(self, account, headers=None):
+        """
+        Block an account after a 429 from the platform
+
+        Returns:
+            float: Seconds until the account may post again
+        """
+        headers = headers or {}
+        now = time.monotonic()
+        with self._lock:
+            self.rejected_by_platform += 1
+            state = self._state(('account', account), self.account_posts, self.account_window)
+            state.consecutive_429 += 1
+            state.bucket.tokens = min(state.bucket.tokens, 0.0)
+
+            delay = None
+            reset = headers.get('x-rate-limit-reset')
+            if reset is not None:
+                try:
+                    delay = max(0.0, int(reset) - time.time()) + random.uniform(0, 1)
+                except ValueError:
+                    delay = None
+            if delay is None:
+                # Full jitter keeps retries of many accounts from lining up
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** (state.consecutive_429 - 1))
+                delay = random.uniform(backoff / 2, backoff)
+
+            state.blocked_until = max(state.blocked_until, now + delay)
+            return state.blocked_until - now
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "tracked": len(self._states),
+                "blocked": sum(1 for state in self._states.values() if state.blocked_until > now),
+                "deferred": self.deferred,
+                "rejected_by_platform": self.rejected_by_platform
+            }
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+    def _state(self, key, posts, window):
+        state = self._states.get(key)
+        if state is None:
+            state = _LimitState(TokenBucket(posts, window))
+            self._states[key] = state
+            if len(self._states) > MAX_TRACKED_KEYS:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(key)
+        return state
+
+
+def make_response_hook(limiter, account):
+    """
+    Build a requests response hook feeding create_tweet rate-limit headers to limiter
+
+    Args:
+        limiter (RateLimiter): Limiter to update
+        account (str): Account the session posts for
+
+    Returns:
+        callable: Hook for session.hooks['response']
+    """
+    def hook(response, *args, **kwargs):
+        if response.request.method != 'POST' or urlparse(response.url).path != CREATE_TWEET_PATH:
+            return
+        limiter.update_from_headers(account, response.headers)
+        if response.status_code < 400:
+            limiter.record_success(account)
+    return hook
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Return the process-wide rate limiter, or None when RATE_LIMIT_ENABLED is off
+    """
+    global _default_limiter
+    if not config.RATE_LIMIT_ENABLED:
+        return None
+    if _default_limiter is None:
+        with _default_limiter_lock:
+            if _default_limiter is None:
+                _default_limiter = RateLimiter()
+    return _default_limiter
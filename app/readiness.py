@@ -0,0 +1,209 @@
+# Readiness of a worker process and admission control of the posting endpoints
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from app import config
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a worker has no capacity left for another post
+
+    Attributes:
+        retry_after (int): Seconds after which the client should try again
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LoadMonitor:
+    """
+    Load of this worker process, and whether it should get more traffic
+
+    Posting endpoints take a slot with admit() and are turned away with 503
+    once max_in_flight posts are running, so a saturated worker sheds load
+    instead of queueing it. The readiness snapshot is refreshed every
+    refresh_interval seconds by a background thread, from in-memory counters
+    and the cached proxy checks; serving it never probes or queries anything.
+    """
+
+    def __init__(self, max_in_flight=None, retry_after=None, error_window=None, max_error_rate=None,
+                 min_requests=None, max_queue_ratio=None, refresh_interval=None):
+        """
+        Args:
+            max_in_flight (int, optional): Posts running at once before new ones are shed, 0 disables shedding
+            retry_after (int, optional): Retry-After of shed requests, in seconds
+            error_window (float, optional): Seconds of results the error rate is computed over
+            max_error_rate (float, optional): Share of 5xx results above which the worker is not ready
+            min_requests (int, optional): Results needed in the window before the error rate counts
+            max_queue_ratio (float, optional): Fill level of the job queue above which the worker is not ready
+            refresh_interval (float, optional): Seconds between snapshots, 0 refreshes on every read
+        """
+        if max_in_flight is None:
+            # Default: three quarters of the threads (greenlets under gevent), the rest serves /ready,
+            # /health and job polls
+            concurrency = config.GUNICORN_WORKER_CONNECTIONS if config.GUNICORN_WORKER_CLASS == 'gevent' \
+                else config.GUNICORN_THREADS
+            max_in_flight = config.ADMISSION_MAX_IN_FLIGHT or max(1, concurrency * 3 // 4)
+        self.max_in_flight = max_in_flight
+        self.retry_after = config.ADMISSION_RETRY_AFTER if retry_after is None else retry_after
+        self.error_window = config.READY_ERROR_WINDOW if error_window is None else error_window
+        self.max_error_rate = config.READY_MAX_ERROR_RATE if max_error_rate is None else max_error_rate
+        self.min_requests = config.READY_MIN_REQUESTS if min_requests is None else min_requests
+        self.max_queue_ratio = config.READY_MAX_QUEUE_RATIO if max_queue_ratio is None else max_queue_ratio
+        self.refresh_interval = config.READY_REFRESH_INTERVAL if refresh_interval is None else refresh_interval
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        # (monotonic time, failed) of recent results, oldest first
+        self._results = deque()
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    @contextmanager
+    def admit(self, slots=1):
+        """
+        Hold slots for the duration of a request: one per post it runs at once
+
+        Args:
+            slots (int): Posts the request runs concurrently, e.g. the concurrency of a batch
+
+        Raises:
+            OverloadedError: If fewer than slots are free
+        """
+        with self._lock:
+            if self.max_in_flight and self.in_flight + slots > self.max_in_flight:
+                self.shed += 1
+                raise OverloadedError(
+                    f"Server is at capacity ({self.max_in_flight} posts in flight), retry later", self.retry_after
+                )
+            self.in_flight += slots
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= slots
+
+    def record_result(self, status_code):
+        """
+        Count the HTTP status of an admitted request towards the error rate; 5xx are errors
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._results.append((now, status_code >= 500))
+            self._expire_results(now)
+
+    def ready(self):
+        """
+        Readiness of the worker, from the last snapshot and the live in-flight count
+
+        Returns:
+            tuple: (ready, dict with status, checks and the age of the snapshot)
+        """
+        snapshot = self._current_snapshot()
+        with self._lock:
+            in_flight = self.in_flight
+        checks = dict(snapshot["checks"], capacity={
+            "ok": not self.max_in_flight or in_flight < self.max_in_flight,
+            "in_flight": in_flight,
+            "max_in_flight": self.max_in_flight
+        })
+        ready = all(check["ok"] for check in checks.values())
+        return ready, {
+            "status": "ready" if ready else "unavailable",
+            "checks": checks,
+            "checked_seconds_ago": round(time.monotonic() - snapshot["checked_at"], 1)
+        }
+
+    def refresh(self):
+        """
+        Take a new snapshot of the error rate, the job queue and the proxies
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire_results(now)
+            requests = len(self._results)
+            errors = sum(1 for _, failed in self._results if failed)
+        error_rate = errors / requests if requests else 0.0
+        self._snapshot = {
+            "checked_at": now,
+            "checks": {
+                "errors": {
+                    "ok": requests < self.min_requests or error_rate <= self.max_error_rate,
+                    "error_rate": round(error_rate, 4),
+                    "requests": requests,
+                    "window": self.error_window
+                },
+                "queue": self._queue_check(),
+                "proxies": self._proxy_check()
+            }
+        }
+        return self._snapshot
+
+    def gauges(self):
+        """
+        Admission gauges and counters as [(name, documentation, value[, kind])] for metrics.register_collector()
+        """
+        with self._lock:
+            return [
+                ('admission_in_flight', 'Posts holding an admission slot', self.in_flight),
+                ('admission_max_in_flight', 'Posts admitted at once before new ones are shed', self.max_in_flight),
+                ('admission_shed_total', 'Requests answered 503 because the worker was at capacity', self.shed,
+                 'counter')
+            ]
+
+    def _current_snapshot(self):
+        if self.refresh_interval <= 0:
+            return self.refresh()
+        if self._refresher is None or not self._refresher.is_alive():
+            with self._lock:
+                if self._refresher is None or not self._refresher.is_alive():
+                    self._refresher = threading.Thread(target=self._run_refresher, name='readiness', daemon=True)
+                    self._refresher.start()
+        snapshot = self._snapshot
+        # Only the first read after start waits for a snapshot
+        return snapshot if snapshot is not None else self.refresh()
+
+    def _run_refresher(self):
+        current = threading.current_thread()
+        while self._refresher is current:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+    def _expire_results(self, now):
+        cutoff = now - self.error_window
+        while self._results and self._results[0][0] < cutoff:
+            self._results.popleft()
+
+    def _queue_check(self):
+        # Only a queue this process already uses, readiness never creates one
+        manager = _loaded('app.jobs', '_default_manager')
+        if manager is None:
+            return {"ok": True, "pending": 0, "limit": None}
+        stats = manager.stats()
+        limit = stats.get('max_pending', stats.get('queue_size'))
+        return {
+            "ok": not limit or stats['pending'] < limit * self.max_queue_ratio,
+            "pending": stats['pending'],
+            "limit": limit
+        }
+
+    def _proxy_check(self):
+        # Cached results of the proxy health registry; fails only when every known proxy is down
+        registry = _loaded('app.proxy_health', '_default_registry')
+        states = registry.status() if registry is not None else []
+        healthy = sum(1 for state in states if state["healthy"])
+        failing = sum(1 for state in states if state["healthy"] is False)
+        return {"ok": healthy > 0 or failing == 0, "healthy": healthy, "failing": failing}
+
+
+def _loaded(module_name, attribute):
+    module = sys.modules.get(module_name)
+    return getattr(module, attribute) if module is not None else None
@@ -0,0 +1,96 @@
+# Encoding of post responses, and the lean variant without the echoed details
+import json
+
+from app import config
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is used without it
+    orjson = None
+
+# Fields of a successful post (or thread) kept in lean responses
+MINIMAL_SUCCESS_FIELDS = ('status', 'tweet_id', 'tweet_url', 'thread_id', 'tweets')
+# Echo of the request and of the Twitter calls, dropped from lean responses
+DETAIL_FIELDS = ('request', 'response')
+
+
+def dumps(payload):
+    """
+    Encode a response body as compact JSON, with orjson when it is installed
+
+    Args:
+        payload: JSON serializable value
+
+    Returns:
+        bytes: UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Integers beyond 64 bits and other values only the standard encoder handles
+            pass
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def is_verbose(field=None, query=None, prefer=None):
+    """
+    Whether a response carries the request and response details
+
+    An explicit verbose field or query parameter wins over the Prefer
+    header (return=minimal or return=representation), which wins over
+    RESPONSE_VERBOSE.
+
+    Args:
+        field (bool, optional): verbose field of the request body
+        query (str, optional): verbose query parameter
+        prefer (str, optional): Prefer header
+
+    Returns:
+        bool: True for the full response
+    """
+    if isinstance(field, bool):
+        return field
+    if query is not None:
+        return query.strip().lower() in ('1', 'true', 'yes', 'on')
+    preferences = [preference.strip().lower() for preference in (prefer or '').split(',')]
+    if 'return=minimal' in preferences:
+        return False
+    if 'return=representation' in preferences:
+        return True
+    return config.RESPONSE_VERBOSE
+
+
+def shape_response(body, verbose):
+    """
+    Drop the echoed request and response details from a post response
+
+    Successful posts keep status, tweet_id and tweet_url, threads also their
+    thread_id and tweets; errors keep everything but the details, so error
+    codes and retry hints survive.
+
+    Args:
+        body (dict): Response body of a post
+        verbose (bool): Return the body unchanged
+
+    Returns:
+        dict: Response body to send
+    """
+    if verbose or not isinstance(body, dict):
+        return body
+    if body.get('status') == 'success':
+        return {field: body[field] for field in MINIMAL_SUCCESS_FIELDS if field in body}
+    return {field: value for field, value in body.items() if field not in DETAIL_FIELDS}
+
+
+def shape_job(job, verbose):
+    """
+    Same as shape_response() for the results held by a job
+    """
+    if verbose or job is None:
+        return job
+    job = dict(job)
+    for field in ('result', 'last_result'):
+        if field in job:
+            job[field] = shape_response(job[field], False)
+    return job
@@ -0,0 +1,105 @@
+# Process lifecycle: background services, and reinitialization of forked workers
+import os
+import sys
+import threading
+
+from app import config
+
+# Process-wide singletons: (module, attribute, lock guarding their creation)
+SINGLETONS = [
+    ('app.accounts', '_default_registry', '_default_registry_lock'),
+    ('app.async_service', '_default_pool', '_default_pool_lock'),
+    ('app.client_pool', '_default_pool', '_default_pool_lock'),
+    ('app.dedup', '_default_index', '_default_index_lock'),
+    ('app.idempotency', '_default_store', '_default_store_lock'),
+    ('app.jobs', '_default_manager', '_default_manager_lock'),
+    ('app.media', '_upload_executor', '_upload_executor_lock'),
+    ('app.media_cache', '_default_cache', '_default_cache_lock'),
+    ('app.proxy_health', '_default_registry', '_default_registry_lock'),
+    ('app.proxy_pool', '_default_pools', '_default_pools_lock'),
+    ('app.rate_limit', '_default_limiter', '_default_limiter_lock'),
+    ('app.scheduler', '_default_scheduler', '_default_scheduler_lock'),
+    ('app.threads', '_default_store', '_default_store_lock')
+]
+
+# Singletons inherited from the parent process. They are never used again,
+# but must not be garbage collected: closing an inherited SQLite connection
+# can drop the WAL of a database the parent still has open.
+_inherited = []
+
+_services_deferred = False
+
+
+def defer_background_services():
+    """
+    Keep start_background_services() from running in this process
+
+    Called by a master process that loads the app before forking workers
+    (gunicorn --preload): threads started there would not exist in the
+    workers, and the master must not post itself.
+    """
+    global _services_deferred
+    _services_deferred = True
+
+
+def start_background_services():
+    """
+    Start the threads that must run without waiting for a request
+
+    The outbox dispatcher resumes posts left by a previous run and the
+    scheduler dispatches posts that became due. Safe to call repeatedly.
+    """
+    if _services_deferred:
+        return
+    # Imported here, the job and scheduler modules import the posting pipeline
+    from app.jobs import get_job_manager
+    from app.scheduler import get_scheduler
+    if config.OUTBOX_ENABLED:
+        get_job_manager()
+    if config.SCHEDULE_ENABLED and os.path.exists(config.SCHEDULE_DB):
+        get_scheduler()
+
+
+def stop_background_services(wait=True):
+    """
+    Stop claiming new posts and, with wait, let the running ones finish
+
+    Used when a worker exits; posts that do not finish are recovered by the
+    next worker from the outbox and the schedule.
+    """
+    # The scheduler first, so it stops handing posts to the job queue
+    scheduler = _loaded('app.scheduler', '_default_scheduler')
+    if scheduler is not None:
+        scheduler.shutdown()
+    manager = _loaded('app.jobs', '_default_manager')
+    if manager is not None:
+        manager.shutdown(wait=wait)
+
+
+def _loaded(module_name, attribute):
+    module = sys.modules.get(module_name)
+    return getattr(module, attribute) if module is not None else None
+
+
+def reset_after_fork():
+    """
+    Forget the singletons of the parent process in a forked child
+
+    Their threads do not exist in the child and their sockets, SQLite
+    connections and locks are shared with the parent, so every singleton is
+    created again on first use.
+    """
+    global _services_deferred
+    _services_deferred = False
+    for module_name, attribute, lock_attribute in SINGLETONS:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        instance = getattr(module, attribute)
+        if instance is not None:
+            _inherited.append(instance)
+        setattr(module, attribute, None)
+        setattr(module, lock_attribute, threading.Lock())
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,377 @@
+# Scheduled posts: /post requests carrying publish_at
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app import config
+from app.jobs import QueueFullError, get_job_manager
+from app.posting import serialize_post_data
+from app.storage import SQLiteStore
+from app.uploads import read_uploads
+
+# Seconds between purges of dispatched and cancelled posts
+PURGE_INTERVAL = 60
+# Seconds before a post that could not be handed to the job queue, or a failed dispatch round, is retried
+DISPATCH_RETRY_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+
+def parse_publish_at(value):
+    """
+    Parse the publish_at field of a post request
+
+    Args:
+        value (str or number): ISO 8601 timestamp (UTC unless it has an offset) or Unix time
+
+    Returns:
+        float: Unix time
+
+    Raises:
+        ValueError: If the value is neither
+    """
+    if isinstance(value, bool):
+        raise ValueError("Field 'publish_at' must be an ISO 8601 timestamp or a Unix time")
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        moment = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError("Field 'publish_at' must be an ISO 8601 timestamp or a Unix time")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='seconds')
+
+
+class Scheduler(SQLiteStore):
+    """
+    Persistent schedule of posts, ordered by due time
+
+    Posts are rows indexed by (state, due_at), so inserting, cancelling and
+    finding the next due post are index operations and never scan the
+    schedule. The dispatcher thread sleeps until the earliest due post and
+    is woken early only when a post due sooner is scheduled. Due posts are
+    handed to the job queue (or outbox) in batches and posted like
+    asynchronous /post requests. When the queue is full they are deferred
+    by its retry_after, and a post the queue refuses with another error is
+    retried after DISPATCH_RETRY_DELAY; publish_at itself is kept.
+    """
+
+    def __init__(self, path=None, max_pending=None, batch_size=None, max_sleep=None, history_ttl=None,
+                 submit_function=None):
+        """
+        Args:
+            path (str, optional): SQLite database file
+            max_pending (int, optional): Posts allowed in the schedule
+            batch_size (int, optional): Due posts handed over per transaction
+            max_sleep (float, optional): Longest sleep of the dispatcher
+            history_ttl (float, optional): Seconds dispatched and cancelled posts are kept
+            submit_function (callable, optional): Queues a post request, returns the job dict
+        """
+        super().__init__(config.SCHEDULE_DB if path is None else path, [
+            '''
+            CREATE TABLE IF NOT EXISTS schedule (
+                id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                publish_at REAL NOT NULL,
+                due_at REAL NOT NULL,
+                text TEXT,
+                payload TEXT,
+                created_at REAL NOT NULL,
+                dispatched_at REAL,
+                job_id TEXT
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS schedule_due ON schedule (state, due_at, id)',
+            'CREATE INDEX IF NOT EXISTS schedule_dispatched ON schedule (dispatched_at)',
+            # Posts per state, kept by triggers so submit() does not count the schedule
+            'CREATE TABLE IF NOT EXISTS schedule_counts (state TEXT PRIMARY KEY, posts INTEGER NOT NULL)',
+            '''
+            CREATE TRIGGER IF NOT EXISTS schedule_insert AFTER INSERT ON schedule BEGIN
+                INSERT INTO schedule_counts (state, posts) VALUES (NEW.state, 1)
+                    ON CONFLICT (state) DO UPDATE SET posts = posts + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS schedule_update AFTER UPDATE OF state ON schedule
+            WHEN OLD.state != NEW.state BEGIN
+                UPDATE schedule_counts SET posts = posts - 1 WHERE state = OLD.state;
+                INSERT INTO schedule_counts (state, posts) VALUES (NEW.state, 1)
+                    ON CONFLICT (state) DO UPDATE SET posts = posts + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS schedule_delete AFTER DELETE ON schedule BEGIN
+                UPDATE schedule_counts SET posts = posts - 1 WHERE state = OLD.state;
+            END
+            '''
+        ])
+        self.max_pending = config.SCHEDULE_MAX_PENDING if max_pending is None else max_pending
+        self.batch_size = config.SCHEDULE_BATCH_SIZE if batch_size is None else batch_size
+        self.max_sleep = config.SCHEDULE_MAX_SLEEP if max_sleep is None else max_sleep
+        self.history_ttl = config.SCHEDULE_HISTORY_TTL if history_ttl is None else history_ttl
+        self.submit_function = submit_function or (lambda data: get_job_manager().submit(data))
+
+        self._condition = threading.Condition()
+        self._next_due = None
+        # Bumped by every submit, so a post scheduled while the dispatcher looks up the next due time is not missed
+        self._version = 0
+        self._stopped = False
+        self.dispatched = 0
+        self.deferred = 0
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name='schedule-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, data, publish_at):
+        """
+        Schedule a post request
+
+        Args:
+            data (dict): Validated request body with uploads read into bytes
+            publish_at (float): Unix time at which the post is published
+
+        Returns:
+            dict: Public view of the scheduled post
+
+        Raises:
+            QueueFullError: If max_pending posts are already scheduled
+        """
+        data = {name: value for name, value in data.items() if name not in ('publish_at', 'async', 'callback_url')}
+        payload = serialize_post_data(data)
+        schedule_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as connection:
+            pending = connection.execute("SELECT posts FROM schedule_counts WHERE state = 'scheduled'").fetchone()
+            if pending is not None and pending[0] >= self.max_pending:
+                raise QueueFullError("Schedule is full", 60)
+            connection.execute(
+                'INSERT INTO schedule (id, state, publish_at, due_at, text, payload, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (schedule_id, 'scheduled', publish_at, publish_at, data.get('text'), payload, now)
+            )
+        with self._condition:
+            self._version += 1
+            if self._next_due is None or publish_at < self._next_due:
+                self._condition.notify()
+        return self._view(schedule_id, 'scheduled', publish_at, data.get('text'), now, None, None)
+
+    def get(self, schedule_id):
+        """
+        Return the public view of a scheduled post, or None if it is unknown or expired
+        """
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                'SELECT id, state, publish_at, text, created_at, dispatched_at, job_id FROM schedule WHERE id = ?',
+                (schedule_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        post = self._view(*row)
+        if post['job_id']:
+            post['job'] = get_job_manager().get(post['job_id'])
+        return post
+
+    def list(self, limit=100, after=None):
+        """
+        Scheduled posts in the order they are due
+
+        Args:
+            limit (int): Maximum number of posts returned
+            after (str, optional): schedule_id of the last post of the previous page
+
+        Returns:
+            list: Public views of the posts
+        """
+        with self.transaction(write=False) as connection:
+            if after is None:
+                rows = connection.execute(
+                    "SELECT id, state, publish_at, text, created_at, dispatched_at, job_id FROM schedule "
+                    "WHERE state = 'scheduled' ORDER BY due_at, id LIMIT ?", (limit,)
+                ).fetchall()
+            else:
+                rows = connection.execute(
+                    "SELECT id, state, publish_at, text, created_at, dispatched_at, job_id FROM schedule "
+                    "WHERE state = 'scheduled' AND (due_at, id) > (SELECT due_at, id FROM schedule WHERE id = ?) "
+                    "ORDER BY due_at, id LIMIT ?", (after, limit)
+                ).fetchall()
+        return [self._view(*row) for row in rows]
+
+    def cancel(self, schedule_id):
+        """
+        Cancel a post that has not been handed to the job queue yet
+
+        Returns:
+            dict: Public view of the post, or None if it is unknown
+
+        Raises:
+            ValueError: If the post was already dispatched or cancelled
+        """
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT id, state, publish_at, text, created_at, dispatched_at, job_id FROM schedule WHERE id = ?',
+                (schedule_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] != 'scheduled':
+                raise ValueError(f"Scheduled post is already {row[1]}")
+            now = time.time()
+            connection.execute(
+                "UPDATE schedule SET state = 'cancelled', payload = NULL, dispatched_at = ? WHERE id = ?",
+                (now, schedule_id)
+            )
+        return self._view(row[0], 'cancelled', row[2], row[3], row[4], now, None)
+
+    def stats(self):
+        with self.transaction(write=False) as connection:
+            counts = dict(connection.execute('SELECT state, posts FROM schedule_counts').fetchall())
+        return {
+            "scheduled": counts.get('scheduled', 0),
+            "dispatched": self.dispatched,
+            "deferred": self.deferred,
+            "next_due_at": _isoformat(self._next_due) if self._next_due is not None else None
+        }
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._dispatcher.join()
+
+    def _view(self, schedule_id, state, publish_at, text, created_at, dispatched_at, job_id):
+        return {
+            "schedule_id": schedule_id,
+            "state": state,
+            "publish_at": _isoformat(publish_at),
+            "text": text,
+            "created_at": created_at,
+            "dispatched_at": dispatched_at,
+            "job_id": job_id
+        }
+
+    def _dispatch(self):
+        purge_at = 0.0
+        while True:
+            with self._condition:
+                version = self._version
+            try:
+                now = time.time()
+                while not self._stopped and self._dispatch_due(now) == self.batch_size:
+                    now = time.time()
+                if now >= purge_at:
+                    self._purge_history(now)
+                    purge_at = now + PURGE_INTERVAL
+                with self.transaction(write=False) as connection:
+                    next_due = connection.execute(
+                        "SELECT MIN(due_at) FROM schedule WHERE state = 'scheduled'"
+                    ).fetchone()[0]
+            except Exception as e:
+                # A locked or failing database must not stop the dispatcher, the round is tried again
+                logger.error('schedule_dispatch_failed', exc_info=e)
+                next_due = time.time() + DISPATCH_RETRY_DELAY
+                version = None
+            with self._condition:
+                self._next_due = next_due
+                if self._stopped:
+                    return
+                if self._version == version or version is None:
+                    timeout = self.max_sleep if next_due is None else next_due - time.time()
+                    self._condition.wait(max(0, min(timeout, self.max_sleep)))
+                if self._stopped:
+                    return
+
+    def _dispatch_due(self, now):
+        """
+        Hand one batch of due posts to the job queue
+
+        Returns:
+            int: Number of due posts found
+        """
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, payload FROM schedule WHERE state = 'scheduled' AND due_at <= ? "
+                "ORDER BY due_at, id LIMIT ?", (now, self.batch_size)
+            ).fetchall()
+            for schedule_id, payload in rows:
+                try:
+                    job = self.submit_function(json.loads(payload))
+                except QueueFullError as e:
+                    # Try again when the queue has room; the remaining due posts would fail the same way
+                    deferred = connection.execute(
+                        "UPDATE schedule SET due_at = ? WHERE state = 'scheduled' AND due_at <= ?",
+                        (now + e.retry_after, now)
+                    ).rowcount
+                    self.deferred += deferred
+                    return 0
+                except Exception as e:
+                    # Dispatch the other due posts; this one is tried again later
+                    logger.error('schedule_dispatch_failed', exc_info=e, extra={'fields': {'schedule_id': schedule_id}})
+                    connection.execute(
+                        'UPDATE schedule SET due_at = ? WHERE id = ?', (now + DISPATCH_RETRY_DELAY, schedule_id)
+                    )
+                    self.deferred += 1
+                    continue
+                connection.execute(
+                    "UPDATE schedule SET state = 'dispatched', payload = NULL, dispatched_at = ?, job_id = ? "
+                    "WHERE id = ?", (now, job['job_id'], schedule_id)
+                )
+                self.dispatched += 1
+        return len(rows)
+
+    def _purge_history(self, now):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM schedule WHERE dispatched_at < ?', (now - self.history_ttl,))
+
+
+def schedule_post(data):
+    """
+    Schedule a /post request carrying publish_at
+
+    Args:
+        data (dict): Validated request body
+
+    Returns:
+        tuple: (response body dict, HTTP status code)
+    """
+    if not config.SCHEDULE_ENABLED:
+        return {"status": "error", "message": "Scheduled posting is disabled"}, 400
+    try:
+        publish_at = parse_publish_at(data['publish_at'])
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+
+    read_uploads(data)
+    try:
+        post = get_scheduler().submit(data, publish_at)
+    except QueueFullError as e:
+        return {"status": "error", "message": str(e), "retry_after": e.retry_after}, 429
+    return {
+        "status": "scheduled",
+        "schedule_id": post['schedule_id'],
+        "publish_at": post['publish_at'],
+        "status_url": f"/scheduled/{post['schedule_id']}"
+    }, 202
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Return the process-wide scheduler, starting its dispatcher on first use
+    """
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = Scheduler()
+    return _default_scheduler
@@ -69,29 +69,31 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }
         
-        // Handle image if selected
+        // Send as multipart/form-data so the image is streamed as a file
+        // instead of being base64 encoded into the JSON body
+        const formData = new FormData();
+        formData.append('api_key', requestData.api_key);
+        formData.append('api_secret', requestData.api_secret);
+        formData.append('access_token', requestData.access_token);
+        formData.append('access_secret', requestData.access_secret);
+        formData.append('text', requestData.text);
+        if (requestData.proxy) {
+            formData.append('proxy', JSON.stringify(requestData.proxy));
+        }
+        
         const imageFile = document.getElementById('imageFile').files[0];
         if (imageFile) {
-            const reader = new FileReader();
-            reader.onload = function(event) {
-                // Get base64 data without the prefix
-                const base64Image = event.target.result.split(',')[1];
-                requestData.image = base64Image;
-                sendTweetRequest(requestData);
-            };
-            reader.readAsDataURL(imageFile);
-        } else {
-            sendTweetRequest(requestData);
+            formData.append('image', imageFile, imageFile.name);
         }
+        
+        sendTweetRequest(formData);
     });
     
-    function sendTweetRequest(requestData) {
+    function sendTweetRequest(formData) {
+        // The browser sets the multipart Content-Type with its boundary
         fetch('/post', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify(requestData)
+            body: formData
         })
         .then(response => response.json())
         .then(data => {
@@ -0,0 +1,62 @@
+# Local SQLite databases shared by the workers of one host
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """
+    Base of the stores kept in a local SQLite database
+
+    Every thread gets its own connection. The database runs in WAL mode so
+    workers read while another one writes. The statements of a
+    transaction() block run in one immediate transaction, which takes the
+    write lock up front; read-only blocks use transaction(write=False),
+    which never waits on writers.
+    """
+
+    def __init__(self, path, schema):
+        """
+        Args:
+            path (str): SQLite database file, its directory is created
+            schema (list): Statements run once to create tables and indexes
+        """
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.transaction() as connection:
+            for statement in schema:
+                connection.execute(statement)
+
+    def transaction(self, write=True):
+        """
+        Args:
+            write (bool): Take the write lock when the transaction begins; False for read-only blocks
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return _Transaction(connection, write)
+
+
+class _Transaction:
+    """
+    Run statements of a with block in one transaction, immediate for writers and deferred for readers
+    """
+
+    def __init__(self, connection, write=True):
+        self.connection = connection
+        self.write = write
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE' if self.write else 'BEGIN')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
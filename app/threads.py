@@ -0,0 +1,130 @@
+# Progress of POST /thread requests, so a thread that failed part way resumes where it stopped
+import hashlib
+import json
+import threading
+import time
+
+from app import config
+from app.media_cache import media_digest
+from app.storage import SQLiteStore
+
+# Seconds between purges of expired threads
+PURGE_INTERVAL = 60
+
+
+def thread_key(data):
+    """
+    Identify a thread by account, the tweet it replies to, and its texts and media
+
+    The proxy is left out, so a thread resumed through another proxy of a
+    pool is still the same thread.
+
+    Args:
+        data (dict): Validated /thread body
+
+    Returns:
+        str: Hex digest, returned to the caller as thread_id
+    """
+    tweets = []
+    for tweet in data['tweets']:
+        images = tweet.get('images') or ([tweet['image']] if tweet.get('image') else [])
+        tweets.append({"text": tweet['text'], "media": [media_digest(image) for image in images]})
+    content = {
+        "api_key": data['api_key'],
+        "access_token": data['access_token'],
+        "in_reply_to_tweet_id": data.get('in_reply_to_tweet_id'),
+        "tweets": tweets
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ThreadStore(SQLiteStore):
+    """
+    tweet_ids of the tweets each thread has posted so far
+
+    A thread is claimed while it posts (state running), so the same thread
+    sent twice at once is not posted twice; a claim older than lock_timeout
+    belongs to a dead worker and is taken over. Threads expire ttl seconds
+    after they were last started.
+    """
+
+    def __init__(self, path=None, ttl=None, lock_timeout=None):
+        """
+        Args:
+            path (str, optional): SQLite database file
+            ttl (int, optional): Seconds a thread can be resumed
+            lock_timeout (int, optional): Seconds after which a running thread is taken over
+        """
+        super().__init__(config.THREAD_DB if path is None else path, [
+            '''
+            CREATE TABLE IF NOT EXISTS threads (
+                key TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                tweet_ids TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS threads_expires ON threads (expires_at)'
+        ])
+        self.ttl = config.THREAD_TTL if ttl is None else ttl
+        self.lock_timeout = config.THREAD_LOCK_TIMEOUT if lock_timeout is None else lock_timeout
+        self._last_purge = 0.0
+
+    def begin(self, key):
+        """
+        Claim a thread before posting it
+
+        Returns:
+            list: tweet_ids already posted, in thread order, or None if the thread is posting elsewhere
+        """
+        now = time.time()
+        if now - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = now
+            self.purge_expired(now)
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT state, tweet_ids, started_at, expires_at FROM threads WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None and row[3] > now and row[0] == 'running' and row[2] >= now - self.lock_timeout:
+                return None
+            tweet_ids = json.loads(row[1]) if row is not None and row[3] > now else []
+            connection.execute(
+                'INSERT OR REPLACE INTO threads (key, state, tweet_ids, started_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (key, 'running', json.dumps(tweet_ids), now, now + self.ttl)
+            )
+        return tweet_ids
+
+    def record(self, key, tweet_ids):
+        """
+        Store the tweet_ids posted so far, right after each tweet
+        """
+        with self.transaction() as connection:
+            connection.execute('UPDATE threads SET tweet_ids = ? WHERE key = ?', (json.dumps(tweet_ids), key))
+
+    def finish(self, key, complete):
+        """
+        Release a claimed thread; an incomplete one is resumed by the next request
+        """
+        with self.transaction() as connection:
+            connection.execute('UPDATE threads SET state = ? WHERE key = ?', ('done' if complete else 'failed', key))
+
+    def purge_expired(self, now=None):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM threads WHERE expires_at <= ?', (time.time() if now is None else now,))
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_thread_store():
+    """
+    Return the process-wide thread store
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = ThreadStore()
+    return _default_store
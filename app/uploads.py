@@ -0,0 +1,91 @@
+# Multipart/form-data support for /post
+import json
+from tempfile import SpooledTemporaryFile
+
+from flask import Request
+
+from app import config
+
+BOOLEAN_FORM_FIELDS = ['async', 'verbose']
+
+
+class UploadError(Exception):
+    """
+    Raised when a multipart request cannot be turned into a post request
+    """
+
+
+class StreamingRequest(Request):
+    """
+    Flask request that keeps uploaded files out of worker memory
+
+    Werkzeug parses multipart bodies chunk by chunk; files are written to a
+    SpooledTemporaryFile that moves to disk once it exceeds UPLOAD_SPOOL_SIZE,
+    so peak memory per upload stays near the spool size instead of the image size.
+    """
+
+    max_form_memory_size = config.MAX_FORM_MEMORY_SIZE
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledTemporaryFile(max_size=config.UPLOAD_SPOOL_SIZE, mode='rb+')
+
+
+def read_post_data(request):
+    """
+    Return the /post body as a dict, from either a JSON or a multipart request
+
+    Multipart requests carry the post fields as form fields, the proxy
+    configuration as a JSON encoded "proxy" field and the image as an "image"
+    file. Repeating the "image" field attaches several images. Images are
+    returned as the spooled file objects, not as bytes.
+
+    Args:
+        request (flask.Request): Current request
+
+    Returns:
+        dict: Post request body, or None if the body is not a JSON object
+
+    Raises:
+        UploadError: If the proxy field is not a JSON object
+    """
+    if request.mimetype != 'multipart/form-data':
+        return request.get_json(silent=True)
+
+    data = request.form.to_dict()
+
+    proxy = data.pop('proxy', None)
+    if proxy:
+        try:
+            data['proxy'] = json.loads(proxy)
+        except ValueError:
+            raise UploadError("Field 'proxy' must be a JSON object")
+        if not isinstance(data['proxy'], dict):
+            raise UploadError("Field 'proxy' must be a JSON object")
+
+    for field in BOOLEAN_FORM_FIELDS:
+        if field in data:
+            data[field] = data[field].strip().lower() in ('1', 'true', 'yes', 'on')
+
+    uploads = [upload.stream for upload in request.files.getlist('image') if upload.filename]
+    if len(uploads) == 1:
+        data['image'] = uploads[0]
+    elif uploads:
+        data['images'] = uploads
+
+    return data
+
+
+def read_uploads(data):
+    """
+    Replace the spooled image files of a post request with their bytes
+
+    Spooled files are closed with the request, so posts that outlive it
+    (queued or scheduled) need the bytes.
+
+    Args:
+        data (dict): Post request body, modified in place
+    """
+    if hasattr(data.get('image'), 'read'):
+        data['image'] = data['image'].read()
+    if data.get('images'):
+        data['images'] = [image.read() if hasattr(image, 'read') else image for image in data['images']]
@@ -0,0 +1,282 @@
+# Pre-flight validation of post requests, run before any network I/O
+import base64
+import io
+import re
+import unicodedata
+
+from app import config
+from app.media import (
+    MAX_IMAGE_DIMENSION, MAX_MEDIA_SIZE, MAX_IMAGES_PER_TWEET, MediaError,
+    check_media_combination, detect_media_type, image_dimensions, media_kind
+)
+from app.proxy_pool import get_proxy_pools
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, oversized images are rejected without it
+    Image = None
+
+CREDENTIAL_FIELDS = ['api_key', 'api_secret', 'access_token', 'access_secret']
+
+# Bytes of an image inspected for its type and dimensions
+HEADER_SIZE = 64 * 1024
+
+# twitter-text v3: code points in these ranges count 1, all others 2, URLs 23
+LIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+URL_LENGTH = 23
+URL_PATTERN = re.compile(r'https?://\S+', re.IGNORECASE)
+ZERO_WIDTH_JOINER = 0x200d
+
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+BASE64_WHITESPACE = b' \t\r\n'
+DATA_URI = re.compile(r'^data:[\w/+.-]+;base64,')
+
+
+class ValidationError(Exception):
+    """
+    Raised when a post request would be rejected by Twitter
+
+    Attributes:
+        error_code (str): Machine readable reason
+    """
+
+    def __init__(self, message, error_code='invalid_request'):
+        super().__init__(message)
+        self.error_code = error_code
+
+
+def tweet_length(text):
+    """
+    Weighted length of a tweet as Twitter counts it
+
+    URLs count 23 characters; Latin, Cyrillic and most punctuation count
+    1, other characters (CJK, emoji) count 2. An emoji sequence joined with
+    zero width joiners, skin tones or variation selectors counts once.
+
+    Args:
+        text (str): Tweet text
+
+    Returns:
+        int: Weighted length
+    """
+    text = unicodedata.normalize('NFC', text)
+    length = URL_LENGTH * len(URL_PATTERN.findall(text))
+    previous_weight = 0
+    joined = False
+    for char in URL_PATTERN.sub('', text):
+        code = ord(char)
+        if code == ZERO_WIDTH_JOINER and previous_weight == 2:
+            joined = True
+            continue
+        if 0xfe00 <= code <= 0xfe0f or 0x1f3fb <= code <= 0x1f3ff:
+            continue
+        if joined:
+            joined = False
+            continue
+        previous_weight = 1 if any(start <= code <= end for start, end in LIGHT_RANGES) else 2
+        length += previous_weight
+    return length
+
+
+def _check_fields(data):
+    if not isinstance(data, dict):
+        raise ValidationError("Request body must be a JSON object")
+    for field in CREDENTIAL_FIELDS:
+        if not isinstance(data[field], str) or not data[field].strip():
+            raise ValidationError(f"Field '{field}' must be a non-empty string")
+    if not isinstance(data['text'], str):
+        raise ValidationError("Field 'text' must be a string")
+
+    proxy = data.get('proxy')
+    if proxy is not None and (
+        not isinstance(proxy, dict) or not all(isinstance(value, str) for value in proxy.values())
+    ):
+        raise ValidationError("Field 'proxy' must be an object of proxy URLs")
+    proxy_pool = data.get('proxy_pool')
+    if proxy_pool is not None:
+        if proxy is not None:
+            raise ValidationError("Fields 'proxy' and 'proxy_pool' cannot be combined")
+        if not isinstance(proxy_pool, str) or get_proxy_pools().get(proxy_pool) is None:
+            raise ValidationError(f"Unknown proxy pool: {proxy_pool}", 'unknown_proxy_pool')
+    callback_url = data.get('callback_url')
+    if callback_url is not None and (
+        not isinstance(callback_url, str) or not callback_url.lower().startswith(('http://', 'https://'))
+    ):
+        raise ValidationError("Field 'callback_url' must be an http(s) URL")
+    for field in ('async', 'verbose'):
+        if field in data and not isinstance(data[field], bool):
+            raise ValidationError(f"Field '{field}' must be a boolean")
+    publish_at = data.get('publish_at')
+    if publish_at is not None and (isinstance(publish_at, bool) or not isinstance(publish_at, (str, int, float))):
+        raise ValidationError("Field 'publish_at' must be an ISO 8601 timestamp or a Unix time")
+
+    images = data.get('images')
+    if images is not None and (not isinstance(images, list) or not images):
+        raise ValidationError("Field 'images' must be a non-empty list")
+    if images and len(images) > MAX_IMAGES_PER_TWEET:
+        raise ValidationError(f"Too many media files: {len(images)} (maximum {MAX_IMAGES_PER_TWEET})",
+                              'invalid_media')
+
+
+def _inspect_base64(value, index):
+    """
+    Type, dimensions and decoded size of base64 media, decoding only its header
+    """
+    encoded = value.encode('ascii', 'replace')
+    if encoded.translate(None, BASE64_ALPHABET + BASE64_WHITESPACE):
+        raise ValidationError(f"Media {index} is not valid base64", 'invalid_media')
+    whitespace = len(encoded) - len(encoded.translate(None, BASE64_WHITESPACE))
+    characters = len(encoded) - whitespace
+    if characters % 4:
+        raise ValidationError(f"Media {index} is not valid base64", 'invalid_media')
+    stripped = encoded.rstrip(BASE64_WHITESPACE)
+    size = characters // 4 * 3 - (len(stripped) - len(stripped.rstrip(b'=')))
+
+    prefix = encoded[:HEADER_SIZE // 3 * 4 + 64].translate(None, BASE64_WHITESPACE)
+    prefix = prefix[:len(prefix) // 4 * 4]
+    try:
+        header = base64.b64decode(prefix)
+    except ValueError:
+        raise ValidationError(f"Media {index} is not valid base64", 'invalid_media')
+    return header, size
+
+
+def _inspect_file(media_file):
+    start = media_file.tell()
+    header = media_file.read(HEADER_SIZE)
+    media_file.seek(0, 2)
+    size = media_file.tell() - start
+    media_file.seek(start)
+    return header, size
+
+
+def _can_resize():
+    return Image is not None and config.IMAGE_RESIZE_ENABLED
+
+
+def _shrink_image(content, max_size):
+    """
+    Downscale and re-encode an image to fit IMAGE_MAX_DIMENSION and max_size
+
+    Images with transparency stay PNG, others become JPEG.
+
+    Returns:
+        bytes: Encoded image
+    """
+    try:
+        image = Image.open(io.BytesIO(content))
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ValidationError(f"Image could not be decoded: {str(e)}", 'invalid_media')
+    transparent = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if transparent else 'RGB')
+
+    scale = min(1.0, config.IMAGE_MAX_DIMENSION / max(image.size))
+    quality = 90
+    for _ in range(8):
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        resized = image.resize(size, Image.LANCZOS) if size != image.size else image
+        output = io.BytesIO()
+        if transparent:
+            resized.save(output, format='PNG', optimize=True)
+        else:
+            resized.save(output, format='JPEG', quality=quality, optimize=True)
+        if output.tell() <= max_size:
+            return output.getvalue()
+        # Lower the quality first, then the resolution
+        if not transparent and quality > 70:
+            quality -= 10
+        else:
+            scale *= 0.75
+    raise ValidationError("Image is too large and could not be shrunk below the size limit", 'media_too_large')
+
+
+def _prepare_media(item, index):
+    """
+    Check one media item and shrink it if needed
+
+    Returns:
+        tuple: (media item to post, kind)
+    """
+    if isinstance(item, str):
+        match = DATA_URI.match(item)
+        if match:
+            item = item[match.end():]
+        header, size = _inspect_base64(item, index)
+    elif isinstance(item, (bytes, bytearray)):
+        header, size = bytes(item[:HEADER_SIZE]), len(item)
+    elif hasattr(item, 'read') and hasattr(item, 'seek'):
+        header, size = _inspect_file(item)
+    else:
+        raise ValidationError(f"Media {index} must be a base64 string or an uploaded file", 'invalid_media')
+
+    mime_type = detect_media_type(header[:16])
+    if mime_type is None:
+        raise ValidationError(f"Media {index} has an unsupported format, expected PNG, JPEG, WEBP, GIF or MP4",
+                              'invalid_media')
+    kind = media_kind(mime_type)
+    dimensions = image_dimensions(header, mime_type) if kind != 'video' else None
+
+    too_large = size > MAX_MEDIA_SIZE[kind]
+    too_wide = dimensions is not None and max(dimensions) > MAX_IMAGE_DIMENSION
+    if kind == 'image' and _can_resize() and (
+        too_large or too_wide or (dimensions is not None and max(dimensions) > config.IMAGE_MAX_DIMENSION)
+    ):
+        # The only case where a whole image is decoded before upload
+        if isinstance(item, str):
+            content = base64.b64decode(item)
+        elif hasattr(item, 'read'):
+            content = item.read()
+            item.seek(0)
+        else:
+            content = bytes(item)
+        return _shrink_image(content, MAX_MEDIA_SIZE[kind]), kind
+
+    if too_large:
+        raise ValidationError(f"Media {index} is too large: {size} bytes (maximum {MAX_MEDIA_SIZE[kind]} for {kind})",
+                              'media_too_large')
+    if too_wide:
+        raise ValidationError(
+            f"Media {index} is too large: {dimensions[0]}x{dimensions[1]} pixels "
+            f"(maximum {MAX_IMAGE_DIMENSION} on a side)", 'media_too_large'
+        )
+    return item, kind
+
+
+def preflight(data):
+    """
+    Check a post request the way Twitter would, before any network I/O
+
+    Checks field types, the weighted tweet length, and the format, size and
+    dimensions of the media. Base64 media are not decoded here beyond their
+    first bytes; only images that must be downscaled or re-encoded (with
+    Pillow installed) are decoded, and are then replaced by the new bytes.
+
+    Args:
+        data (dict): Request body carrying all required fields, modified in place
+
+    Raises:
+        ValidationError: If the request cannot be posted as given
+    """
+    _check_fields(data)
+
+    length = tweet_length(data['text'])
+    if length > config.TWEET_MAX_LENGTH:
+        raise ValidationError(f"Tweet is too long: {length} characters (maximum {config.TWEET_MAX_LENGTH})",
+                              'tweet_too_long')
+
+    field = 'images' if data.get('images') else 'image'
+    items = data['images'] if field == 'images' else ([data['image']] if data.get('image') else [])
+    if not items and not data['text'].strip():
+        raise ValidationError("Tweet must have text or media")
+
+    prepared = [_prepare_media(item, index) for index, item in enumerate(items)]
+    try:
+        check_media_combination([kind for _, kind in prepared])
+    except MediaError as e:
+        raise ValidationError(str(e), 'invalid_media')
+
+    if field == 'images':
+        data['images'] = [item for item, _ in prepared]
+    elif prepared:
+        data['image'] = prepared[0][0]
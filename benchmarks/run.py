@@ -0,0 +1,256 @@
+# Load test of /post against local Twitter and proxy stand-ins
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.stubs import FakeHttpProxy, FakeSocks5Proxy, FakeTwitter, StubSettings, start
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# PNG signature and an IHDR chunk of a 1024x1024 image, so pre-flight validation reads sane dimensions
+PNG_HEADER = b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sIIBBBBBI', 13, b'IHDR', 1024, 1024, 8, 6, 0, 0, 0, 0)
+
+# name -> (stub error rate, stub 429 rate, proxy mode, attach an image)
+SCENARIOS = {
+    'text': (0.0, 0.0, None, False),
+    'image': (0.0, 0.0, None, True),
+    'proxied': (0.0, 0.0, 'mixed', False),
+    'errors': (0.2, 0.1, None, False)
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb(pid):
+    """
+    Peak resident set size (VmHWM) of a process and its children in MiB, None where /proc is unavailable
+
+    Children are the gunicorn workers; their peaks are summed, so this is an
+    upper bound of the memory used at once.
+    """
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f'/proc/{current}/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as children:
+                pending.extend(int(child) for child in children.read().split())
+    except OSError:
+        return None
+    return round(total / 1024, 1)
+
+
+class ServiceProcess:
+    """
+    The service under test, in its own process so its memory is measured alone
+    """
+
+    def __init__(self, twitter_url, engine='wsgi', env=None):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.serve', '--twitter-url', twitter_url,
+             '--port', str(self.port), '--engine', engine],
+            cwd=ROOT, env=dict(os.environ, **(env or {})),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    def wait_ready(self, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if requests.get(self.url + '/health', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("Service did not start")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def build_payloads(scenario, count, accounts, image_size, proxies):
+    """
+    Request bodies for one scenario
+
+    Accounts rotate so the per-account rate limiter does not dominate, and
+    every image differs so the media cache does not skip uploads.
+    """
+    _, _, proxy_mode, with_image = SCENARIOS[scenario]
+    image = bytearray(PNG_HEADER + os.urandom(max(0, image_size - len(PNG_HEADER))))
+    payloads = []
+    for index in range(count):
+        account = index % accounts
+        payload = {
+            'api_key': 'benchmark-key',
+            'api_secret': 'benchmark-secret',
+            'access_token': f'benchmark-token-{account}',
+            'access_secret': 'benchmark-token-secret',
+            'text': f'Benchmark {scenario} {index}'
+        }
+        if with_image:
+            image[-8:] = index.to_bytes(8, 'big')
+            payload['image'] = base64.b64encode(bytes(image)).decode('ascii')
+        if proxy_mode:
+            payload['proxy'] = proxies[index % len(proxies)]
+        payloads.append(payload)
+    return payloads
+
+
+def drive(url, payloads, concurrency):
+    """
+    Send payloads to /post with at most concurrency requests in flight
+
+    Returns:
+        tuple: (latencies in seconds, status code counts, wall time in seconds)
+    """
+    local = threading.local()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(payload):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start_time = time.perf_counter()
+        try:
+            status = session.post(url + '/post', json=payload, timeout=120).status_code
+        except requests.RequestException:
+            status = 'connection_error'
+        elapsed = time.perf_counter() - start_time
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, payloads))
+    return latencies, statuses, time.perf_counter() - started
+
+
+def run_scenario(scenario, args):
+    error_rate, rate_limit_rate, _, _ = SCENARIOS[scenario]
+    settings = StubSettings(
+        latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate if args.error_rate is not None else error_rate,
+        rate_limit_rate=args.rate_limit_rate if args.rate_limit_rate is not None else rate_limit_rate
+    )
+    twitter = start(FakeTwitter(settings))
+    http_proxy = start(FakeHttpProxy(latency=args.proxy_latency))
+    socks_proxy = start(FakeSocks5Proxy(latency=args.proxy_latency, username='bench', password='p@ssword'))
+    proxies = [{'http': http_proxy.url, 'https': http_proxy.url}, {'socks5': socks_proxy.url}]
+
+    service = ServiceProcess(twitter.url, args.engine)
+    try:
+        service.wait_ready()
+        warmup = build_payloads(scenario, args.warmup, args.accounts, args.image_size, proxies)
+        drive(service.url, warmup, args.concurrency)
+
+        payloads = build_payloads(scenario, args.requests, args.accounts, args.image_size, proxies)
+        latencies, statuses, wall_time = drive(service.url, payloads, args.concurrency)
+        rss = peak_rss_mb(service.process.pid)
+    finally:
+        service.stop()
+        for server in (twitter, http_proxy, socks_proxy):
+            server.shutdown()
+            server.server_close()
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status in (200, 201))
+    return {
+        "scenario": scenario,
+        "engine": args.engine,
+        "requests": len(payloads),
+        "concurrency": args.concurrency,
+        "ok": ok,
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "throughput": round(len(payloads) / wall_time, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": rss,
+        "stub": dict(twitter.counters)
+    }
+
+
+def print_report(results):
+    header = f"{'scenario':<10}{'requests':>9}{'ok':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'RSS MB':>9}  statuses"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['scenario']:<10}{result['requests']:>9}{result['ok']:>7}{result['throughput']:>9}"
+              f"{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}"
+              f"{result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-':>9}  {result['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /post against local Twitter and proxy stand-ins")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="Scenario to run, repeatable (default: all)")
+    parser.add_argument('--requests', type=int, default=500, help="Measured requests per scenario")
+    parser.add_argument('--warmup', type=int, default=20, help="Unmeasured requests sent first")
+    parser.add_argument('--concurrency', type=int, default=16, help="Requests in flight")
+    parser.add_argument('--engine', choices=['wsgi', 'asgi', 'gunicorn'], default='wsgi',
+                        help="Application serving /post; gunicorn reads GUNICORN_* variables")
+    parser.add_argument('--accounts', type=int, default=64, help="Distinct accounts the requests rotate over")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub latency per API call in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="Random extra stub latency in seconds")
+    parser.add_argument('--proxy-latency', type=float, default=0.0, help="Proxy connect latency in seconds")
+    parser.add_argument('--error-rate', type=float, help="Override the share of 503 answers")
+    parser.add_argument('--rate-limit-rate', type=float, help="Override the share of 429 answers")
+    parser.add_argument('--image-size', type=int, default=256 * 1024, help="Image size in bytes")
+    parser.add_argument('--json', help="Also write the results to this file")
+    parser.add_argument('--seed', type=int, help="Seed of the stub error rolls")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    results = []
+    for scenario in args.scenario or list(SCENARIOS):
+        results.append(run_scenario(scenario, args))
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Serve the app with Twitter API calls redirected to a local stub
+import argparse
+import sys
+
+import requests
+from werkzeug.serving import make_server
+
+TWITTER_HOSTS = ('https://api.twitter.com', 'https://upload.twitter.com')
+
+
+def redirect_twitter(base_url):
+    """
+    Send every requests call to the Twitter hosts to base_url instead
+
+    Only the scheme and host are rewritten; OAuth signing, the pooled
+    sessions, proxies and the tweepy parsing all run as in production.
+    """
+    original = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        for host in TWITTER_HOSTS:
+            if url.startswith(host):
+                url = base_url + url[len(host):]
+                break
+        return original(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request
+
+    # The asynchronous engine builds its URLs from these module constants
+    from app import async_service
+    async_service.API_URL = base_url
+    async_service.UPLOAD_URL = base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the service against a stub Twitter API")
+    parser.add_argument('--twitter-url', required=True, help="Base URL of the stub, e.g. http://127.0.0.1:8001")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--engine', choices=['wsgi', 'asgi', 'gunicorn'], default='wsgi',
+                        help="Threaded Flask app, the asynchronous ASGI app on uvicorn, or the Flask app "
+                             "on gunicorn with gunicorn.conf.py (GUNICORN_* variables apply)")
+    args = parser.parse_args()
+
+    redirect_twitter(args.twitter_url)
+
+    if args.engine == 'asgi':
+        import uvicorn
+        from app.asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(), host=args.host, port=args.port, log_level='warning')
+        return
+
+    if args.engine == 'gunicorn':
+        # Workers are forked from this process and inherit the redirection
+        from gunicorn.app.wsgiapp import run
+        sys.argv = ['gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'{args.host}:{args.port}', 'wsgi:app']
+        run()
+        return
+
+    from app.main import create_app
+    server = make_server(args.host, args.port, create_app(), threaded=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+# Local stand-ins for the Twitter API and for HTTP and SOCKS5 proxies
+import json
+import random
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class StubSettings:
+    """
+    Behaviour of the fake Twitter API
+
+    Args:
+        latency (float): Seconds added to every API call
+        jitter (float): Random extra latency, up to this many seconds
+        error_rate (float): Share of calls answered with 503
+        rate_limit_rate (float): Share of calls answered with 429
+        rate_limit_reset (int): Seconds until x-rate-limit-reset on a 429
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, rate_limit_reset=60):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rate_limit_reset = rate_limit_reset
+
+
+class _TwitterHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        # Requests forwarded by the HTTP proxy stand-in keep their absolute URI
+        path = urlparse(self.path).path
+        settings = server.settings
+
+        delay = settings.latency + random.uniform(0, settings.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = random.random()
+        if path != '/2/users/me':
+            if roll < settings.rate_limit_rate:
+                server.count('rate_limited')
+                return self._send(429, {"title": "Too Many Requests", "detail": "Too Many Requests"}, {
+                    'x-rate-limit-limit': '200',
+                    'x-rate-limit-remaining': '0',
+                    'x-rate-limit-reset': str(int(time.time()) + settings.rate_limit_reset)
+                })
+            if roll < settings.rate_limit_rate + settings.error_rate:
+                server.count('errors')
+                return self._send(503, {"title": "Service Unavailable", "detail": "Stub error"})
+
+        if path == '/2/tweets' and self.command == 'POST':
+            server.count('tweets')
+            text = json.loads(body or b'{}').get('text', '')
+            return self._send(201, {"data": {"id": str(server.next_id()), "text": text}}, {
+                'x-rate-limit-limit': '200',
+                'x-rate-limit-remaining': '199',
+                'x-rate-limit-reset': str(int(time.time()) + 900)
+            })
+
+        if path == '/1.1/media/upload.json':
+            server.count('uploads')
+            if b'APPEND' in body[:4096] and b'command' in body[:4096]:
+                return self._send(204, None)
+            media_id = server.next_id()
+            return self._send(200, {
+                "media_id": media_id,
+                "media_id_string": str(media_id),
+                "size": length,
+                "expires_after_secs": 86400
+            })
+
+        if path == '/2/users/me':
+            return self._send(200, {"data": {"id": "1", "username": "benchmark"}})
+
+        return self._send(404, {"title": "Not Found"})
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeTwitter(ThreadingHTTPServer):
+    """
+    Fake v2 create_tweet and v1.1 media/upload endpoints over plain HTTP
+
+    Also answers GET /2/users/me so proxy connection tests succeed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), _TwitterHandler)
+        self.settings = settings or StubSettings()
+        self.counters = {"tweets": 0, "uploads": 0, "errors": 0, "rate_limited": 0}
+        self._id = 1000
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def next_id(self):
+        with self._lock:
+            self._id += 1
+            return self._id
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+def _relay(client, upstream):
+    """
+    Copy bytes both ways until one side closes
+    """
+    sockets = [client, upstream]
+    try:
+        while True:
+            readable, _, _ = select.select(sockets, [], [], 60)
+            if not readable:
+                return
+            for sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                (upstream if sock is client else client).sendall(data)
+    except OSError:
+        return
+    finally:
+        upstream.close()
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed during handshake")
+        data += chunk
+    return data
+
+
+class _HttpProxyHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        client = self.request
+        head = b''
+        while b'\r\n\r\n' not in head:
+            chunk = client.recv(65536)
+            if not chunk:
+                return
+            head += chunk
+        method, target = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')[:2]
+
+        if method == 'CONNECT':
+            host, port = target.rsplit(':', 1)
+        else:
+            parsed = urlparse(target)
+            host, port = parsed.hostname, parsed.port or 80
+        time.sleep(self.server.latency)
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=10)
+        except OSError:
+            client.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+            return
+        self.server.count()
+
+        if method == 'CONNECT':
+            client.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        else:
+            # Forward the request as received; the stub accepts absolute URIs
+            upstream.sendall(head)
+        _relay(client, upstream)
+
+
+class _Socks5Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        client = self.request
+        try:
+            version, method_count = _recv_exact(client, 2)
+            methods = _recv_exact(client, method_count)
+            if self.server.username is not None:
+                if 2 not in methods:
+                    client.sendall(b'\x05\xff')
+                    return
+                client.sendall(b'\x05\x02')
+                _, user_length = _recv_exact(client, 2)
+                username = _recv_exact(client, user_length).decode('utf-8')
+                password = _recv_exact(client, _recv_exact(client, 1)[0]).decode('utf-8')
+                if (username, password) != (self.server.username, self.server.password):
+                    client.sendall(b'\x01\x01')
+                    return
+                client.sendall(b'\x01\x00')
+            else:
+                client.sendall(b'\x05\x00')
+
+            _, command, _, address_type = _recv_exact(client, 4)
+            if address_type == 1:
+                host = socket.inet_ntoa(_recv_exact(client, 4))
+            elif address_type == 3:
+                host = _recv_exact(client, _recv_exact(client, 1)[0]).decode('idna')
+            else:
+                host = socket.inet_ntop(socket.AF_INET6, _recv_exact(client, 16))
+            port = struct.unpack('!H', _recv_exact(client, 2))[0]
+        except (ConnectionError, OSError, ValueError):
+            return
+
+        if command != 1:
+            client.sendall(b'\x05\x07\x00\x01' + b'\x00' * 6)
+            return
+        time.sleep(self.server.latency)
+        try:
+            upstream = socket.create_connection((host, port), timeout=10)
+        except OSError:
+            client.sendall(b'\x05\x05\x00\x01' + b'\x00' * 6)
+            return
+        self.server.count()
+        client.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+        _relay(client, upstream)
+
+
+class _ProxyServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    scheme = None
+
+    def __init__(self, handler, host='127.0.0.1', port=0, latency=0.0):
+        super().__init__((host, port), handler)
+        self.latency = latency
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.connections += 1
+
+
+class FakeHttpProxy(_ProxyServer):
+    """
+    HTTP proxy forwarding absolute-URI requests and CONNECT tunnels
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        super().__init__(_HttpProxyHandler, host, port, latency)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class FakeSocks5Proxy(_ProxyServer):
+    """
+    SOCKS5 proxy supporting CONNECT, with optional username/password authentication
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, username=None, password=None):
+        super().__init__(_Socks5Handler, host, port, latency)
+        self.username = username
+        self.password = password
+
+    @property
+    def url(self):
+        auth = f"{self.username}:{self.password}@" if self.username is not None else ''
+        return f"socks5://{auth}{self.server_address[0]}:{self.server_address[1]}"
+
+
+def start(server):
+    """
+    Serve a stub or proxy on a daemon thread
+
+    Returns:
+        The server, already accepting connections
+    """
+    thread = threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True)
+    thread.start()
+    return server
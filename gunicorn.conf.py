@@ -0,0 +1,48 @@
+# Gunicorn settings of the service, tuned for I/O-bound posting
+# Every value comes from app/config.py and can be overridden with an environment variable
+import multiprocessing
+
+# Not imported as 'config', which gunicorn would read as its own setting
+from app import config as app_config
+
+if app_config.GUNICORN_WORKER_CLASS == 'gevent':
+    # Must run before the app (and the standard library modules it uses) is imported
+    from gevent import monkey
+    monkey.patch_all()
+
+from app import runtime
+
+bind = app_config.GUNICORN_BIND
+worker_class = app_config.GUNICORN_WORKER_CLASS
+workers = app_config.GUNICORN_WORKERS or multiprocessing.cpu_count()
+threads = app_config.GUNICORN_THREADS
+worker_connections = app_config.GUNICORN_WORKER_CONNECTIONS
+preload_app = app_config.GUNICORN_PRELOAD
+timeout = app_config.GUNICORN_TIMEOUT
+graceful_timeout = app_config.GUNICORN_GRACEFUL_TIMEOUT
+keepalive = app_config.GUNICORN_KEEPALIVE
+max_requests = app_config.GUNICORN_MAX_REQUESTS
+max_requests_jitter = app_config.GUNICORN_MAX_REQUESTS_JITTER
+accesslog = '-'
+errorlog = '-'
+
+if preload_app:
+    # The outbox and scheduler threads start in the workers, see post_worker_init
+    runtime.defer_background_services()
+
+
+def when_ready(server):
+    if workers > 1 and not app_config.OUTBOX_ENABLED:
+        # In-memory jobs belong to the worker that queued them
+        server.log.warning('%d workers without OUTBOX_ENABLED: GET /jobs/<job_id> answers 404 when it reaches '
+                           'another worker than the one that queued the post', workers)
+
+
+def post_worker_init(worker):
+    # Forked workers dropped the singletons of the master (runtime.reset_after_fork)
+    runtime.start_background_services()
+
+
+def worker_exit(server, worker):
+    # Finish running posts within graceful_timeout; unfinished outbox posts are recovered by another worker
+    runtime.stop_background_services()
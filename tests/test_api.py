@@ -1,4 +1,5 @@
 import unittest
+import io
 import json
 import base64
 from unittest.mock import patch, MagicMock
@@ -92,6 +93,52 @@ class TestTwitterPoster(unittest.TestCase):
         # Verify mock was called with correct parameters
         mock_post_tweet.assert_called_once_with('Test tweet', self.test_image)
     
+    @patch('app.twitter_service.TwitterService.post_tweet')
+    def test_post_tweet_multipart_image(self, mock_post_tweet):
+        """Test posting a tweet with an image uploaded as multipart/form-data"""
+        image_binary = base64.b64decode(self.test_image)
+        uploaded = {}
+        
+        def capture_upload(text, image_data):
+            uploaded['text'] = text
+            uploaded['image'] = image_data.read()
+            return {
+                'tweet_id': '1234567890',
+                'tweet_url': 'https://twitter.com/user/status/1234567890'
+            }
+        mock_post_tweet.side_effect = capture_upload
+        
+        form = self.test_credentials.copy()
+        form['proxy'] = json.dumps({'http': 'http://127.0.0.1:8080'})
+        form['image'] = (io.BytesIO(image_binary), 'image.png')
+        
+        with patch('app.twitter_service.TwitterService._test_proxy_connection', return_value=(True, None)):
+            response = self.client.post('/post', data=form, content_type='multipart/form-data')
+        
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(uploaded['text'], 'Test tweet')
+        self.assertEqual(uploaded['image'], image_binary)
+    
+    def test_multipart_invalid_proxy(self):
+        """Test that a multipart proxy field must be a JSON object"""
+        form = self.test_credentials.copy()
+        form['proxy'] = 'not json'
+        response = self.client.post('/post', data=form, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+    
+    @patch('app.main.config.MAX_CONTENT_LENGTH', 64)
+    def test_request_too_large(self):
+        """Test that oversized bodies are rejected from the Content-Length header"""
+        test_data = self.test_credentials.copy()
+        test_data['image'] = self.test_image
+        response = self.client.post(
+            '/post',
+            data=json.dumps(test_data),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(json.loads(response.data)['status'], 'error')
+    
     def test_missing_required_fields(self):
         """Test error handling for missing required fields"""
         # Remove required field
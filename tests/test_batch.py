@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest.mock import patch
+from app.main import create_app
+from app.batch import resolve_batch, run_batch, account_key, BatchError
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.batch = {
+            'accounts': {
+                'main': {
+                    'api_key': 'test_api_key',
+                    'api_secret': 'test_api_secret',
+                    'access_token': 'test_access_token',
+                    'access_secret': 'test_access_secret',
+                    'proxy': 'residential'
+                }
+            },
+            'proxies': {
+                'residential': {'http': 'http://127.0.0.1:8080'}
+            },
+            'posts': [
+                {'account': 'main', 'text': 'First'},
+                {'account': 'main', 'text': 'Second', 'proxy': None},
+                {'account': 'missing', 'text': 'Third'}
+            ]
+        }
+
+    def test_resolve_references(self):
+        """Test that accounts and proxies referenced by name are expanded"""
+        resolved = resolve_batch(self.batch)
+        first, error = resolved[0]
+        self.assertIsNone(error)
+        self.assertEqual(first['access_token'], 'test_access_token')
+        self.assertEqual(first['proxy'], {'http': 'http://127.0.0.1:8080'})
+        self.assertIsNone(resolved[1][0]['proxy'])
+        self.assertIn('Unknown account', resolved[2][1]['message'])
+
+    @patch('app.posting._execute_post')
+    def test_deferred_items_are_rejected(self, mock_execute):
+        """Test that batch items asking to be scheduled or queued fail with 400 instead of posting at once"""
+        batch = dict(self.batch, stream=False, posts=[
+            {'account': 'main', 'text': 'Later', 'proxy': None, 'publish_at': '2030-01-01T00:00:00Z'},
+            {'account': 'main', 'text': 'Queued', 'proxy': None, 'async': True}
+        ])
+        response = self.client.post('/post/batch', data=json.dumps(batch), content_type='application/json')
+
+        results = json.loads(response.data)['results']
+        self.assertEqual([result['status_code'] for result in results], [400, 400])
+        self.assertIn('publish_at', results[0]['result']['message'])
+        self.assertIn('async', results[1]['result']['message'])
+        mock_execute.assert_not_called()
+
+    def test_invalid_batch(self):
+        """Test that a batch without posts is rejected"""
+        with self.assertRaises(BatchError):
+            resolve_batch({'posts': []})
+
+    def test_account_concurrency_limit(self):
+        """Test that no account runs more posts in parallel than allowed"""
+        lock = threading.Lock()
+        active = Counter()
+        peak = Counter()
+
+        def fake_post(post_data):
+            key = account_key(post_data)
+            with lock:
+                active[key] += 1
+                peak[key] = max(peak[key], active[key])
+            time.sleep(0.01)
+            with lock:
+                active[key] -= 1
+            return {'status': 'success'}, 201
+
+        posts = [(i, {'api_key': 'k', 'access_token': f"account_{i % 2}"}) for i in range(10)]
+        results = list(run_batch(posts, concurrency=4, account_concurrency=1, post_function=fake_post))
+
+        self.assertEqual(sorted(index for index, _, _ in results), list(range(10)))
+        self.assertEqual(max(peak.values()), 1)
+
+    def test_failures_do_not_abort_batch(self):
+        """Test that an exception in one post still returns the others"""
+        def flaky_post(post_data):
+            if post_data['text'] == 'bad':
+                raise Exception('boom')
+            return {'status': 'success'}, 201
+
+        posts = [(0, {'text': 'bad'}), (1, {'text': 'good'})]
+        results = {index: status_code for index, _, status_code in run_batch(posts, post_function=flaky_post)}
+        self.assertEqual(results, {0: 500, 1: 201})
+
+    @patch('app.twitter_service.TwitterService.post_tweet')
+    @patch('app.twitter_service.TwitterService._test_proxy_connection', return_value=(True, None))
+    def test_batch_endpoint_streams_results(self, mock_test_proxy, mock_post_tweet):
+        """Test that the batch endpoint streams one line per post and a summary"""
+        mock_post_tweet.return_value = {
+            'tweet_id': '1234567890',
+            'tweet_url': 'https://twitter.com/user/status/1234567890'
+        }
+        response = self.client.post('/post/batch', data=json.dumps(self.batch), content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1]['summary'], {'total': 3, 'succeeded': 2, 'failed': 1})
+
+    @patch('app.twitter_service.TwitterService.post_tweet')
+    def test_batch_endpoint_single_document(self, mock_post_tweet):
+        """Test the non-streaming batch response"""
+        mock_post_tweet.return_value = {'tweet_id': '1', 'tweet_url': 'https://twitter.com/user/status/1'}
+        batch = dict(self.batch, stream=False, posts=[{'account': 'main', 'text': 'Only', 'proxy': None}])
+        response = self.client.post('/post/batch', data=json.dumps(batch), content_type='application/json')
+
+        data = json.loads(response.data)
+        self.assertEqual(data['summary']['succeeded'], 1)
+        self.assertEqual(data['results'][0]['result']['tweet_id'], '1')
+
+if __name__ == '__main__':
+    unittest.main()
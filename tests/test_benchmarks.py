@@ -0,0 +1,48 @@
+import unittest
+import requests
+from benchmarks.run import percentile
+from benchmarks.stubs import FakeHttpProxy, FakeSocks5Proxy, FakeTwitter, StubSettings, start
+
+class TestBenchmarkStubs(unittest.TestCase):
+    def setUp(self):
+        self.twitter = start(FakeTwitter(StubSettings(latency=0)))
+
+    def tearDown(self):
+        self.twitter.shutdown()
+        self.twitter.server_close()
+
+    def _serve(self, server):
+        start(server)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_create_tweet_through_proxies(self):
+        """Test that the stub answers create_tweet through both proxy stand-ins"""
+        http_proxy = self._serve(FakeHttpProxy())
+        socks_proxy = self._serve(FakeSocks5Proxy(username='user', password='p@ss'))
+        socks_url = socks_proxy.url.replace('p@ss', 'p%40ss')
+
+        for proxy_url in (http_proxy.url, socks_url):
+            response = requests.post(self.twitter.url + '/2/tweets', json={'text': 'hi'},
+                                     proxies={'http': proxy_url})
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.json()['data']['text'], 'hi')
+        self.assertEqual(self.twitter.counters['tweets'], 2)
+
+    def test_rate_limited_answers(self):
+        """Test that the stub answers 429 with rate-limit headers"""
+        self.twitter.settings.rate_limit_rate = 1.0
+        response = requests.post(self.twitter.url + '/2/tweets', json={'text': 'hi'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['x-rate-limit-remaining'], '0')
+
+    def test_percentile(self):
+        """Test the nearest-rank percentile"""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import asyncio
+import base64
+import json
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+import requests
+from app import posting
+from app.client_pool import ClientPool, KeepAliveSession
+from app.deadline import Deadline, DeadlineExceeded, current_deadline, deadline_scope, parse_deadline
+from app.main import create_app
+from app.media_cache import MediaCache
+from app.proxy_health import ProxyHealthRegistry
+from app.twitter_service import TwitterService
+
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+
+POST = {
+    'api_key': 'key', 'api_secret': 'secret',
+    'access_token': 'token', 'access_secret': 'token_secret', 'text': 'Hello'
+}
+
+
+def make_service():
+    service = TwitterService('key', 'secret', 'token', 'token_secret', client_pool=ClientPool(),
+                             media_cache=MediaCache(), rate_limiter=None)
+    service.client = MagicMock()
+    service.api = MagicMock()
+    return service
+
+
+class TestDeadline(unittest.TestCase):
+    def test_parse_header(self):
+        """Test that the header sets the deadline, capped at the maximum, and bad values are rejected"""
+        self.assertEqual(parse_deadline('2.5').seconds, 2.5)
+        with patch('app.deadline.config.REQUEST_DEADLINE_MAX', 60.0):
+            self.assertEqual(parse_deadline('3600').seconds, 60.0)
+        with patch('app.deadline.config.REQUEST_DEADLINE', 30.0):
+            self.assertEqual(parse_deadline(None).seconds, 30.0)
+        for value in ('soon', '0', '-1', 'nan', 'inf'):
+            with self.assertRaises(ValueError):
+                parse_deadline(value)
+
+    def test_phase_keeps_reserve(self):
+        """Test that a phase stops at its reserve, which takes at most half of the deadline"""
+        deadline = Deadline(10)
+        deadline.start('media_upload', reserve=4)
+        self.assertAlmostEqual(deadline.budget(), 6, delta=0.1)
+        deadline.start('media_upload', reserve=30)
+        self.assertAlmostEqual(deadline.budget(), 5, delta=0.1)
+        deadline.expires_at = time.monotonic() + 1
+        with self.assertRaises(DeadlineExceeded) as raised:
+            deadline.start('media_upload', reserve=4)
+        self.assertEqual(raised.exception.phase, 'media_upload')
+
+
+class TestSessionTimeouts(unittest.TestCase):
+    @patch('requests.Session.request')
+    def test_timeouts_cut_to_deadline(self, mock_request):
+        """Test that every call gets timeouts, cut to the deadline, and none is sent once it has passed"""
+        session = KeepAliveSession()
+        with patch('app.deadline.config.HTTP_CONNECT_TIMEOUT', 5.0), \
+                patch('app.deadline.config.HTTP_READ_TIMEOUT', 30.0):
+            session.request('POST', 'https://api.twitter.com/2/tweets')
+            self.assertEqual(mock_request.call_args.kwargs['timeout'], (5.0, 30.0))
+
+            with deadline_scope(Deadline(2)):
+                session.request('POST', 'https://api.twitter.com/2/tweets', timeout=60)
+            connect, read = mock_request.call_args.kwargs['timeout']
+            self.assertLessEqual(connect, 2)
+            self.assertLessEqual(read, 2)
+
+            with deadline_scope(Deadline(0)), self.assertRaises(DeadlineExceeded):
+                session.request('POST', 'https://api.twitter.com/2/tweets')
+        self.assertEqual(mock_request.call_count, 2)
+
+
+class TestServiceDeadline(unittest.TestCase):
+    def test_create_tweet_timeout(self):
+        """Test that a create_tweet timing out at the deadline is reported with its phase"""
+        service = make_service()
+
+        def slow(**kwargs):
+            time.sleep(0.15)
+            raise requests.ReadTimeout('Read timed out')
+
+        service.client.create_tweet.side_effect = slow
+        with deadline_scope(Deadline(0.2)):
+            result = service.post_tweet('Hello')
+        self.assertEqual((result['error_code'], result['phase']), ('deadline_exceeded', 'create_tweet'))
+        self.assertIn('may have been created', result['error'])
+
+    def test_uploads_keep_time_for_create_tweet(self):
+        """Test that uploads run under the request deadline and stop before the create_tweet reserve"""
+        service = make_service()
+        seen = []
+
+        def slow_upload(**kwargs):
+            seen.append(current_deadline())
+            time.sleep(0.3)
+            raise requests.ReadTimeout('Read timed out')
+
+        service.api.simple_upload.side_effect = slow_upload
+        deadline = Deadline(0.5)
+        with patch('app.twitter_service.config.REQUEST_DEADLINE_RESERVE', 5.0), deadline_scope(deadline):
+            result = service.post_tweet('Hello', [PNG, PNG])
+        self.assertEqual((result['error_code'], result['phase']), ('deadline_exceeded', 'media_upload'))
+        self.assertEqual(seen, [deadline, deadline])
+        service.client.create_tweet.assert_not_called()
+
+    def test_cancelled_probe_not_cached(self):
+        """Test that a proxy probe cut short by the deadline does not mark the proxy as dead"""
+        registry = ProxyHealthRegistry(probe_interval=0)
+        probe = MagicMock(side_effect=DeadlineExceeded('proxy_check'))
+        proxy = {'socks5': 'socks5://proxy.example:1080'}
+        with self.assertRaises(DeadlineExceeded):
+            registry.check(proxy, probe)
+        probe.side_effect = None
+        probe.return_value = (True, None)
+        self.assertEqual(registry.check(proxy, probe), (True, None))
+        self.assertEqual(probe.call_count, 2)
+
+
+class TestDeadlineEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = create_app().test_client()
+
+    def post(self, headers):
+        return self.client.post('/post', data=json.dumps(POST), content_type='application/json', headers=headers)
+
+    def test_invalid_header(self):
+        """Test that an invalid X-Request-Deadline is rejected"""
+        response = self.post({'X-Request-Deadline': 'soon'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['error_code'], 'invalid_deadline')
+
+    @patch('app.posting.TwitterService')
+    def test_deadline_exceeded_is_504(self, mock_service):
+        """Test that the header deadline reaches the pipeline and a spent deadline answers 504"""
+        deadlines = []
+
+        def post_tweet(text, image_data):
+            deadlines.append(current_deadline())
+            return {'status': 'error', 'error': 'Request deadline exceeded during media_upload',
+                    'error_code': 'deadline_exceeded', 'phase': 'media_upload', 'request': {}, 'response': {}}
+
+        mock_service.return_value.post_tweet.side_effect = post_tweet
+        response = self.post({'X-Request-Deadline': '2'})
+        self.assertEqual(response.status_code, 504)
+        body = json.loads(response.data)
+        self.assertEqual((body['error_code'], body['phase']), ('deadline_exceeded', 'media_upload'))
+        self.assertEqual(deadlines[0].seconds, 2.0)
+
+    def test_async_post_cancelled(self):
+        """Test that the asynchronous engine cancels a post still running at its deadline"""
+        cancelled = []
+
+        async def hang(data):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with patch('app.posting._execute_post_async', hang):
+            body, status_code = asyncio.run(posting.execute_post_async(dict(POST), Deadline(0.1)))
+        self.assertEqual((status_code, body['error_code']), (504, 'deadline_exceeded'))
+        self.assertEqual(cancelled, [True])
+
+if __name__ == '__main__':
+    unittest.main()
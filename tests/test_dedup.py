@@ -0,0 +1,110 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from app.dedup import DedupIndex, content_key
+from app.main import create_app
+
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+
+POST = {
+    'api_key': 'key', 'api_secret': 'secret',
+    'access_token': '42-token', 'access_secret': 'token_secret', 'text': 'Hello'
+}
+
+
+class TestContentKey(unittest.TestCase):
+    def test_normalized_content(self):
+        """Test that whitespace and encoding variants of one post share a fingerprint, other content does not"""
+        account, fingerprint = content_key(dict(POST, text='Hello  world\n', images=[PNG]))
+        self.assertEqual(account, '42')
+        self.assertEqual(len(fingerprint), 16)
+        self.assertEqual(content_key(dict(POST, text=' Hello world', image=base64.b64encode(PNG).decode('ascii'))),
+                         (account, fingerprint))
+        self.assertNotEqual(content_key(dict(POST, text='Hello world'))[1], fingerprint)
+        self.assertNotEqual(content_key(dict(POST, text='hello world', images=[PNG]))[1], fingerprint)
+        self.assertNotEqual(content_key(dict(POST, access_token='43-token', text='Hello world', images=[PNG]))[0],
+                            account)
+
+
+class TestDedupIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dedup.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claim_and_window(self):
+        """Test that content is blocked while it is sent and within the window, across restarts"""
+        index = DedupIndex(self.path, window=60, max_per_account=10)
+        fingerprint = bytes(16)
+        self.assertIsNone(index.claim('42', fingerprint))
+        self.assertEqual(index.claim('42', fingerprint), {'state': 'pending'})
+        index.finish('42', fingerprint)
+        self.assertIsNone(index.claim('42', fingerprint))
+        index.finish('42', fingerprint, tweet_id='100')
+
+        earlier = DedupIndex(self.path, window=60).claim('42', fingerprint)
+        self.assertEqual((earlier['state'], earlier['tweet_id']), ('posted', '100'))
+        self.assertIsNone(index.claim('43', fingerprint))
+
+        index.purge_expired(time.time() + 61)
+        self.assertIsNone(index.claim('42', fingerprint))
+
+    def test_eviction_into_summaries(self):
+        """Test that fingerprints beyond the limit are dropped, or still rejected from a Bloom summary"""
+        fingerprints = [bytes([index]) * 16 for index in range(3)]
+        for bloom in (False, True):
+            path = os.path.join(self.directory, f'bloom-{bloom}.sqlite3')
+            index = DedupIndex(path, window=3600, max_per_account=2, bloom=bloom)
+            with patch('app.dedup.config.DEDUP_BLOOM_CAPACITY', 100):
+                for tweet_id, fingerprint in enumerate(fingerprints):
+                    self.assertIsNone(index.claim('42', fingerprint))
+                    index.finish('42', fingerprint, tweet_id=tweet_id)
+            stats = index.stats()
+            self.assertEqual((stats['entries'], stats['summaries']), (2, int(bloom)))
+            self.assertEqual(index.claim('42', fingerprints[0]), {'state': 'probable'} if bloom else None)
+            self.assertIsNone(index.claim('42', bytes([9]) * 16))
+
+
+class TestDedupEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        index = DedupIndex(os.path.join(self.directory, 'dedup.sqlite3'))
+        for patcher in (patch('app.posting.get_dedup_index', return_value=index),
+                        patch('app.posting.config.DEDUP_ENABLED', True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = create_app().test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def post(self, data):
+        return self.client.post('/post', data=json.dumps(data), content_type='application/json')
+
+    @patch('app.posting.TwitterService')
+    def test_duplicate_rejected_before_posting(self, mock_service):
+        """Test that a failed post can be sent again and a posted one is answered 409 without calling Twitter"""
+        mock_service.return_value.post_tweet.return_value = {'status': 'error', 'error': 'boom'}
+        self.assertEqual(self.post(POST).status_code, 500)
+
+        mock_service.return_value.post_tweet.return_value = {
+            'status': 'success', 'tweet_id': '100', 'tweet_url': 'https://twitter.com/user/status/100'
+        }
+        self.assertEqual(self.post(POST).status_code, 201)
+
+        response = self.post(dict(POST, text=' Hello '))
+        self.assertEqual(response.status_code, 409)
+        body = json.loads(response.data)
+        self.assertEqual((body['error_code'], body['tweet_id']), ('duplicate_content', '100'))
+        self.assertEqual(mock_service.return_value.post_tweet.call_count, 2)
+        self.assertEqual(self.post(dict(POST, text='Hello again')).status_code, 201)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from app.idempotency import (
+    IN_PROGRESS, MISMATCH, NEW, REPLAY, IdempotencyStore, idempotency_key, run_idempotent
+)
+from app.main import create_app
+
+POST = {
+    'api_key': 'key', 'api_secret': 'secret',
+    'access_token': 'token', 'access_secret': 'token_secret',
+    'text': 'Hello'
+}
+
+class TestIdempotencyStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = IdempotencyStore(os.path.join(self.directory, 'keys.sqlite3'), ttl=60, lock_timeout=30)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_finished_request_is_replayed(self):
+        """Test that a finished key replays its response"""
+        self.assertEqual(self.store.begin('k', 'f')[0], NEW)
+        self.store.finish('k', {"status": "success", "tweet_id": "42"}, 201)
+        self.assertEqual(self.store.begin('k', 'f'), (REPLAY, {"status": "success", "tweet_id": "42"}, 201))
+
+    def test_key_reused_for_other_request(self):
+        """Test that a key used with a different fingerprint is rejected"""
+        self.store.begin('k', 'f')
+        self.store.finish('k', {"status": "success"}, 201)
+        self.assertEqual(self.store.begin('k', 'other')[0], MISMATCH)
+
+    def test_failed_request_is_retried(self):
+        """Test that posts failing before create_tweet are run again, later failures are replayed"""
+        for body, status_code in (({"status": "error"}, 429),
+                                  ({"error_code": "proxy_pool_unavailable"}, 503),
+                                  ({"error_code": "deadline_exceeded", "phase": "media_upload"}, 504),
+                                  ({"error": "Proxy connection test failed", "proxy_unreachable": True}, 500)):
+            self.store.begin('k', 'f')
+            self.store.finish('k', body, status_code)
+            self.assertEqual(self.store.begin('k', 'f')[0], NEW)
+            self.store.finish('k', {"status": "success"}, 201)
+            self.store.purge_expired(float('inf'))
+
+        for body, status_code in (({"error_code": "deadline_exceeded", "phase": "create_tweet"}, 504),
+                                  ({"error": "Twitter API error"}, 500)):
+            self.store.begin('k', 'f')
+            self.store.finish('k', body, status_code)
+            self.assertEqual(self.store.begin('k', 'f'), (REPLAY, body, status_code))
+            self.store.purge_expired(float('inf'))
+
+    def test_reads_do_not_wait_for_writers(self):
+        """Test that reading a key and the counters does not queue behind a write transaction"""
+        self.store.begin('k', 'f')
+        locked = threading.Event()
+        release = threading.Event()
+
+        def writer():
+            with self.store.transaction() as connection:
+                connection.execute("UPDATE idempotency SET started_at = started_at WHERE key = 'k'")
+                locked.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(5))
+            reader = threading.Thread(target=lambda: (self.store.stats(), self.store.wait('k', 0)))
+            reader.start()
+            reader.join(2)
+            self.assertFalse(reader.is_alive())
+        finally:
+            release.set()
+            thread.join()
+
+    def test_running_request(self):
+        """Test that a running key is in progress until the lock times out"""
+        self.store.begin('k', 'f')
+        self.assertEqual(self.store.begin('k', 'f')[0], IN_PROGRESS)
+        self.store.lock_timeout = -1
+        self.assertEqual(self.store.begin('k', 'f')[0], NEW)
+
+    def test_expired_key(self):
+        """Test that expired keys are claimed again and purged"""
+        self.store.ttl = -1
+        self.store.begin('k', 'f')
+        self.store.finish('k', {"status": "success"}, 201)
+        self.assertEqual(self.store.begin('k', 'f')[0], NEW)
+        self.store.purge_expired()
+        self.assertEqual(self.store.stats()['done'] + self.store.stats()['running'], 0)
+
+    def test_retry_waits_for_running_request(self):
+        """Test that a concurrent retry gets the result of the first request"""
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def post():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"status": "success", "tweet_id": "42"}, 201
+
+        first = threading.Thread(target=run_idempotent, args=(self.store, 'k', 'f', post))
+        first.start()
+        started.wait(5)
+        threading.Timer(0.1, release.set).start()
+        body, status_code, replayed = run_idempotent(self.store, 'k', 'f', post)
+        first.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((body['tweet_id'], status_code, replayed), ('42', 201, True))
+
+    def test_keys_are_scoped_to_account(self):
+        """Test that the same header value of two accounts gives two keys"""
+        first, _ = idempotency_key(POST, 'abc')
+        second, _ = idempotency_key(dict(POST, access_token='other'), 'abc')
+        self.assertNotEqual(first, second)
+        self.assertEqual(idempotency_key(POST, None), (None, None))
+
+
+class TestIdempotentPost(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        store = IdempotencyStore(os.path.join(self.directory, 'keys.sqlite3'))
+        patcher = patch('app.main.get_idempotency_store', return_value=store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = create_app().test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def post(self, data, key):
+        return self.client.post('/post', data=json.dumps(data), content_type='application/json',
+                                headers={'Idempotency-Key': key})
+
+    @patch('app.main.execute_post')
+    def test_retry_is_replayed(self, mock_execute):
+        """Test that a retry with the same key does not post twice"""
+        mock_execute.return_value = ({"status": "success", "tweet_id": "42"}, 201)
+
+        first = self.post(POST, 'abc')
+        second = self.post(POST, 'abc')
+
+        self.assertEqual(mock_execute.call_count, 1)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(json.loads(second.data)['tweet_id'], '42')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+
+    @patch('app.main.execute_post')
+    def test_key_reused_for_other_body(self, mock_execute):
+        """Test that a key reused for another tweet is rejected with 422"""
+        mock_execute.return_value = ({"status": "success", "tweet_id": "42"}, 201)
+        self.post(POST, 'abc')
+        response = self.post(dict(POST, text='Other'), 'abc')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.data)['error_code'], 'idempotency_key_reused')
+        self.assertEqual(mock_execute.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
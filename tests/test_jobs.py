@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+from app.main import create_app
+from app.jobs import JobManager, QueueFullError
+
+class TestJobManager(unittest.TestCase):
+    def wait_for(self, manager, job_id):
+        for _ in range(100):
+            job = manager.get(job_id)
+            if job['state'] in ('succeeded', 'failed'):
+                return job
+            time.sleep(0.01)
+        self.fail('Job did not finish')
+
+    def test_job_result(self):
+        """Test that a finished job exposes the /post response and status code"""
+        manager = JobManager(workers=1, queue_size=1, executor='thread',
+                             post_function=lambda data: ({'status': 'success', 'tweet_id': '1'}, 201))
+        job = manager.submit({'text': 'Test tweet'})
+        self.assertIn(job['state'], ('queued', 'running', 'succeeded'))
+
+        finished = self.wait_for(manager, job['job_id'])
+        self.assertEqual(finished['state'], 'succeeded')
+        self.assertEqual(finished['status_code'], 201)
+        self.assertEqual(finished['result']['tweet_id'], '1')
+        manager.shutdown()
+
+    def test_queue_full(self):
+        """Test backpressure when all workers are busy and the queue is full"""
+        release = threading.Event()
+
+        def blocking_post(data):
+            release.wait(5)
+            return {'status': 'success'}, 201
+
+        manager = JobManager(workers=1, queue_size=1, executor='thread', post_function=blocking_post)
+        manager.submit({})
+        manager.submit({})
+        with self.assertRaises(QueueFullError) as context:
+            manager.submit({})
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        release.set()
+        manager.shutdown()
+
+    def test_failed_job(self):
+        """Test that an exception in a job is reported as a failed job"""
+        manager = JobManager(workers=1, queue_size=1, executor='thread',
+                             post_function=MagicMock(side_effect=Exception('boom')))
+        job = self.wait_for(manager, manager.submit({})['job_id'])
+        self.assertEqual(job['state'], 'failed')
+        self.assertIn('boom', job['result']['message'])
+        manager.shutdown()
+
+class TestAsyncPostEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.test_data = {
+            'api_key': 'test_api_key',
+            'api_secret': 'test_api_secret',
+            'access_token': 'test_access_token',
+            'access_secret': 'test_access_secret',
+            'text': 'Test tweet',
+            'async': True
+        }
+
+    @patch('app.twitter_service.TwitterService.post_tweet')
+    def test_async_post_and_poll(self, mock_post_tweet):
+        """Test that async mode returns 202 and the job can be polled"""
+        mock_post_tweet.return_value = {
+            'tweet_id': '1234567890',
+            'tweet_url': 'https://twitter.com/user/status/1234567890'
+        }
+        response = self.client.post('/post', data=json.dumps(self.test_data), content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(data['status'], 'accepted')
+
+        for _ in range(100):
+            job = json.loads(self.client.get(data['status_url']).data)
+            if job['state'] == 'succeeded':
+                break
+            time.sleep(0.01)
+        self.assertEqual(job['state'], 'succeeded')
+        self.assertEqual(job['result']['tweet_id'], '1234567890')
+
+    @patch('app.main.get_job_manager')
+    def test_async_post_queue_full(self, mock_get_job_manager):
+        """Test that a full queue answers 429 with Retry-After"""
+        mock_get_job_manager.return_value.submit.side_effect = QueueFullError('Job queue is full', 3)
+        response = self.client.post('/post', data=json.dumps(self.test_data), content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '3')
+
+    def test_unknown_job(self):
+        """Test polling a job that does not exist"""
+        response = self.client.get('/jobs/unknown')
+        self.assertEqual(response.status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
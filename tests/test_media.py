@@ -0,0 +1,124 @@
+import base64
+import io
+import unittest
+from unittest.mock import MagicMock
+import tweepy
+from app.client_pool import ClientPool
+from app.media_cache import MediaCache, content_digest
+from app.media import detect_media_type, describe_media, check_media_combination, upload_media, MediaError
+from app.twitter_service import TwitterService
+
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+GIF = b'GIF89a' + b'\x00' * 32
+MP4 = b'\x00\x00\x00\x18ftypmp42' + b'\x00' * 32
+
+class TestMedia(unittest.TestCase):
+    def test_detect_media_type(self):
+        """Test media type detection from magic bytes"""
+        self.assertEqual(detect_media_type(PNG[:16]), 'image/png')
+        self.assertEqual(detect_media_type(b'\xff\xd8\xff\xe0' + b'\x00' * 12), 'image/jpeg')
+        self.assertEqual(detect_media_type(GIF[:16]), 'image/gif')
+        self.assertEqual(detect_media_type(MP4[:16]), 'video/mp4')
+        self.assertIsNone(detect_media_type(b'plain text here!'))
+
+    def test_describe_media_keeps_position(self):
+        """Test that inspecting a file leaves it ready for upload"""
+        media_file = io.BytesIO(PNG)
+        self.assertEqual(describe_media(media_file), ('image/png', 'image', len(PNG)))
+        self.assertEqual(media_file.tell(), 0)
+
+    def test_media_combination_rules(self):
+        """Test the up to 4 images, or a single GIF/video rule"""
+        check_media_combination(['image'] * 4)
+        with self.assertRaises(MediaError):
+            check_media_combination(['image'] * 5)
+        with self.assertRaises(MediaError):
+            check_media_combination(['image', 'video'])
+
+    def test_upload_media_in_order(self):
+        """Test that several media are uploaded and returned in request order"""
+        api = MagicMock()
+        api.simple_upload.side_effect = lambda filename, file: MagicMock(media_id=filename)
+        api.chunked_upload.side_effect = lambda filename, **kwargs: MagicMock(media_id=filename)
+
+        media_ids = upload_media(api, [io.BytesIO(PNG), io.BytesIO(PNG), io.BytesIO(PNG)])
+        self.assertEqual(media_ids, ['media0.png', 'media1.png', 'media2.png'])
+        self.assertEqual(api.simple_upload.call_count, 3)
+
+        media_ids = upload_media(api, [io.BytesIO(GIF)])
+        self.assertEqual(media_ids, ['media0.gif'])
+        self.assertEqual(api.chunked_upload.call_args.kwargs['media_category'], 'tweet_gif')
+
+    def test_post_tweet_with_several_images(self):
+        """Test that a tweet with several images calls create_tweet once with all media_ids"""
+        service = TwitterService('key', 'secret', 'token', 'token_secret',
+                                 client_pool=ClientPool(), media_cache=MediaCache())
+        service.client = MagicMock()
+        service.client.create_tweet.return_value = MagicMock(data={'id': '42'})
+        service.api = MagicMock()
+        service.api.simple_upload.side_effect = [
+            MagicMock(media_id=1, expires_after_secs=86400),
+            MagicMock(media_id=2, expires_after_secs=86400)
+        ]
+
+        image = base64.b64encode(PNG).decode()
+        result = service.post_tweet('Two images', [image, image])
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['response']['tweet_type'], 'with_images')
+        service.client.create_tweet.assert_called_once_with(text='Two images', media_ids=[1, 2])
+
+    def test_media_cache_skips_upload_per_account(self):
+        """Test that identical content is uploaded once per account"""
+        cache = MediaCache(max_size=10, ttl=3600)
+        api = MagicMock()
+        api.simple_upload.side_effect = [
+            MagicMock(media_id=1, expires_after_secs=86400),
+            MagicMock(media_id=2, expires_after_secs=86400)
+        ]
+
+        reused = []
+        self.assertEqual(upload_media(api, [io.BytesIO(PNG)], cache=cache, account='a'), [1])
+        self.assertEqual(upload_media(api, [io.BytesIO(PNG)], cache=cache, account='a', reused=reused), [1])
+        self.assertEqual(upload_media(api, [io.BytesIO(PNG)], cache=cache, account='b'), [2])
+
+        self.assertEqual(reused, [0])
+        self.assertEqual(api.simple_upload.call_count, 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_media_cache_respects_platform_expiry(self):
+        """Test that a media_id is not reused past its reported expiry"""
+        cache = MediaCache(max_size=10, ttl=3600)
+        digest = content_digest(io.BytesIO(PNG))
+        cache.put('a', digest, 1, expires_after=60)
+        self.assertIsNone(cache.get('a', digest))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_media_cache_size_limit(self):
+        """Test that the least recently used media_id is evicted when full"""
+        cache = MediaCache(max_size=2, ttl=3600)
+        for media_id in range(3):
+            cache.put('a', str(media_id), media_id)
+        self.assertIsNone(cache.get('a', '0'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_expired_cached_media_is_uploaded_again(self):
+        """Test that a rejected cached media_id is replaced by a fresh upload"""
+        cache = MediaCache(max_size=10, ttl=3600)
+        service = TwitterService('key', 'secret', 'token', 'token_secret',
+                                 client_pool=ClientPool(), media_cache=cache)
+        cache.put(service.account_key, content_digest(io.BytesIO(PNG)), 1)
+        rejected = tweepy.BadRequest(MagicMock(status_code=400, json=MagicMock(return_value={})))
+        service.client = MagicMock()
+        service.client.create_tweet.side_effect = [rejected, MagicMock(data={'id': '42'})]
+        service.api = MagicMock()
+        service.api.simple_upload.return_value = MagicMock(media_id=2, expires_after_secs=86400)
+
+        result = service.post_tweet('Banner', base64.b64encode(PNG).decode())
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['response']['media_ids'], [2])
+        service.client.create_tweet.assert_called_with(text='Banner', media_ids=[2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from app.jobs import QueueFullError
+from app.outbox import Outbox, is_retryable
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.sqlite3')
+        self.outboxes = []
+
+    def tearDown(self):
+        for outbox in self.outboxes:
+            outbox.shutdown()
+        shutil.rmtree(self.directory)
+
+    def make_outbox(self, post_function, **kwargs):
+        kwargs.setdefault('workers', 2)
+        kwargs.setdefault('poll_interval', 0.01)
+        kwargs.setdefault('backoff_base', 0.01)
+        outbox = Outbox(self.path, post_function=post_function, **kwargs)
+        self.outboxes.append(outbox)
+        return outbox
+
+    def wait_for(self, outbox, job_id):
+        for _ in range(300):
+            job = outbox.get(job_id)
+            if job['state'] in ('succeeded', 'failed'):
+                return job
+            time.sleep(0.01)
+        self.fail('Job did not finish')
+
+    def test_job_result(self):
+        """Test that a post from the outbox exposes its response like a job"""
+        outbox = self.make_outbox(lambda data: ({'status': 'success', 'tweet_id': data['text']}, 201))
+        job = outbox.submit({'text': '1', 'image': b'\x89PNG'})
+
+        finished = self.wait_for(outbox, job['job_id'])
+        self.assertEqual(finished['state'], 'succeeded')
+        self.assertEqual(finished['result']['tweet_id'], '1')
+        self.assertEqual(finished['attempts'], 1)
+
+    def test_retry_with_backoff(self):
+        """Test that retryable failures are attempted again until they succeed"""
+        attempts = []
+
+        def flaky_post(data):
+            attempts.append(time.time())
+            if len(attempts) < 3:
+                return {'status': 'error', 'message': 'Connection reset'}, 500
+            return {'status': 'success'}, 201
+
+        outbox = self.make_outbox(flaky_post)
+        finished = self.wait_for(outbox, outbox.submit({})['job_id'])
+        self.assertEqual(finished['state'], 'succeeded')
+        self.assertEqual(finished['attempts'], 3)
+        self.assertEqual(outbox.stats()['retried'], 2)
+
+    def test_permanent_failure_is_not_retried(self):
+        """Test that Twitter's 4xx answers and exhausted attempts fail the job"""
+        outbox = self.make_outbox(lambda data: ({'status': 'error', 'error': '403 Forbidden\nduplicate'}, 500),
+                                  max_attempts=3)
+        finished = self.wait_for(outbox, outbox.submit({})['job_id'])
+        self.assertEqual((finished['state'], finished['attempts']), ('failed', 1))
+
+        outbox.post_function = lambda data: ({'status': 'error', 'message': 'timed out'}, 500)
+        finished = self.wait_for(outbox, outbox.submit({})['job_id'])
+        self.assertEqual((finished['state'], finished['attempts']), ('failed', 3))
+
+    def test_is_retryable(self):
+        """Test the classification of failed posts"""
+        self.assertTrue(is_retryable({'error_code': 'rate_limited'}, 429))
+        self.assertTrue(is_retryable({'message': 'Proxy connection test failed'}, 500))
+        self.assertFalse(is_retryable({'error': '401 Unauthorized'}, 500))
+        self.assertFalse(is_retryable({'message': 'Missing required fields'}, 400))
+
+    def test_recovery_of_abandoned_post(self):
+        """Test that a post left running by a dead worker is resumed"""
+        release = threading.Event()
+        first = self.make_outbox(lambda data: (release.wait(5), ({'status': 'success'}, 201))[1], lease=0.05)
+        job_id = first.submit({'text': 'x'})['job_id']
+        while first.get(job_id)['state'] != 'running':
+            time.sleep(0.01)
+        # Simulate a crash: the dispatcher stops renewing the lease
+        first._stopped.set()
+        first._dispatcher.join()
+
+        second = self.make_outbox(lambda data: ({'status': 'success', 'tweet_id': '2'}, 201))
+        finished = self.wait_for(second, job_id)
+        release.set()
+        self.assertEqual(finished['result']['tweet_id'], '2')
+        self.assertEqual(finished['attempts'], 2)
+        self.assertEqual(second.stats()['recovered'], 1)
+
+    def test_expired_lease_does_not_overwrite_new_owner(self):
+        """Test that a worker finishing after its lease expired leaves the post to the worker that took it over"""
+        first_release = threading.Event()
+        second_release = threading.Event()
+        first = self.make_outbox(lambda data: (first_release.wait(5), ({'status': 'success', 'tweet_id': '1'}, 201))[1],
+                                 lease=0.05)
+        job_id = first.submit({'text': 'x'})['job_id']
+        while first.get(job_id)['state'] != 'running':
+            time.sleep(0.01)
+        first._stopped.set()
+        first._dispatcher.join()
+
+        second = self.make_outbox(lambda data: (second_release.wait(5), ({'status': 'success', 'tweet_id': '2'}, 201))[1])
+        while second.get(job_id)['attempts'] != 2:
+            time.sleep(0.01)
+        first_release.set()
+        first._executor.shutdown(wait=True)
+        with sqlite3.connect(self.path) as connection:
+            state, owner, payload = connection.execute(
+                'SELECT state, owner, payload FROM outbox WHERE id = ?', (job_id,)
+            ).fetchone()
+        self.assertEqual((state, owner), ('running', second.owner))
+        self.assertIsNotNone(payload)
+
+        second_release.set()
+        self.assertEqual(self.wait_for(second, job_id)['result']['tweet_id'], '2')
+
+    def test_dispatcher_survives_database_errors(self):
+        """Test that a failing claim is logged and retried instead of stopping the dispatcher"""
+        claim = Outbox._claim
+        failures = []
+
+        def locked_once(outbox, limit, now):
+            if not failures:
+                failures.append(now)
+                raise sqlite3.OperationalError('database is locked')
+            return claim(outbox, limit, now)
+
+        with patch.object(Outbox, '_claim', locked_once):
+            outbox = self.make_outbox(lambda data: ({'status': 'success'}, 201))
+            finished = self.wait_for(outbox, outbox.submit({})['job_id'])
+        self.assertEqual(finished['state'], 'succeeded')
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(outbox._dispatcher.is_alive())
+
+    def test_outbox_full(self):
+        """Test that submissions beyond max_pending are rejected"""
+        release = threading.Event()
+        outbox = self.make_outbox(lambda data: (release.wait(5), ({'status': 'success'}, 201))[1],
+                                  workers=1, max_pending=2)
+        outbox.submit({})
+        outbox.submit({})
+        with self.assertRaises(QueueFullError):
+            outbox.submit({})
+        release.set()
+
+    def test_pending_counts(self):
+        """Test that the per-state counts follow the posts, and are rebuilt for an outbox without them"""
+        release = threading.Event()
+
+        def post(data):
+            release.wait(5)
+            return {'status': 'success'}, 201
+
+        outbox = self.make_outbox(post, workers=1)
+        job_ids = [outbox.submit({})['job_id'] for _ in range(3)]
+        self.assertEqual(outbox.pending, 3)
+
+        with sqlite3.connect(self.path) as connection:
+            connection.execute('DROP TABLE outbox_counts')
+        self.assertEqual(self.make_outbox(post, workers=1).pending, 3)
+
+        release.set()
+        for job_id in job_ids:
+            self.wait_for(outbox, job_id)
+        stats = outbox.stats()
+        self.assertEqual((outbox.pending, stats['succeeded']), (0, 3))
+
+    def test_finished_payload_is_dropped(self):
+        """Test that credentials and media are not kept once a post is done"""
+        outbox = self.make_outbox(lambda data: ({'status': 'success'}, 201))
+        job_id = outbox.submit({'access_secret': 'secret'})['job_id']
+        self.wait_for(outbox, job_id)
+        with sqlite3.connect(self.path) as connection:
+            payload = connection.execute('SELECT payload FROM outbox WHERE id = ?', (job_id,)).fetchone()[0]
+        self.assertIsNone(payload)
+
+if __name__ == '__main__':
+    unittest.main()
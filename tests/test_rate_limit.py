@@ -0,0 +1,130 @@
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+import requests
+import tweepy
+from app.client_pool import ClientPool
+from app.rate_limit import RateLimiter, RateLimitedError, make_response_hook
+from app.twitter_service import TwitterService
+from app.main import create_app
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket_defers_when_empty(self):
+        """Test that posts beyond the bucket are deferred without consuming a token"""
+        limiter = RateLimiter(account_posts=2, account_window=60)
+        self.assertEqual(limiter.reserve('account'), (True, 0.0))
+        self.assertEqual(limiter.reserve('account'), (True, 0.0))
+
+        reserved, wait = limiter.reserve('account')
+        self.assertFalse(reserved)
+        self.assertAlmostEqual(wait, 30, delta=1)
+        self.assertTrue(limiter.reserve('other')[0])
+        self.assertEqual(limiter.stats()['deferred'], 1)
+
+    def test_app_bucket_is_shared_by_accounts(self):
+        """Test that the app bucket limits all accounts of one API key"""
+        limiter = RateLimiter(account_posts=10, account_window=60, app_posts=1, app_window=60)
+        self.assertTrue(limiter.reserve('first', 'app')[0])
+        self.assertFalse(limiter.reserve('second', 'app')[0])
+
+    def test_headers_block_until_reset(self):
+        """Test that an exhausted platform limit blocks the account until the reset"""
+        limiter = RateLimiter(account_posts=10, account_window=60)
+        limiter.update_from_headers('account', {
+            'x-rate-limit-limit': '10',
+            'x-rate-limit-remaining': '0',
+            'x-rate-limit-reset': str(int(time.time()) + 120)
+        })
+        reserved, wait = limiter.reserve('account', max_wait=5)
+        self.assertFalse(reserved)
+        self.assertGreater(wait, 100)
+
+    def test_backoff_grows_without_reset_header(self):
+        """Test the jittered exponential backoff after repeated 429s"""
+        limiter = RateLimiter(account_posts=10, account_window=60, backoff_base=10, backoff_max=25)
+        first = limiter.record_rate_limited('account')
+        self.assertTrue(5 <= first <= 10)
+        limiter.clear()
+        limiter.record_rate_limited('account')
+        limiter.record_rate_limited('account')
+        third = limiter.record_rate_limited('account')
+        self.assertTrue(12.5 <= third <= 25)
+
+    def test_response_hook_only_tracks_create_tweet(self):
+        """Test that the session hook reads headers of create_tweet responses only"""
+        limiter = MagicMock()
+        hook = make_response_hook(limiter, 'account')
+        response = MagicMock(url='https://api.twitter.com/2/tweets', status_code=201, headers={})
+        response.request.method = 'POST'
+        hook(response)
+        limiter.update_from_headers.assert_called_once_with('account', {})
+        limiter.record_success.assert_called_once_with('account')
+
+        limiter.reset_mock()
+        response.url = 'https://upload.twitter.com/1.1/media/upload.json'
+        hook(response)
+        limiter.update_from_headers.assert_not_called()
+
+    def test_post_tweet_reports_platform_429(self):
+        """Test that a 429 from Twitter is reported with the expected send time"""
+        limiter = RateLimiter(account_posts=10, account_window=60)
+        service = TwitterService('key', 'secret', 'token', 'token_secret',
+                                 client_pool=ClientPool(), rate_limiter=limiter)
+        response = requests.Response()
+        response.status_code = 429
+        response.headers['x-rate-limit-reset'] = str(int(time.time()) + 60)
+        service.client = MagicMock()
+        service.client.create_tweet.side_effect = tweepy.TooManyRequests(response)
+
+        result = service.post_tweet('Test tweet')
+        self.assertEqual(result['error_code'], 'rate_limited')
+        self.assertTrue(55 <= result['retry_after'] <= 62)
+        self.assertIn('expected_send_at', result)
+        self.assertFalse(limiter.reserve(service.account_key)[0])
+
+    @patch('app.twitter_service.upload_media')
+    def test_failed_upload_refunds_the_slot(self, mock_upload_media):
+        """Test that a post failing before create_tweet gives its slot back, a sent one does not"""
+        limiter = RateLimiter(account_posts=1, account_window=60)
+        service = TwitterService('key', 'secret', 'token', 'token_secret',
+                                 client_pool=ClientPool(), rate_limiter=limiter)
+        service.client = MagicMock()
+        service.api = MagicMock()
+        mock_upload_media.side_effect = Exception("Upload failed")
+
+        result = service.post_tweet('Test tweet', b'image bytes')
+        self.assertEqual(result['status'], 'error')
+        service.client.create_tweet.assert_not_called()
+
+        service.client.create_tweet.side_effect = Exception("Connection reset")
+        result = service.post_tweet('Test tweet')
+        self.assertNotIn('error_code', result)
+        service.client.create_tweet.assert_called_once()
+        self.assertFalse(limiter.reserve(service.account_key)[0])
+
+    @patch('app.posting.TwitterService')
+    def test_post_endpoint_returns_429(self, mock_twitter_service):
+        """Test that a deferred post is answered with 429 and Retry-After"""
+        error = RateLimitedError("Rate limit reached", 30)
+        mock_instance = MagicMock()
+        mock_instance.post_tweet.return_value = {
+            'status': 'error',
+            'error': str(error),
+            'error_code': 'rate_limited',
+            'retry_after': error.retry_after,
+            'expected_send_at': error.expected_send_at
+        }
+        mock_twitter_service.return_value = mock_instance
+
+        client = create_app().test_client()
+        response = client.post('/post', json={
+            'api_key': 'key', 'api_secret': 'secret',
+            'access_token': 'token', 'access_secret': 'token_secret',
+            'text': 'Test tweet'
+        })
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        self.assertEqual(response.json['expected_send_at'], error.expected_send_at)
+
+if __name__ == '__main__':
+    unittest.main()
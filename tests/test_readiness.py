@@ -0,0 +1,156 @@
+import json
+import threading
+import unittest
+from unittest.mock import patch
+from app.main import create_app
+from app.readiness import LoadMonitor, OverloadedError
+
+POST = {
+    'api_key': 'key', 'api_secret': 'secret',
+    'access_token': 'token', 'access_secret': 'token_secret', 'text': 'Hello'
+}
+
+
+class TestLoadMonitor(unittest.TestCase):
+    def test_admission_sheds_beyond_capacity(self):
+        """Test that posts beyond max_in_flight are turned away and slots are given back"""
+        monitor = LoadMonitor(max_in_flight=1, retry_after=3, refresh_interval=0)
+        with monitor.admit():
+            with self.assertRaises(OverloadedError) as raised:
+                with monitor.admit():
+                    pass
+            self.assertEqual(raised.exception.retry_after, 3)
+            self.assertFalse(monitor.ready()[0])
+        with monitor.admit():
+            pass
+        self.assertEqual((monitor.in_flight, monitor.admitted, monitor.shed), (0, 2, 1))
+        self.assertTrue(monitor.ready()[0])
+
+    def test_admission_of_several_slots(self):
+        """Test that a request holding several slots is only admitted when all of them are free"""
+        monitor = LoadMonitor(max_in_flight=3, refresh_interval=0)
+        with monitor.admit():
+            with self.assertRaises(OverloadedError):
+                with monitor.admit(3):
+                    pass
+            with monitor.admit(2):
+                self.assertEqual(monitor.in_flight, 3)
+        self.assertEqual((monitor.in_flight, monitor.shed), (0, 1))
+
+    @patch('app.readiness.config.ADMISSION_MAX_IN_FLIGHT', 0)
+    @patch('app.readiness.config.GUNICORN_THREADS', 8)
+    @patch('app.readiness.config.GUNICORN_WORKER_CONNECTIONS', 1000)
+    def test_default_capacity_follows_worker_class(self):
+        """Test that the default limit is sized from the greenlets of a gevent worker, the threads otherwise"""
+        self.assertEqual(LoadMonitor().max_in_flight, 6)
+        with patch('app.readiness.config.GUNICORN_WORKER_CLASS', 'gevent'):
+            self.assertEqual(LoadMonitor().max_in_flight, 750)
+
+    def test_error_rate(self):
+        """Test that the error rate only counts once enough results are in the window"""
+        monitor = LoadMonitor(max_error_rate=0.5, min_requests=4, refresh_interval=0)
+        for status_code in (500, 502, 504):
+            monitor.record_result(status_code)
+        self.assertTrue(monitor.ready()[0])
+        monitor.record_result(201)
+        ready, status = monitor.ready()
+        self.assertFalse(ready)
+        self.assertEqual(status['checks']['errors']['error_rate'], 0.75)
+
+    def test_snapshot_is_cached(self):
+        """Test that readiness is served from the last snapshot between refreshes"""
+        monitor = LoadMonitor(max_error_rate=0.5, min_requests=1, refresh_interval=60)
+        self.assertTrue(monitor.ready()[0])
+        monitor.record_result(500)
+        self.assertTrue(monitor.ready()[0])
+        monitor.refresh()
+        self.assertFalse(monitor.ready()[0])
+
+
+class TestReadyEndpoint(unittest.TestCase):
+    @patch('app.readiness.config.READY_REFRESH_INTERVAL', 0.0)
+    @patch('app.readiness.config.ADMISSION_MAX_IN_FLIGHT', 1)
+    def test_overloaded_worker(self):
+        """Test that a worker at capacity sheds posts with 503 and reports itself unready"""
+        client = create_app().test_client()
+        self.assertEqual(client.get('/ready').status_code, 200)
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_post(data):
+            started.set()
+            release.wait(5)
+            return {'status': 'success', 'tweet_id': '1'}, 201
+
+        with patch('app.posting._execute_post', side_effect=slow_post):
+            first = threading.Thread(target=client.post, args=('/post',),
+                                     kwargs={'data': json.dumps(POST), 'content_type': 'application/json'})
+            first.start()
+            self.assertTrue(started.wait(5))
+            try:
+                response = client.post('/post', data=json.dumps(POST), content_type='application/json')
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers['Retry-After'], '1')
+                self.assertEqual(json.loads(response.data)['error_code'], 'overloaded')
+
+                ready = client.get('/ready')
+                self.assertEqual(ready.status_code, 503)
+                self.assertFalse(json.loads(ready.data)['checks']['capacity']['ok'])
+            finally:
+                release.set()
+                first.join()
+        self.assertEqual(client.get('/ready').status_code, 200)
+
+    @patch('app.readiness.config.READY_REFRESH_INTERVAL', 0.0)
+    @patch('app.readiness.config.ADMISSION_MAX_IN_FLIGHT', 2)
+    def test_batch_takes_a_slot_per_concurrent_post(self):
+        """Test that a batch is shed when its posts do not fit next to running ones, and admitted once they do"""
+        client = create_app().test_client()
+        batch = {'posts': [POST, POST, POST], 'stream': False}
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_post(data):
+            started.set()
+            release.wait(5)
+            return {'status': 'success', 'tweet_id': '1'}, 201
+
+        with patch('app.posting._execute_post', side_effect=slow_post):
+            first = threading.Thread(target=client.post, args=('/post',),
+                                     kwargs={'data': json.dumps(POST), 'content_type': 'application/json'})
+            first.start()
+            self.assertTrue(started.wait(5))
+            try:
+                response = client.post('/post/batch', data=json.dumps(batch), content_type='application/json')
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(json.loads(response.data)['error_code'], 'overloaded')
+            finally:
+                release.set()
+                first.join()
+
+            for stream in (False, True):
+                response = client.post('/post/batch', data=json.dumps(dict(batch, stream=stream)),
+                                       content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+                response.get_data()
+                response.close()
+                self.assertEqual(json.loads(client.get('/ready').data)['checks']['capacity']['in_flight'], 0)
+
+    @patch('app.readiness.config.READY_REFRESH_INTERVAL', 0.0)
+    @patch('app.readiness.config.READY_MIN_REQUESTS', 2)
+    @patch('app.posting._execute_post', return_value=({'status': 'error', 'error': 'boom'}, 500))
+    def test_failing_posts_make_worker_unready(self, mock_execute):
+        """Test that a high share of 5xx posts takes the worker out of rotation"""
+        client = create_app().test_client()
+        for _ in range(2):
+            client.post('/post', data=json.dumps(POST), content_type='application/json')
+        response = client.get('/ready')
+        self.assertEqual(response.status_code, 503)
+        body = json.loads(response.data)
+        self.assertEqual(body['status'], 'unavailable')
+        self.assertEqual(body['checks']['errors']['requests'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
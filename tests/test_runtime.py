@@ -0,0 +1,55 @@
+import os
+import unittest
+from unittest.mock import patch
+from app import client_pool, runtime
+
+
+class TestRuntime(unittest.TestCase):
+    def tearDown(self):
+        runtime._services_deferred = False
+
+    def test_reset_after_fork(self):
+        """Test that a forked worker creates its own singletons"""
+        parent_pool = client_pool.get_client_pool()
+        parent_lock = client_pool._default_pool_lock
+        with patch.object(runtime, '_inherited', []):
+            with patch.object(client_pool, '_default_pool', parent_pool):
+                runtime.reset_after_fork()
+                self.assertIsNone(client_pool._default_pool)
+                self.assertIsNot(client_pool._default_pool_lock, parent_lock)
+                self.assertIsNot(client_pool.get_client_pool(), parent_pool)
+                self.assertIn(parent_pool, runtime._inherited)
+        client_pool._default_pool_lock = parent_lock
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "os.fork is not available")
+    def test_fork_hook(self):
+        """Test that the fork hook runs in the child and leaves the parent alone"""
+        parent_pool = client_pool.get_client_pool()
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write_end, b'1' if client_pool._default_pool is None else b'0')
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_end, 'rb') as child:
+            self.assertEqual(child.read(), b'1')
+        self.assertIs(client_pool.get_client_pool(), parent_pool)
+
+    @patch('app.jobs.get_job_manager')
+    def test_defer_background_services(self, mock_manager):
+        """Test that a preloading master does not start the outbox dispatcher"""
+        runtime.defer_background_services()
+        runtime.start_background_services()
+        mock_manager.assert_not_called()
+
+        # As reset_after_fork() does in a worker
+        runtime._services_deferred = False
+        with patch('app.runtime.config.OUTBOX_ENABLED', True), patch('app.runtime.config.SCHEDULE_ENABLED', False):
+            runtime.start_background_services()
+        mock_manager.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from app.jobs import QueueFullError
+from app.main import create_app
+from app.scheduler import Scheduler, parse_publish_at
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'schedule.sqlite3')
+        self.schedulers = []
+        self.jobs = []
+        self.submitted = threading.Event()
+
+    def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler.shutdown()
+        shutil.rmtree(self.directory)
+
+    def submit_job(self, data):
+        self.jobs.append((time.time(), data))
+        self.submitted.set()
+        return {'job_id': str(len(self.jobs))}
+
+    def make_scheduler(self, **kwargs):
+        kwargs.setdefault('submit_function', self.submit_job)
+        scheduler = Scheduler(self.path, **kwargs)
+        self.schedulers.append(scheduler)
+        return scheduler
+
+    def test_parse_publish_at(self):
+        """Test the accepted publish_at formats"""
+        self.assertEqual(parse_publish_at('2024-01-02T08:00:00Z'), 1704182400.0)
+        self.assertEqual(parse_publish_at('2024-01-02T10:00:00+02:00'), 1704182400.0)
+        self.assertEqual(parse_publish_at('2024-01-02T08:00:00'), 1704182400.0)
+        self.assertEqual(parse_publish_at(1704182400), 1704182400.0)
+        with self.assertRaises(ValueError):
+            parse_publish_at('tomorrow')
+
+    def test_post_dispatched_when_due(self):
+        """Test that a post is handed to the job queue at publish_at, not before"""
+        scheduler = self.make_scheduler()
+        publish_at = time.time() + 0.2
+        post = scheduler.submit({'text': 'Later', 'image': b'\x89PNG', 'publish_at': 'x'}, publish_at)
+
+        self.assertTrue(self.submitted.wait(2))
+        dispatched_at, data = self.jobs[0]
+        self.assertGreaterEqual(dispatched_at, publish_at)
+        self.assertLess(dispatched_at, publish_at + 0.5)
+        self.assertEqual(data['text'], 'Later')
+        self.assertNotIn('publish_at', data)
+        self.assertEqual(scheduler.get(post['schedule_id'])['state'], 'dispatched')
+
+    def test_earlier_post_wakes_dispatcher(self):
+        """Test that a post due sooner than the next one does not wait for it"""
+        scheduler = self.make_scheduler(max_sleep=60)
+        scheduler.submit({'text': 'Late'}, time.time() + 30)
+        time.sleep(0.05)
+        scheduler.submit({'text': 'Soon'}, time.time() + 0.05)
+
+        self.assertTrue(self.submitted.wait(2))
+        self.assertEqual(self.jobs[0][1]['text'], 'Soon')
+
+    def test_schedule_survives_restart(self):
+        """Test that posts of a stopped scheduler are dispatched by the next one"""
+        first = self.make_scheduler(submit_function=lambda data: self.fail('Dispatched too early'))
+        first.submit({'text': 'Persisted'}, time.time() + 0.1)
+        first.shutdown()
+        self.schedulers.remove(first)
+
+        self.make_scheduler()
+        self.assertTrue(self.submitted.wait(2))
+        self.assertEqual(self.jobs[0][1]['text'], 'Persisted')
+
+    def test_cancel(self):
+        """Test that pending posts can be cancelled and dispatched ones cannot"""
+        scheduler = self.make_scheduler()
+        later = scheduler.submit({'text': 'Later'}, time.time() + 60)
+        now = scheduler.submit({'text': 'Now'}, time.time())
+        self.assertTrue(self.submitted.wait(2))
+
+        self.assertEqual(scheduler.cancel(later['schedule_id'])['state'], 'cancelled')
+        with self.assertRaises(ValueError):
+            scheduler.cancel(now['schedule_id'])
+        self.assertIsNone(scheduler.cancel('unknown'))
+        self.assertEqual(scheduler.stats()['scheduled'], 0)
+
+    def test_list_pages(self):
+        """Test that pending posts are listed in due order, page by page"""
+        scheduler = self.make_scheduler()
+        start = time.time() + 60
+        for index in range(5):
+            scheduler.submit({'text': str(index)}, start + 4 - index)
+
+        first = scheduler.list(3)
+        second = scheduler.list(3, after=first[-1]['schedule_id'])
+        self.assertEqual([post['text'] for post in first + second], ['4', '3', '2', '1', '0'])
+
+    def test_full_queue_defers_posts(self):
+        """Test that due posts wait for the job queue instead of being dropped"""
+        def full_queue(data):
+            raise QueueFullError("Job queue is full", 60)
+
+        scheduler = self.make_scheduler(submit_function=full_queue)
+        post = scheduler.submit({'text': 'Busy'}, time.time())
+        for _ in range(100):
+            if scheduler.stats()['deferred']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(scheduler.get(post['schedule_id'])['state'], 'scheduled')
+        self.assertEqual(scheduler.stats()['deferred'], 1)
+
+    @patch('app.scheduler.DISPATCH_RETRY_DELAY', 0.05)
+    def test_dispatch_error_keeps_dispatcher_running(self):
+        """Test that a post the queue fails to take is retried and the dispatcher keeps running"""
+        calls = []
+
+        def failing_once(data):
+            calls.append(data['text'])
+            if len(calls) == 1:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            return self.submit_job(data)
+
+        scheduler = self.make_scheduler(submit_function=failing_once)
+        first = scheduler.submit({'text': 'First'}, time.time())
+        for _ in range(200):
+            if len(self.jobs) == 1:
+                break
+            time.sleep(0.01)
+        self.assertTrue(scheduler._dispatcher.is_alive())
+        self.assertEqual(scheduler.get(first['schedule_id'])['state'], 'dispatched')
+
+        second = scheduler.submit({'text': 'Second'}, time.time())
+        for _ in range(200):
+            if len(self.jobs) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(scheduler.get(second['schedule_id'])['state'], 'dispatched')
+        self.assertEqual(calls, ['First', 'First', 'Second'])
+
+
+class TestScheduledPostEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scheduler = Scheduler(os.path.join(self.directory, 'schedule.sqlite3'),
+                                   submit_function=lambda data: {'job_id': '1'})
+        for target in ('app.main.get_scheduler', 'app.scheduler.get_scheduler'):
+            patcher = patch(target, return_value=self.scheduler)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = create_app().test_client()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_schedule_and_cancel(self):
+        """Test scheduling a post through /post, inspecting and cancelling it"""
+        response = self.client.post('/post', data=json.dumps({
+            'api_key': 'key', 'api_secret': 'secret',
+            'access_token': 'token', 'access_secret': 'token_secret',
+            'text': 'Later', 'publish_at': '2100-01-01T00:00:00Z'
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        body = json.loads(response.data)
+        self.assertEqual(body['publish_at'], '2100-01-01T00:00:00+00:00')
+        self.assertTrue(response.headers['Location'].endswith(body['status_url']))
+
+        listed = json.loads(self.client.get('/scheduled').data)
+        self.assertEqual([post['schedule_id'] for post in listed['posts']], [body['schedule_id']])
+
+        self.assertEqual(self.client.delete(body['status_url']).status_code, 200)
+        self.assertEqual(json.loads(self.client.get(body['status_url']).data)['state'], 'cancelled')
+        self.assertEqual(self.client.delete(body['status_url']).status_code, 409)
+
+    def test_invalid_publish_at(self):
+        """Test that an unparsable publish_at is rejected"""
+        response = self.client.post('/post', data=json.dumps({
+            'api_key': 'key', 'api_secret': 'secret',
+            'access_token': 'token', 'access_secret': 'token_secret',
+            'text': 'Later', 'publish_at': 'tomorrow'
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
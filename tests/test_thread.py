@@ -0,0 +1,141 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from app.client_pool import ClientPool
+from app.main import create_app
+from app.media_cache import MediaCache
+from app.threads import ThreadStore
+from app.twitter_service import TwitterService
+
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+IMAGE = base64.b64encode(PNG).decode()
+
+THREAD = {
+    'api_key': 'key', 'api_secret': 'secret',
+    'access_token': 'token', 'access_secret': 'token_secret',
+    'tweets': [{'text': 'One', 'image': IMAGE}, {'text': 'Two'}, {'text': 'Three', 'images': [IMAGE, IMAGE]}]
+}
+
+
+def make_service():
+    service = TwitterService('key', 'secret', 'token', 'token_secret', client_pool=ClientPool(),
+                             media_cache=MediaCache(), rate_limiter=MagicMock(reserve=MagicMock(return_value=(True, 0))))
+    service.client = MagicMock()
+    service.api = MagicMock()
+    return service
+
+
+class TestPostThread(unittest.TestCase):
+    def test_media_uploaded_before_replies(self):
+        """Test that all media are uploaded first and every tweet replies to the previous one"""
+        service = make_service()
+        calls = []
+        media_ids = iter(range(1, 10))
+        service.api.simple_upload.side_effect = lambda **kwargs: calls.append('upload') or MagicMock(
+            media_id=next(media_ids), expires_after_secs=86400)
+        tweet_ids = iter(['10', '11', '12'])
+        service.client.create_tweet.side_effect = lambda **kwargs: calls.append('create') or MagicMock(
+            data={'id': next(tweet_ids)})
+
+        result = service.post_thread([('One', IMAGE), ('Two', None), ('Three', [IMAGE, IMAGE])], '9')
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual([tweet['tweet_id'] for tweet in result['tweets']], ['10', '11', '12'])
+        self.assertEqual(calls, ['upload'] * 3 + ['create'] * 3)
+        created = [call.kwargs for call in service.client.create_tweet.call_args_list]
+        self.assertEqual([kwargs.get('in_reply_to_tweet_id') for kwargs in created], ['9', '10', '11'])
+        self.assertEqual(len(created[0]['media_ids']), 1)
+        self.assertNotIn('media_ids', created[1])
+        self.assertEqual(len(created[2]['media_ids']), 2)
+
+    def test_resume_after_failed_link(self):
+        """Test that a failed tweet stops the thread and a retry continues after the last posted tweet"""
+        service = make_service()
+        service.client.create_tweet.side_effect = [MagicMock(data={'id': '10'}), ValueError('boom')]
+        posted = []
+        tweets = [('One', None), ('Two', None), ('Three', None)]
+
+        result = service.post_thread(tweets, on_posted=lambda index, tweet_id: posted.append(tweet_id))
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(result['failed_index'], 1)
+        self.assertEqual(posted, ['10'])
+
+        service.client.create_tweet.side_effect = [MagicMock(data={'id': '11'}), MagicMock(data={'id': '12'})]
+        result = service.post_thread(tweets, posted=posted)
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual([tweet['tweet_id'] for tweet in result['tweets']], ['10', '11', '12'])
+        self.assertEqual(service.client.create_tweet.call_args_list[-2].kwargs['in_reply_to_tweet_id'], '10')
+
+
+class TestThreadStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ThreadStore(os.path.join(self.directory, 'threads.sqlite3'), ttl=60, lock_timeout=30)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claim_and_resume(self):
+        """Test that a running thread is not claimed twice and a failed one resumes with its tweets"""
+        self.assertEqual(self.store.begin('k'), [])
+        self.assertIsNone(self.store.begin('k'))
+        self.store.record('k', ['10'])
+        self.store.finish('k', False)
+        self.assertEqual(self.store.begin('k'), ['10'])
+
+
+class TestThreadEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        store = ThreadStore(os.path.join(self.directory, 'threads.sqlite3'))
+        patcher = patch('app.posting.get_thread_store', return_value=store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = create_app().test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def post(self, data):
+        return self.client.post('/thread', data=json.dumps(data), content_type='application/json')
+
+    @patch('app.posting.TwitterService')
+    def test_thread_resumes_when_sent_again(self, mock_service):
+        """Test that sending a failed thread again resumes after its posted tweets"""
+        def fail_second(tweets, in_reply_to_tweet_id, posted, on_posted):
+            on_posted(0, '10')
+            return {'status': 'error', 'error': 'boom', 'failed_index': 1, 'request': {}, 'response': {},
+                    'tweets': [{'index': 0, 'tweet_id': '10'}]}
+
+        mock_service.return_value.post_thread.side_effect = fail_second
+        response = self.post(THREAD)
+        self.assertEqual(response.status_code, 500)
+        body = json.loads(response.data)
+        self.assertEqual(body['failed_index'], 1)
+
+        mock_service.return_value.post_thread.side_effect = None
+        mock_service.return_value.post_thread.return_value = {
+            'status': 'success', 'tweet_id': '10', 'tweets': [], 'request': {}, 'response': {}
+        }
+        response = self.post(THREAD)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)['thread_id'], body['thread_id'])
+        self.assertEqual(mock_service.return_value.post_thread.call_args[0][2], ['10'])
+
+    def test_invalid_thread(self):
+        """Test that an invalid tweet is reported with its index before anything is posted"""
+        response = self.post(dict(THREAD, tweets=[{'text': 'One'}, {'text': 'x' * 300}]))
+        self.assertEqual(response.status_code, 400)
+        body = json.loads(response.data)
+        self.assertEqual((body['error_code'], body['index']), ('tweet_too_long', 1))
+
+        with patch('app.posting.config.THREAD_MAX_TWEETS', 2):
+            self.assertEqual(self.post(THREAD).status_code, 400)
+        self.assertEqual(self.post(dict(THREAD, publish_at=0)).status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
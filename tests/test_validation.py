@@ -0,0 +1,155 @@
+import base64
+import io
+import json
+import os
+import struct
+import unittest
+from unittest.mock import patch
+from app.main import create_app
+from app.media import image_dimensions
+from app.validation import ValidationError, preflight, tweet_length
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def png_header(width, height):
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sIIBBBBBI', 13, b'IHDR', width, height, 8, 6, 0, 0, 0, 0)
+
+
+def post(**fields):
+    data = {
+        'api_key': 'key', 'api_secret': 'secret',
+        'access_token': 'token', 'access_secret': 'token_secret',
+        'text': 'Hello'
+    }
+    data.update(fields)
+    return data
+
+
+def encoded_image(image, image_format, **options):
+    output = io.BytesIO()
+    image.save(output, format=image_format, **options)
+    return output.getvalue()
+
+class TestTweetLength(unittest.TestCase):
+    def test_weighted_length(self):
+        """Test the twitter-text weighting of characters and URLs"""
+        self.assertEqual(tweet_length('hello'), 5)
+        self.assertEqual(tweet_length('Привет'), 6)
+        self.assertEqual(tweet_length('你好'), 4)
+        self.assertEqual(tweet_length('see https://example.com/a/very/long/path?query=1'), 4 + 23)
+        self.assertEqual(tweet_length('\U0001F44D\U0001F3FD'), 2)
+        self.assertEqual(tweet_length('\U0001F468‍\U0001F469‍\U0001F467'), 2)
+
+    def test_too_long(self):
+        """Test that tweets over the weighted limit are rejected"""
+        preflight(post(text='a' * 280))
+        with self.assertRaises(ValidationError) as context:
+            preflight(post(text='你' * 141))
+        self.assertEqual(context.exception.error_code, 'tweet_too_long')
+
+
+class TestPreflight(unittest.TestCase):
+    def test_field_types(self):
+        """Test that fields of the wrong type are rejected"""
+        for fields in ({'api_key': ''}, {'text': 42}, {'proxy': 'http://proxy'}, {'async': 'yes'},
+                       {'callback_url': 'ftp://host'}, {'images': []}, {'publish_at': True}):
+            with self.assertRaises(ValidationError, msg=fields):
+                preflight(post(**fields))
+
+    def test_media_magic_bytes(self):
+        """Test that media of an unknown format or invalid base64 are rejected"""
+        with self.assertRaises(ValidationError) as context:
+            preflight(post(image=base64.b64encode(b'not an image').decode()))
+        self.assertEqual(context.exception.error_code, 'invalid_media')
+        with self.assertRaises(ValidationError):
+            preflight(post(image='not base64!'))
+
+    def test_base64_is_not_decoded(self):
+        """Test that valid base64 media are passed on as given"""
+        image = base64.b64encode(png_header(100, 100) + os.urandom(1000)).decode()
+        data = post(images=[image, 'data:image/png;base64,' + image])
+        preflight(data)
+        self.assertEqual(data['images'], [image, image])
+
+    @patch('app.validation.config.IMAGE_RESIZE_ENABLED', False)
+    def test_limits_without_resizing(self):
+        """Test the size and dimension limits when images are not shrunk"""
+        with self.assertRaises(ValidationError) as context:
+            preflight(post(image=base64.b64encode(png_header(9000, 10)).decode()))
+        self.assertEqual(context.exception.error_code, 'media_too_large')
+
+        with self.assertRaises(ValidationError) as context:
+            preflight(post(image=png_header(10, 10) + bytes(5 * 1024 * 1024)))
+        self.assertIn('5242880', str(context.exception))
+
+    def test_media_combination(self):
+        """Test that a GIF cannot be combined with other media"""
+        gif = base64.b64encode(b'GIF89a\x0a\x00\x0a\x00').decode()
+        png = base64.b64encode(png_header(10, 10)).decode()
+        with self.assertRaises(ValidationError):
+            preflight(post(images=[gif, png]))
+
+    def test_text_or_media_required(self):
+        """Test that an empty tweet needs media"""
+        with self.assertRaises(ValidationError):
+            preflight(post(text=' '))
+        preflight(post(text='', image=base64.b64encode(png_header(10, 10)).decode()))
+
+
+@unittest.skipIf(Image is None, "Pillow is not installed")
+class TestImageProcessing(unittest.TestCase):
+    def test_dimensions_from_header(self):
+        """Test that dimensions are read from the header of every image format"""
+        image = Image.new('RGB', (321, 123), 'white')
+        for mime_type, image_format in (('image/jpeg', 'JPEG'), ('image/png', 'PNG'),
+                                        ('image/gif', 'GIF'), ('image/webp', 'WEBP')):
+            content = encoded_image(image, image_format)
+            self.assertEqual(image_dimensions(content[:4096], mime_type), (321, 123), image_format)
+        lossless = encoded_image(image, 'WEBP', lossless=True)
+        self.assertEqual(image_dimensions(lossless, 'image/webp'), (321, 123))
+
+    @patch('app.validation.config.IMAGE_MAX_DIMENSION', 200)
+    def test_wide_image_is_downscaled(self):
+        """Test that images wider than IMAGE_MAX_DIMENSION are downscaled"""
+        content = encoded_image(Image.new('RGB', (800, 100), 'red'), 'PNG')
+        data = post(image=base64.b64encode(content).decode())
+        preflight(data)
+
+        shrunk = Image.open(io.BytesIO(data['image']))
+        self.assertEqual((shrunk.format, shrunk.size), ('JPEG', (200, 25)))
+
+    def test_large_image_is_reencoded(self):
+        """Test that images over the size limit are re-encoded below it"""
+        content = encoded_image(Image.frombytes('RGB', (1500, 1500), os.urandom(1500 * 1500 * 3)), 'PNG')
+        self.assertGreater(len(content), 5 * 1024 * 1024)
+        data = post(image=content)
+        preflight(data)
+        self.assertLessEqual(len(data['image']), 5 * 1024 * 1024)
+
+
+class TestPostValidation(unittest.TestCase):
+    def setUp(self):
+        self.client = create_app().test_client()
+
+    def test_non_json_body(self):
+        """Test that /post answers 400 instead of failing on a non-JSON body"""
+        for body, content_type in ((b'text=hello', 'text/plain'), (b'{not json', 'application/json'),
+                                   (b'[1, 2]', 'application/json')):
+            response = self.client.post('/post', data=body, content_type=content_type)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data)['error_code'], 'invalid_request')
+
+    @patch('app.twitter_service.TwitterService.post_tweet')
+    def test_rejected_before_network(self, mock_post_tweet):
+        """Test that invalid posts never reach the Twitter service"""
+        response = self.client.post('/post', data=json.dumps(post(text='a' * 281)),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['error_code'], 'tweet_too_long')
+        mock_post_tweet.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()